@@ -1,9 +1,13 @@
 import json
-import boto3
 import logging
 import os
 from datetime import datetime
 import time
+import sys
+sys.path.append('/opt')
+
+# Imports locales (shared layer)
+from shared.aws_clients import LazyClient, get_resource
 
 # Setup logging
 logger = logging.getLogger()
@@ -13,10 +17,10 @@ logger.setLevel(logging.INFO)
 COLLECTION_ID = os.environ['COLLECTION_ID']
 INDEXED_DOCUMENTS_TABLE = os.environ['INDEXED_DOCUMENTS_TABLE']
 COMPARISON_RESULTS_TABLE = os.environ['COMPARISON_RESULTS_TABLE']
+CONTENT_HASHES_TABLE = os.environ.get('CONTENT_HASHES_TABLE')
 
-# AWS Clients
-rekognition_client = boto3.client('rekognition')
-dynamodb = boto3.resource('dynamodb')
+# AWS Clients (se construyen en el primer uso)
+rekognition_client = LazyClient('rekognition')
 
 def lambda_handler(event, context):
     """
@@ -288,12 +292,19 @@ def cleanup_dynamodb_tables_internal():
         comparison_results_result = cleanup_table(COMPARISON_RESULTS_TABLE, 'comparison_id', 'timestamp')
         results['comparison_results'] = comparison_results_result
         
-        # STEP 3: Consolidar resultados
+        # STEP 3: Limpiar índice de hashes (si no, los documentos re-subidos
+        # se tomarían como duplicados de documentos ya borrados)
+        if CONTENT_HASHES_TABLE:
+            logger.info("Cleaning content hashes table...")
+            results['content_hashes'] = cleanup_table(CONTENT_HASHES_TABLE, 'hash_key', 'entry_id')
+        
+        # STEP 4: Consolidar resultados
         total_documents_deleted = indexed_docs_result.get('items_deleted', 0)
         total_comparisons_deleted = comparison_results_result.get('items_deleted', 0)
         
         all_successful = (indexed_docs_result.get('success', False) and 
-                         comparison_results_result.get('success', False))
+                         comparison_results_result.get('success', False) and
+                         results.get('content_hashes', {}).get('success', True))
         
         processing_time = (time.time() - start_time) * 1000
         
@@ -303,7 +314,8 @@ def cleanup_dynamodb_tables_internal():
             'comparison_results_deleted': total_comparisons_deleted,
             'tables_cleaned': {
                 'indexed_documents': indexed_docs_result.get('success', False),
-                'comparison_results': comparison_results_result.get('success', False)
+                'comparison_results': comparison_results_result.get('success', False),
+                **({'content_hashes': results['content_hashes'].get('success', False)} if CONTENT_HASHES_TABLE else {})
             },
             'details': results,
             'processing_time_ms': int(processing_time)
@@ -326,7 +338,7 @@ def cleanup_table(table_name, partition_key, sort_key=None):
     🔧 FUNCIÓN CORREGIDA: Limpiar una tabla específica de DynamoDB
     """
     try:
-        table = dynamodb.Table(table_name)
+        table = get_resource('dynamodb').Table(table_name)
         
         # STEP 1: Contar elementos iniciales
         scan_response = table.scan(Select='COUNT')
@@ -439,9 +451,11 @@ def get_cleanup_status():
             }
         
         # STEP 2: Estado de las tablas DynamoDB
-        for table_name in [INDEXED_DOCUMENTS_TABLE, COMPARISON_RESULTS_TABLE]:
+        for table_name in [INDEXED_DOCUMENTS_TABLE, COMPARISON_RESULTS_TABLE, CONTENT_HASHES_TABLE]:
+            if not table_name:
+                continue
             try:
-                table = dynamodb.Table(table_name)
+                table = get_resource('dynamodb').Table(table_name)
                 scan_response = table.scan(Select='COUNT')
                 
                 status['dynamodb_tables'][table_name] = {
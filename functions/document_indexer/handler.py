@@ -1,16 +1,22 @@
 import json
-import boto3
 import logging
 import os
 import uuid
+import threading
+import time
 from datetime import datetime
+from urllib.parse import unquote_plus
 import sys
 from decimal import Decimal
 sys.path.append('/opt')
 
 # Imports locales (se empaquetan con la Lambda)
-from shared.image_processor import MinimalImageProcessor
-from shared.rekognition_client import RekognitionClient
+from shared.image_processor import MinimalImageProcessor, ImageProcessingPool
+from shared.rekognition_client import RekognitionClient, is_throttling_error, parse_tps_config
+from shared.concurrency import run_bounded
+from shared.aws_clients import LazyClient
+from shared.dynamodb_table import DynamoTable
+from shared.content_hashes import ContentHashIndex, content_hash
 
 # Setup logging
 logger = logging.getLogger()
@@ -20,14 +26,69 @@ logger.setLevel(logging.INFO)
 COLLECTION_ID = os.environ['COLLECTION_ID']
 INDEXED_DOCUMENTS_TABLE = os.environ['INDEXED_DOCUMENTS_TABLE']
 DOCUMENTS_BUCKET = os.environ['DOCUMENTS_BUCKET']
+INDEXING_MAX_WORKERS = int(os.environ.get('INDEXING_MAX_WORKERS', '8'))
+INDEXING_RUNS_TABLE = os.environ.get('INDEXING_RUNS_TABLE')
+# Margen antes del timeout para dejar de despachar documentos y guardar checkpoint
+INDEXING_CHECKPOINT_MARGIN_MS = int(os.environ.get('INDEXING_CHECKPOINT_MARGIN_SECONDS', '60')) * 1000
+MAX_FAILED_KEYS_IN_CHECKPOINT = 1000
+# Procesos para el preprocesado de imágenes (0 = en el mismo hilo que indexa)
+INDEXING_PREPROCESS_WORKERS = int(os.environ.get('INDEXING_PREPROCESS_WORKERS', '0'))
+# Pre-filtro local de calidad antes de llamar a Rekognition
+IMAGE_QUALITY_GATE = os.environ.get('IMAGE_QUALITY_GATE', 'true').lower() == 'true'
 
-s3_client = boto3.client('s3')
-dynamodb = boto3.resource('dynamodb')
-table = dynamodb.Table(INDEXED_DOCUMENTS_TABLE)
+# TPS por API de Rekognition ("5" o "CompareFaces=10,IndexFaces=5"; vacío = sin límite)
+REKOGNITION_TPS = parse_tps_config(os.environ.get('REKOGNITION_TPS', ''))
+# Margen antes del timeout de la Lambda en el que ya no se reintentan throttles
+REKOGNITION_DEADLINE_MARGIN_SECONDS = 5
+
+# Índice de hashes de contenido (sin tabla no se detectan duplicados por contenido)
+CONTENT_HASHES_TABLE = os.environ.get('CONTENT_HASHES_TABLE')
+# Bits distintos del dHash para reportar un documento como casi idéntico (máx. 3; -1 = desactivado).
+# Solo informativo: documentos de la misma plantilla de personas distintas dan distancias de 0-2 bits
+NEAR_DUPLICATE_MAX_DISTANCE = int(os.environ.get('NEAR_DUPLICATE_MAX_DISTANCE', '-1'))
+
+IMAGE_SUFFIXES = ('.jpg', '.jpeg', '.png')
+
+# Resultados que no indexan nada nuevo (se cuentan como omitidos)
+SKIPPED_STATUSES = ('ALREADY_INDEXED', 'DUPLICATE_CONTENT')
+
+# Derivados del indexador en su propio bucket (fuera de la notificación del de documentos)
+DERIVED_BUCKET = os.environ['DERIVED_BUCKET']
+NORMALIZED_PREFIX = 'normalized/'
+FACE_CROP_PREFIX = 'face_crop/'
+# Prefijo donde versiones anteriores guardaban los derivados en el bucket de
+# documentos (no son documentos a indexar)
+LEGACY_DERIVED_PREFIX = '_derived/'
+
+# Clients (se construyen en el primer uso para no pagarlos en el cold start)
+s3_client = LazyClient('s3')
+lambda_client = LazyClient('lambda')
+# Tablas sobre el cliente DynamoDB de bajo nivel (thread-safe, sin capa de resources)
+table = DynamoTable(INDEXED_DOCUMENTS_TABLE)
+runs_table = DynamoTable(INDEXING_RUNS_TABLE) if INDEXING_RUNS_TABLE else None
+content_index = ContentHashIndex(CONTENT_HASHES_TABLE) if CONTENT_HASHES_TABLE else None
 
 # Processors
-image_processor = MinimalImageProcessor()
-rekognition_client = RekognitionClient(COLLECTION_ID)
+image_processor = MinimalImageProcessor(int(os.environ.get('IMAGE_TARGET_DIMENSION', '4096')))
+rekognition_client = RekognitionClient(COLLECTION_ID, REKOGNITION_TPS)
+
+# Pool de preprocesado compartido por los hilos de indexación (se crea al primer uso)
+_preprocess_pool = None
+_preprocess_pool_lock = threading.Lock()
+
+def preprocess_document(image_bytes: bytes, s3_key: str) -> tuple:
+    """
+    Preprocesar un documento: con INDEXING_PREPROCESS_WORKERS > 0 el trabajo de
+    Pillow se envía a un pool de procesos mientras los hilos siguen con la E/S
+    """
+    global _preprocess_pool
+    if INDEXING_PREPROCESS_WORKERS <= 0:
+        return image_processor.process_image(image_bytes, s3_key)
+    
+    with _preprocess_pool_lock:
+        if _preprocess_pool is None:
+            _preprocess_pool = ImageProcessingPool(INDEXING_PREPROCESS_WORKERS, image_processor.TARGET_DIMENSION)
+    return _preprocess_pool.process_image(image_bytes, s3_key)
 
 def lambda_handler(event, context):
     """
@@ -37,28 +98,64 @@ def lambda_handler(event, context):
     1. {"action": "smart_index_all"} - Indexa todos, saltando duplicados
     2. {"action": "index_new_only"} - Solo documentos nuevos
     3. {"action": "index_all"} - Modo clásico (mantener compatibilidad)
+    4. {"action": "resume", "run_id": "run_..."} - Continuar una ejecución con checkpoint
+    5. {"action": "run_status", "run_id": "run_..."} - Estado de una ejecución
+       (sin run_id: lista las ejecuciones en curso)
+    6. Evento S3 OBJECT_CREATED del bucket de documentos - indexa solo las keys del evento
+
+    Opcionales para modos 1 y 2:
+    - "max_workers": limita la concurrencia (default INDEXING_MAX_WORKERS)
+    - "prefix" / "start_after": procesar solo un shard del bucket
+      ej: {"action": "smart_index_all", "prefix": "dni/", "start_after": "dni/m.jpg"}
     """
     
     logger.info(f"Received event: {json.dumps(event)}")
     
+    if context is not None:
+        rekognition_client.set_deadline(
+            time.time() + context.get_remaining_time_in_millis() / 1000 - REKOGNITION_DEADLINE_MARGIN_SECONDS
+        )
+    
     try:
+        # Evento S3: filtrar las keys antes de cualquier llamada a AWS
+        if 'Records' in event:
+            document_keys = s3_event_document_keys(event['Records'])
+            if not document_keys:
+                return create_response(message='No documents to index in S3 event', new_indexed=0, skipped=0, errors=0, results=[])
+        
         # Asegurar que la colección existe
         if not rekognition_client.create_collection_if_not_exists():
+            if 'Records' in event:
+                raise RuntimeError('Failed to create Rekognition collection')
             return {
                 'statusCode': 500,
                 'body': json.dumps({'error': 'Failed to create Rekognition collection'})
             }
         
+        # Evento S3: indexación incremental de los documentos recién subidos
+        if 'Records' in event:
+            return index_s3_event_documents(document_keys)
+        
         # Determinar modo de operación
         action = event.get('action', 'smart_index_all')  # Default inteligente
+        max_workers = int(event.get('max_workers', INDEXING_MAX_WORKERS))
+        prefix = event.get('prefix', '')
+        start_after = event.get('start_after')
         
         if action == 'smart_index_all' or action == 'index_all':
             # MODO 1: Indexar todos los documentos, saltando duplicados
-            return smart_index_all_documents()
+            return smart_index_all_documents(max_workers, prefix, start_after, context=context)
             
         elif action == 'index_new_only':
             # MODO 2: Solo documentos nuevos
-            return index_new_documents_only()
+            return index_new_documents_only(max_workers, prefix, start_after)
+            
+        elif action == 'resume':
+            # Continuar ejecución desde su checkpoint
+            return resume_indexing_run(event.get('run_id'), context)
+            
+        elif action == 'run_status':
+            return get_indexing_run_status(event.get('run_id'))
             
         elif 'documents' in event:
             # Indexar documentos específicos (mantener funcionalidad)
@@ -69,90 +166,127 @@ def lambda_handler(event, context):
                 'statusCode': 400,
                 'body': json.dumps({
                     'error': 'Invalid event format',
-                    'supported_actions': ['smart_index_all', 'index_new_only'],
+                    'supported_actions': ['smart_index_all', 'index_new_only', 'resume', 'run_status'],
                     'example': '{"action": "smart_index_all"}'
                 })
             }
             
     except Exception as e:
         logger.error(f"Unhandled error: {str(e)}")
+        # Evento S3 (invocación asíncrona): la invocación debe fallar para que Lambda
+        # la reintente y, agotados los reintentos, la envíe a la DLQ del indexador
+        if 'Records' in event:
+            raise
         return {
             'statusCode': 500,
             'body': json.dumps({'error': f'Internal error: {str(e)}'})
         }
+    finally:
+        # Contadores acumulados del contenedor: llamadas, throttles y reintentos
+        logger.info(f"📊 Rekognition stats: {rekognition_client.get_stats()}")
 
-def smart_index_all_documents():
+def smart_index_all_documents(max_workers: int = INDEXING_MAX_WORKERS, prefix: str = '', start_after: str = None,
+                              context=None, run: dict = None):
     """
     MODO 1: Indexar todos los documentos, pero saltando duplicados
+    
+    Cuando queda menos de INDEXING_CHECKPOINT_MARGIN_SECONDS de ejecución se
+    deja de despachar documentos, se guarda un checkpoint de la ejecución
+    (posición en el listado, contadores y documentos fallidos) y la Lambda se
+    re-invoca de forma asíncrona con {"action": "resume", "run_id": ...}
     """
-    logger.info("🔄 SMART INDEX ALL: Processing all documents, skipping duplicates")
+    resuming = run is not None
+    if not resuming:
+        run = new_indexing_run('smart_index_all', prefix, start_after, max_workers)
+    
+    logger.info(f"🔄 SMART INDEX ALL: Processing all documents, skipping duplicates (run {run['run_id']})")
     
     try:
         # 1. Obtener documentos ya indexados
-        existing_docs = get_already_indexed_documents()
-        existing_s3_keys = {doc['s3_key'] for doc in existing_docs}
+        if resuming:
+            # Al continuar no se repite el scan: cada documento se verifica
+            # contra s3-key-index en index_single_document
+            existing_s3_keys = set()
+            logger.info(f"▶️  RESUMING run {run['run_id']} after {run.get('last_key')}")
+        else:
+            existing_docs = get_already_indexed_documents()
+            existing_s3_keys = {doc['s3_key'] for doc in existing_docs}
+            
+            logger.info(f"Found {len(existing_docs)} already indexed documents")
+        
+        # 2. Listar el bucket página a página y 3. procesar cada imagen
+        #    a medida que llega (los nuevos se indexan en paralelo)
+        results = []
+        skipped_count = 0
+        listing_stats = {}
+        previous_last_key = run.get('last_key')
         
-        logger.info(f"Found {len(existing_docs)} already indexed documents")
+        def documents_to_index():
+            nonlocal skipped_count
+            for s3_key in iter_document_keys(prefix, previous_last_key or start_after, listing_stats,
+                                             continuation_token=run.get('continuation_token')):
+                # ✅ VERIFICAR SI YA FUE INDEXADO
+                if s3_key in existing_s3_keys:
+                    logger.info(f"⏭️  SKIPPING already indexed: {s3_key}")
+                    results.append({
+                        'document': s3_key,
+                        'status': 'SKIPPED_DUPLICATE',
+                        'message': 'Already indexed'
+                    })
+                    skipped_count += 1
+                    continue
+                
+                # 🆕 PROCESAR DOCUMENTO NUEVO (reservar su posición en results)
+                logger.info(f"🆕 INDEXING NEW document: {s3_key}")
+                results.append(None)
+                yield len(results) - 1, s3_key
+        
+        def deadline_reached() -> bool:
+            return context is not None and context.get_remaining_time_in_millis() < INDEXING_CHECKPOINT_MARGIN_MS
         
-        # 2. Listar todos los archivos en el bucket
-        response = s3_client.list_objects_v2(Bucket=DOCUMENTS_BUCKET)
+        new_indexed_count, already_indexed, error_count = index_documents_concurrently(
+            documents_to_index(), results, max_workers, should_stop=deadline_reached
+        )
+        # Documentos detectados como ya indexados (o duplicados) por la verificación final
+        skipped_count += already_indexed
         
-        if 'Contents' not in response:
+        if not resuming and listing_stats.get('objects_listed', 0) == 0:
             return create_response(
                 message='No documents found in bucket',
                 new_indexed=0, skipped=0, errors=0
             )
         
-        # 3. Procesar cada archivo
-        results = []
-        new_indexed_count = 0
-        skipped_count = 0
-        error_count = 0
+        # 4. Actualizar la ejecución (checkpoint o cierre)
+        run['new_indexed'] += new_indexed_count
+        run['skipped'] += skipped_count
+        run['errors'] += error_count
+        run['failed_keys'] = (run['failed_keys'] + [
+            r['document'] for r in results if r and r.get('success') is False
+        ])[:MAX_FAILED_KEYS_IN_CHECKPOINT]
+        run['continuation_token'] = listing_stats.get('page_token')
+        run['last_key'] = listing_stats.get('last_key', previous_last_key)
         
-        for obj in response['Contents']:
-            s3_key = obj['Key']
-            
-            # Solo procesar imágenes
-            if not s3_key.lower().endswith(('.jpg', '.jpeg', '.png')):
-                continue
-            
-            # ✅ VERIFICAR SI YA FUE INDEXADO
-            if s3_key in existing_s3_keys:
-                logger.info(f"⏭️  SKIPPING already indexed: {s3_key}")
-                results.append({
-                    'document': s3_key,
-                    'status': 'SKIPPED_DUPLICATE',
-                    'message': 'Already indexed'
-                })
-                skipped_count += 1
-                continue
-            
-            # 🆕 PROCESAR DOCUMENTO NUEVO
-            logger.info(f"🆕 INDEXING NEW document: {s3_key}")
-            
-            try:
-                result = index_single_document(s3_key)
-                results.append(result)
-                
-                if result['success']:
-                    new_indexed_count += 1
-                else:
-                    error_count += 1
-                    
-            except Exception as e:
-                logger.error(f"Error processing {s3_key}: {str(e)}")
-                results.append({
-                    'document': s3_key,
-                    'success': False,
-                    'error': str(e)
-                })
-                error_count += 1
+        if listing_stats.get('exhausted'):
+            run['status'] = 'COMPLETED'
+            message = 'Smart indexing completed'
+        elif run['last_key'] == previous_last_key:
+            # Ningún documento avanzó en esta invocación: evitar un bucle de re-invocaciones
+            run['status'] = 'FAILED'
+            message = 'Smart indexing stopped: no progress before checkpoint deadline'
+        else:
+            run['status'] = 'IN_PROGRESS'
+            message = 'Smart indexing checkpointed, continuing in a new invocation'
+        
+        if save_indexing_run(run) and run['status'] == 'IN_PROGRESS':
+            continue_indexing_run_async(run, context)
         
         return create_response(
-            message=f'Smart indexing completed',
-            new_indexed=new_indexed_count,
-            skipped=skipped_count, 
-            errors=error_count,
+            message=message,
+            run_id=run['run_id'],
+            run_status=run['status'],
+            new_indexed=run['new_indexed'],
+            skipped=run['skipped'], 
+            errors=run['errors'],
             results=results
         )
         
@@ -163,7 +297,7 @@ def smart_index_all_documents():
             'body': json.dumps({'error': f'Smart indexing failed: {str(e)}'})
         }
 
-def index_new_documents_only():
+def index_new_documents_only(max_workers: int = INDEXING_MAX_WORKERS, prefix: str = '', start_after: str = None):
     """
     MODO 2: Indexar SOLO documentos nuevos (no duplicar NADA)
     """
@@ -174,65 +308,49 @@ def index_new_documents_only():
         existing_docs = get_already_indexed_documents()
         existing_s3_keys = {doc['s3_key'] for doc in existing_docs}
         
-        # 2. Obtener TODOS los archivos en S3
-        response = s3_client.list_objects_v2(Bucket=DOCUMENTS_BUCKET)
+        # 2. Recorrer TODOS los archivos en S3 página a página y
+        # 3. enviar a indexar solo los documentos completamente nuevos
+        results = []
+        total_in_bucket = 0
+        listing_stats = {}
+        
+        def new_documents():
+            nonlocal total_in_bucket
+            for s3_key in iter_document_keys(prefix, start_after, listing_stats):
+                total_in_bucket += 1
+                if s3_key in existing_s3_keys:
+                    continue
+                logger.info(f"🆕 Indexing NEW document: {s3_key}")
+                results.append(None)
+                yield len(results) - 1, s3_key
+        
+        # 4. Indexar solo documentos nuevos
+        success_count, skipped_count, error_count = index_documents_concurrently(
+            new_documents(), results, max_workers
+        )
         
-        if 'Contents' not in response:
+        if listing_stats['objects_listed'] == 0:
             return create_response(
                 message='No documents found in bucket',
                 new_indexed=0, total_existing=len(existing_s3_keys)
             )
         
-        # 3. Identificar documentos completamente nuevos
-        new_documents = []
-        for obj in response['Contents']:
-            s3_key = obj['Key']
-            
-            if (s3_key.lower().endswith(('.jpg', '.jpeg', '.png')) and 
-                s3_key not in existing_s3_keys):
-                new_documents.append(s3_key)
-        
-        if not new_documents:
+        if not results:
             return create_response(
                 message='No new documents to index',
                 new_indexed=0,
                 total_existing=len(existing_s3_keys),
-                total_in_bucket=len([obj for obj in response['Contents'] 
-                                   if obj['Key'].lower().endswith(('.jpg', '.jpeg', '.png'))])
+                total_in_bucket=total_in_bucket
             )
         
-        # 4. Indexar solo documentos nuevos
-        logger.info(f"Found {len(new_documents)} new documents to index")
-        
-        results = []
-        success_count = 0
-        error_count = 0
-        
-        for s3_key in new_documents:
-            try:
-                logger.info(f"🆕 Indexing NEW document: {s3_key}")
-                result = index_single_document(s3_key)
-                results.append(result)
-                
-                if result['success']:
-                    success_count += 1
-                else:
-                    error_count += 1
-                    
-            except Exception as e:
-                logger.error(f"Error indexing new document {s3_key}: {str(e)}")
-                results.append({
-                    'document': s3_key,
-                    'success': False,
-                    'error': str(e)
-                })
-                error_count += 1
+        logger.info(f"Found {len(results)} new documents to index")
         
         return create_response(
             message=f'New documents indexing completed',
             new_indexed=success_count,
+            skipped=skipped_count,
             errors=error_count,
-            total_new_found=len(new_documents),
+            total_new_found=len(results),
             results=results
         )
         
@@ -243,13 +361,117 @@ def index_new_documents_only():
             'body': json.dumps({'error': f'Failed to index new documents: {str(e)}'})
         }
 
+def iter_document_keys(prefix: str = '', start_after: str = None, stats: dict = None,
+                       continuation_token: str = None):
+    """
+    Listar el bucket de documentos página a página (list_objects_v2 devuelve
+    máximo 1000 keys por llamada), devolviendo solo imágenes y sin construir
+    la lista completa en memoria.
+    
+    continuation_token: retomar desde una página guardada en un checkpoint;
+    en ese caso se descartan las keys <= start_after dentro de la página
+    
+    stats (opcional) se actualiza con 'pages', 'objects_listed', 'page_token'
+    (token de la página en curso), 'last_key' (última key entregada) y
+    'exhausted' (True al terminar el listado)
+    """
+    params = {'Bucket': DOCUMENTS_BUCKET}
+    if prefix:
+        params['Prefix'] = prefix
+    if continuation_token:
+        params['ContinuationToken'] = continuation_token
+    elif start_after:
+        params['StartAfter'] = start_after
+    
+    stats = stats if stats is not None else {}
+    stats.setdefault('pages', 0)
+    stats.setdefault('objects_listed', 0)
+    stats['exhausted'] = False
+    
+    while True:
+        stats['page_token'] = params.get('ContinuationToken')
+        response = s3_client.list_objects_v2(**params)
+        contents = response.get('Contents', [])
+        stats['pages'] += 1
+        stats['objects_listed'] += len(contents)
+        
+        for obj in contents:
+            s3_key = obj['Key']
+            if continuation_token and start_after and s3_key <= start_after:
+                continue
+            if s3_key.lower().endswith(IMAGE_SUFFIXES) and not s3_key.startswith(LEGACY_DERIVED_PREFIX):
+                stats['last_key'] = s3_key
+                yield s3_key
+        
+        if not response.get('IsTruncated'):
+            stats['exhausted'] = True
+            break
+        params['ContinuationToken'] = response['NextContinuationToken']
+
+def index_documents_concurrently(positioned_keys, results: list, max_workers: int = INDEXING_MAX_WORKERS,
+                                 should_stop=None) -> tuple:
+    """
+    Motor de indexación concurrente: S3 GET, preprocessing y llamadas a
+    Rekognition se solapan en un pool acotado de hilos que se reduce solo
+    ante throttling. Cada resultado se guarda en su posición de `results`
+    para mantener el mismo orden que el procesamiento secuencial.
+    
+    positioned_keys: iterable de (posición en results, s3_key)
+    should_stop: callable opcional para dejar de despachar (deadline)
+    Retorna (indexados_ok, omitidos, errores); los omitidos (SKIPPED_STATUSES)
+    terminan bien pero no indexan nada nuevo
+    """
+    success_count = 0
+    skipped_count = 0
+    error_count = 0
+    
+    for _, (position, s3_key), result in run_bounded(
+        positioned_keys,
+        lambda item: index_document_safely(item[1]),
+        max_workers=max(1, max_workers),
+        is_throttled=is_throttled_result,
+        should_stop=should_stop
+    ):
+        results[position] = result
+        if not result['success']:
+            error_count += 1
+        elif result.get('status') in SKIPPED_STATUSES:
+            skipped_count += 1
+        else:
+            success_count += 1
+    
+    return success_count, skipped_count, error_count
+
+def index_document_safely(s3_key: str) -> dict:
+    """
+    Indexar un documento sin propagar excepciones al pool
+    """
+    try:
+        return index_single_document(s3_key)
+    except Exception as e:
+        logger.error(f"Error processing {s3_key}: {str(e)}")
+        return {
+            'document': s3_key,
+            'success': False,
+            'error': str(e)
+        }
+
+def is_throttled_result(result: dict) -> bool:
+    return not result.get('success') and is_throttling_error(result.get('error', ''))
+
 def get_already_indexed_documents():
     """
-    Obtener lista de documentos ya indexados desde DynamoDB
+    Obtener lista de documentos ya indexados desde DynamoDB (todas las páginas)
     """
     try:
-        response = table.scan()
-        return response['Items']
+        params = {'ProjectionExpression': 's3_key'}
+        items = []
+        while True:
+            response = table.scan(**params)
+            items.extend(response['Items'])
+            if 'LastEvaluatedKey' not in response:
+                return items
+            params['ExclusiveStartKey'] = response['LastEvaluatedKey']
     except Exception as e:
         logger.error(f"Error getting indexed documents: {str(e)}")
         return []
@@ -276,33 +498,57 @@ def index_single_document(s3_key: str) -> dict:
         
         logger.info(f"Downloaded {s3_key}: {len(image_bytes)} bytes")
         
+        # STEP 1b: Mismos bytes ya indexados bajo otra key (sin llamar a Rekognition)
+        document_hash = content_hash(image_bytes)
+        duplicate = find_duplicate_by_content(document_hash)
+        if duplicate:
+            return register_duplicate(s3_key, duplicate, 'DUPLICATE_CONTENT', document_hash)
+        
         # STEP 2: Preprocessing
-        processed_bytes, error = image_processor.process_image(image_bytes, s3_key)
+        processed_bytes, error = preprocess_document(image_bytes, s3_key)
         if error:
             return {'document': s3_key, 'success': False, 'error': f'Preprocessing failed: {error}'}
         
-        # STEP 3: Detectar caras
-        face_detection = rekognition_client.detect_faces(processed_bytes)
-        if not face_detection['success']:
-            return {'document': s3_key, 'success': False, 'error': f'Face detection failed: {face_detection["error"]}'}
+        # STEP 2a: Casi idéntico a uno indexado (solo se reporta, se indexa igual:
+        #          el dHash no distingue documentos de la misma plantilla)
+        perceptual_hash = compute_perceptual_hash(processed_bytes, s3_key)
+        near_duplicate = find_near_duplicate(perceptual_hash)
+        if near_duplicate:
+            logger.info(f"🔎 NEAR_DUPLICATE: {s3_key} looks like {near_duplicate['s3_key']} "
+                        f"({near_duplicate['document_id']}, distance {near_duplicate['distance']}), indexing anyway")
         
-        if face_detection['face_count'] == 0:
-            return {'document': s3_key, 'success': False, 'error': 'No faces detected in document'}
-        
-        if face_detection['face_count'] > 1:
-            logger.warning(f"Multiple faces detected in {s3_key}, using first face")
+        # STEP 2b: Pre-filtro de calidad (sin coste de Rekognition)
+        quality = assess_document_quality(processed_bytes, s3_key)
+        if quality and not quality['passed']:
+            return {
+                'document': s3_key,
+                'success': False,
+                'error': f'Image quality check failed: {"; ".join(quality["reasons"])}',
+                'quality': quality
+            }
         
-        # STEP 4: Generar ID único
+        # STEP 3: Generar ID único
         document_id = generate_document_id(s3_key)
         
-        # STEP 5: ⚡ TRANSACCIÓN ATÓMICA
+        # STEP 4: ⚡ TRANSACCIÓN ATÓMICA
         try:
-            # 5a. Indexar en Rekognition
+            # 4a. Detectar e indexar en una sola llamada (IndexFaces reporta las
+            #     caras no indexadas, no hace falta DetectFaces antes)
             index_result = rekognition_client.index_face(processed_bytes, document_id)
             if not index_result['success']:
+                if index_result.get('error_type') == 'NO_FACE_DETECTED':
+                    return {'document': s3_key, 'success': False, 'error': 'No faces detected in document'}
                 return {'document': s3_key, 'success': False, 'error': f'Rekognition indexing failed: {index_result["error"]}'}
             
-            # 5b. Guardar metadata INMEDIATAMENTE
+            if index_result['face_count'] > 1:
+                logger.warning(f"Multiple faces detected in {s3_key}, using largest face")
+            
+            # 4b. Guardar derivados para el validador (no crítico):
+            #     documento normalizado y recorte de la cara indexada
+            normalized_key = store_normalized_document(document_id, processed_bytes)
+            face_crop_key = store_face_crop(document_id, processed_bytes, index_result['bounding_box'])
+            
+            # 4c. Guardar metadata INMEDIATAMENTE
             person_name = extract_person_name(s3_key)
             
             metadata = {
@@ -316,12 +562,26 @@ def index_single_document(s3_key: str) -> dict:
                 'face_bounding_box': json.dumps(index_result['bounding_box']),
                 'processing_status': 'INDEXED_SUCCESSFULLY'
             }
+            if normalized_key:
+                metadata['normalized_key'] = normalized_key
+            if face_crop_key:
+                metadata['face_crop_key'] = face_crop_key
+            if quality:
+                metadata['quality_scores'] = json.dumps({k: v for k, v in quality.items() if k not in ('passed', 'reasons')})
+            metadata['content_hash'] = document_hash
+            if perceptual_hash:
+                metadata['perceptual_hash'] = perceptual_hash
+            if near_duplicate:
+                metadata['near_duplicate_of'] = near_duplicate['document_id']
             
             table.put_item(Item=metadata)
             
+            # 4d. Registrar hashes para detectar futuros duplicados (no crítico)
+            register_document_hashes(document_id, s3_key, document_hash, perceptual_hash)
+            
             logger.info(f"✅ Successfully indexed {s3_key} → {document_id}")
             
-            return {
+            result = {
                 'document': s3_key,
                 'success': True,
                 'status': 'NEWLY_INDEXED',
@@ -330,6 +590,10 @@ def index_single_document(s3_key: str) -> dict:
                 'person_name': person_name,
                 'confidence': index_result['confidence']
             }
+            if near_duplicate:
+                result['near_duplicate_of'] = near_duplicate['document_id']
+                result['perceptual_distance'] = near_duplicate['distance']
+            return result
             
         except Exception as metadata_error:
             # 🛡️ ROLLBACK: Eliminar cara de Rekognition si falló metadata
@@ -342,6 +606,9 @@ def index_single_document(s3_key: str) -> dict:
                         FaceIds=[index_result['face_id']]
                     )
                     logger.info(f"Rolled back face {index_result['face_id']} from Rekognition")
+                for derived_key in (locals().get('normalized_key'), locals().get('face_crop_key')):
+                    if derived_key:
+                        s3_client.delete_object(Bucket=DERIVED_BUCKET, Key=derived_key)
             except Exception as rollback_error:
                 logger.error(f"CRITICAL: Rollback failed: {rollback_error}")
             
@@ -351,14 +618,142 @@ def index_single_document(s3_key: str) -> dict:
         logger.error(f"Error indexing {s3_key}: {str(e)}")
         return {'document': s3_key, 'success': False, 'error': str(e)}
 
+def assess_document_quality(processed_bytes: bytes, s3_key: str) -> dict:
+    """Scores de calidad del documento (None si el pre-filtro está desactivado o falla)"""
+    if not IMAGE_QUALITY_GATE:
+        return None
+    try:
+        # Sin límites de exposición: los escaneos sobre fondo blanco son válidos
+        return image_processor.assess_quality(processed_bytes, check_exposure=False)
+    except Exception as e:
+        logger.warning(f"Quality check skipped for {s3_key}: {str(e)}")
+        return None
+
+def store_normalized_document(document_id: str, processed_bytes: bytes) -> str:
+    """
+    Guardar la salida de process_image (JPEG normalizado, máx. 4096px) como
+    derivado para que el validador no tenga que re-descargar ni re-procesar
+    el original. La key incluye el document_id, así que es inmutable.
+    """
+    normalized_key = f'{NORMALIZED_PREFIX}{document_id}.jpg'
+    try:
+        s3_client.put_object(
+            Bucket=DERIVED_BUCKET,
+            Key=normalized_key,
+            Body=processed_bytes,
+            ContentType='image/jpeg'
+        )
+        return normalized_key
+    except Exception as e:
+        logger.warning(f"Could not store normalized derivative for {document_id}: {str(e)}")
+        return None
+
+def store_face_crop(document_id: str, processed_bytes: bytes, bounding_box: dict) -> str:
+    """
+    Guardar un recorte con margen de la cara indexada: CompareFaces recibe
+    unos pocos KB en lugar del documento completo
+    """
+    crop_bytes, error = image_processor.crop_face(processed_bytes, bounding_box, document_id)
+    if error:
+        logger.warning(f"Could not crop face for {document_id}: {error}")
+        return None
+    
+    face_crop_key = f'{FACE_CROP_PREFIX}{document_id}.jpg'
+    try:
+        s3_client.put_object(
+            Bucket=DERIVED_BUCKET,
+            Key=face_crop_key,
+            Body=crop_bytes,
+            ContentType='image/jpeg'
+        )
+        return face_crop_key
+    except Exception as e:
+        logger.warning(f"Could not store face crop for {document_id}: {str(e)}")
+        return None
+
+def compute_perceptual_hash(processed_bytes: bytes, s3_key: str) -> str:
+    """dHash del documento normalizado (None sin índice de hashes o si falla)"""
+    if not content_index:
+        return None
+    try:
+        return image_processor.perceptual_hash(processed_bytes)
+    except Exception as e:
+        logger.warning(f"Perceptual hash skipped for {s3_key}: {str(e)}")
+        return None
+
+def find_duplicate_by_content(document_hash: str) -> dict:
+    """Entrada del índice de hashes con los mismos bytes exactos (o None)"""
+    if not content_index:
+        return None
+    try:
+        return content_index.find_document_by_content(document_hash)
+    except Exception as e:
+        logger.warning(f"Content hash lookup failed: {str(e)}")
+        return None
+
+def find_near_duplicate(perceptual_hash: str) -> dict:
+    """Entrada del documento casi idéntico más cercano (o None)"""
+    if not content_index or not perceptual_hash or NEAR_DUPLICATE_MAX_DISTANCE < 0:
+        return None
+    try:
+        return content_index.find_similar_document(perceptual_hash, NEAR_DUPLICATE_MAX_DISTANCE)
+    except Exception as e:
+        logger.warning(f"Perceptual hash lookup failed: {str(e)}")
+        return None
+
+def register_document_hashes(document_id: str, s3_key: str, document_hash: str, perceptual_hash: str):
+    if not content_index:
+        return
+    try:
+        content_index.register_document(document_id, s3_key, document_hash, perceptual_hash)
+    except Exception as e:
+        logger.warning(f"Could not register content hashes for {document_id}: {str(e)}")
+
+def register_duplicate(s3_key: str, duplicate: dict, status: str, document_hash: str) -> dict:
+    """
+    Registrar la key como alias del documento ya indexado: no se añade otra
+    cara a la colección, pero la key queda en s3-key-index (las siguientes
+    pasadas la omiten sin descargarla). No se copian los derivados del
+    original: el validador usa los bytes de la propia key
+    """
+    original_id = duplicate['document_id']
+    logger.info(f"♻️  {status}: {s3_key} duplicates {duplicate['s3_key']} ({original_id})")
+    
+    document_id = generate_document_id(s3_key)
+    metadata = {
+        'document_id': document_id,
+        's3_key': s3_key,
+        'person_name': extract_person_name(s3_key),
+        'document_type': detect_document_type(s3_key),
+        'index_timestamp': datetime.utcnow().isoformat(),
+        'processing_status': status,
+        'duplicate_of': original_id,
+        'content_hash': document_hash
+    }
+    try:
+        table.put_item(Item=metadata)
+    except Exception as e:
+        return {'document': s3_key, 'success': False, 'error': f'Could not register duplicate: {str(e)}'}
+    
+    return {
+        'document': s3_key,
+        'success': True,
+        'status': status,
+        'document_id': document_id,
+        'duplicate_of': original_id,
+        'message': f'Duplicate of {duplicate["s3_key"]}, skipped'
+    }
+
 def check_document_already_indexed(s3_key: str) -> dict:
     """
-    Verificar si un documento ya fue indexado
+    Verificar si un documento ya fue indexado (query sobre s3-key-index)
     """
     try:
-        response = table.scan(
-            FilterExpression='s3_key = :key',
-            ExpressionAttributeValues={':key': s3_key}
+        response = table.query(
+            IndexName='s3-key-index',
+            KeyConditionExpression='s3_key = :key',
+            ExpressionAttributeValues={':key': s3_key},
+            Limit=1
         )
         
         if response['Items']:
@@ -369,6 +764,139 @@ def check_document_already_indexed(s3_key: str) -> dict:
         logger.error(f"Error checking document {s3_key}: {str(e)}")
         return None
 
+def new_indexing_run(action: str, prefix: str, start_after: str, max_workers: int) -> dict:
+    """
+    Estado inicial de una ejecución de indexación con checkpoint
+    """
+    timestamp = datetime.utcnow()
+    return {
+        'run_id': f"run_{timestamp.strftime('%Y%m%d_%H%M%S')}_{str(uuid.uuid4())[:8]}",
+        'action': action,
+        'status': 'IN_PROGRESS',
+        'prefix': prefix or '',
+        'start_after': start_after,
+        'max_workers': max_workers,
+        'continuation_token': None,
+        'last_key': None,
+        'new_indexed': 0,
+        'skipped': 0,
+        'errors': 0,
+        'failed_keys': [],
+        'invocations': 1,
+        'started_at': timestamp.isoformat()
+    }
+
+def save_indexing_run(run: dict) -> bool:
+    """
+    Guardar checkpoint de la ejecución (expira a los 30 días)
+    """
+    if runs_table is None:
+        logger.warning("INDEXING_RUNS_TABLE not configured, checkpoint not saved")
+        return False
+    run['updated_at'] = datetime.utcnow().isoformat()
+    run['ttl'] = int(time.time()) + (30 * 24 * 60 * 60)
+    runs_table.put_item(Item={k: v for k, v in run.items() if v is not None})
+    return True
+
+def get_indexing_run(run_id: str) -> dict:
+    """
+    Leer una ejecución y normalizar los números de DynamoDB (Decimal → int)
+    """
+    response = runs_table.get_item(Key={'run_id': run_id})
+    run = response.get('Item')
+    return normalize_indexing_run(run) if run else None
+
+def normalize_indexing_run(run: dict) -> dict:
+    for field in ('max_workers', 'new_indexed', 'skipped', 'errors', 'invocations', 'ttl'):
+        if field in run:
+            run[field] = int(run[field])
+    run.setdefault('continuation_token', None)
+    run.setdefault('last_key', None)
+    run.setdefault('start_after', None)
+    run.setdefault('failed_keys', [])
+    return run
+
+def continue_indexing_run_async(run: dict, context):
+    """
+    Re-invocar esta misma Lambda (asíncrono) para continuar la ejecución
+    """
+    if context is None:
+        logger.warning(f"No Lambda context, run {run['run_id']} must be resumed manually")
+        return
+    lambda_client.invoke(
+        FunctionName=context.invoked_function_arn,
+        InvocationType='Event',
+        Payload=json.dumps({'action': 'resume', 'run_id': run['run_id']})
+    )
+    logger.info(f"⏩ Run {run['run_id']} checkpointed at {run['last_key']}, re-invoked asynchronously")
+
+def resume_indexing_run(run_id: str, context):
+    """
+    Continuar una ejecución desde su último checkpoint
+    """
+    if not run_id or runs_table is None:
+        return {
+            'statusCode': 400,
+            'body': json.dumps({
+                'error': 'resume requires run_id and a configured INDEXING_RUNS_TABLE',
+                'example': '{"action": "resume", "run_id": "run_20250618_143022_a1b2c3d4"}'
+            })
+        }
+    
+    run = get_indexing_run(run_id)
+    if not run:
+        return {
+            'statusCode': 404,
+            'body': json.dumps({'error': f'Run not found: {run_id}'})
+        }
+    if run['status'] != 'IN_PROGRESS':
+        return {
+            'statusCode': 409,
+            'body': json.dumps({'error': f'Run {run_id} is {run["status"]}, nothing to resume'})
+        }
+    
+    run['invocations'] += 1
+    return smart_index_all_documents(
+        run['max_workers'], run['prefix'], run['start_after'], context=context, run=run
+    )
+
+def get_indexing_run_status(run_id: str = None):
+    """
+    Estado de una ejecución, o de todas las ejecuciones en curso si no hay run_id
+    """
+    if runs_table is None:
+        return {
+            'statusCode': 400,
+            'body': json.dumps({'error': 'INDEXING_RUNS_TABLE not configured'})
+        }
+    
+    if run_id:
+        run = get_indexing_run(run_id)
+        if not run:
+            return {
+                'statusCode': 404,
+                'body': json.dumps({'error': f'Run not found: {run_id}'})
+            }
+        return {'statusCode': 200, 'body': json.dumps(run)}
+    
+    params = {
+        'FilterExpression': '#status = :status',
+        'ExpressionAttributeNames': {'#status': 'status'},
+        'ExpressionAttributeValues': {':status': 'IN_PROGRESS'}
+    }
+    in_progress = []
+    while True:
+        response = runs_table.scan(**params)
+        in_progress.extend(normalize_indexing_run(item) for item in response['Items'])
+        if 'LastEvaluatedKey' not in response:
+            break
+        params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    
+    return {
+        'statusCode': 200,
+        'body': json.dumps({'in_progress_runs': in_progress, 'count': len(in_progress)})
+    }
+
 def create_response(message, **kwargs):
     """
     Crear respuesta estandarizada
@@ -411,18 +939,66 @@ def detect_document_type(s3_key: str) -> str:
     else:
         return 'DOCUMENT'
 
+def s3_event_document_keys(records: list) -> list:
+    """
+    Keys de documentos a indexar en un lote de eventos S3 OBJECT_CREATED
+    (sin derivados ni keys repetidas)
+    """
+    document_keys = []
+    for record in records:
+        if record.get('eventSource') != 'aws:s3':
+            continue
+        if record['s3']['bucket']['name'] != DOCUMENTS_BUCKET:
+            logger.warning(f"Ignoring event from unexpected bucket: {record['s3']['bucket']['name']}")
+            continue
+        
+        # Las keys llegan URL-encoded en las notificaciones S3
+        s3_key = unquote_plus(record['s3']['object']['key'])
+        if s3_key.startswith(LEGACY_DERIVED_PREFIX):
+            continue
+        if s3_key.lower().endswith(IMAGE_SUFFIXES) and s3_key not in document_keys:
+            document_keys.append(s3_key)
+    return document_keys
+
+def index_s3_event_documents(document_keys: list):
+    """
+    Indexar exactamente los documentos de un lote de eventos S3 OBJECT_CREATED
+    (sin listar el bucket ni escanear la tabla). Si algún documento falla se
+    lanza excepción: Lambda reintenta el evento (los ya indexados se omiten
+    como ALREADY_INDEXED) y, agotados los reintentos, lo envía a la DLQ
+    """
+    logger.info(f"📥 S3 EVENT: {len(document_keys)} new documents to index")
+    
+    results = [None] * len(document_keys)
+    success_count, skipped_count, error_count = index_documents_concurrently(enumerate(document_keys), results)
+    
+    if error_count:
+        failed = [f"{result['document']}: {result.get('error')}" for result in results if result and not result['success']]
+        raise RuntimeError(f"{error_count} of {len(document_keys)} documents failed to index: {'; '.join(failed)}")
+    
+    return create_response(
+        message='Indexed documents from S3 event',
+        new_indexed=success_count,
+        skipped=skipped_count,
+        errors=error_count,
+        results=results
+    )
+
 def index_specific_documents(document_list: list):
     """
     Indexar documentos específicos (mantener funcionalidad existente)
     """
     results = []
     success_count = 0
+    skipped_count = 0
     
     for s3_key in document_list:
         try:
             result = index_single_document(s3_key)
             results.append(result)
-            if result['success']:
+            if result['success'] and result.get('status') in SKIPPED_STATUSES:
+                skipped_count += 1
+            elif result['success']:
                 success_count += 1
         except Exception as e:
             results.append({'document': s3_key, 'success': False, 'error': str(e)})
@@ -430,5 +1006,6 @@ def index_specific_documents(document_list: list):
     return create_response(
         message=f'Processed {len(document_list)} specific documents',
         new_indexed=success_count,
+        skipped=skipped_count,
         results=results
     )
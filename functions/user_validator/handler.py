@@ -1,9 +1,14 @@
+import functools
 import json
-import boto3
 import logging
+import math
 import os
+import threading
 import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
 from datetime import datetime
+from urllib.parse import unquote_plus
 import time
 import sys
 from decimal import Decimal
@@ -11,7 +16,13 @@ sys.path.append('/opt')
 
 # Imports locales
 from shared.image_processor import MinimalImageProcessor
-from shared.rekognition_client import RekognitionClient
+from shared.rekognition_client import RekognitionClient, is_throttling_error, parse_tps_config
+from shared.concurrency import run_bounded
+from shared.byte_cache import LRUByteCache
+from shared.aws_clients import LazyClient
+from shared.dynamodb_table import DynamoTable, BATCH_WRITE_MAX_ITEMS
+from shared.result_cache import ValidationResultCache
+from shared.result_sink import ResultSink
 
 # Setup logging
 logger = logging.getLogger()
@@ -22,20 +33,108 @@ COLLECTION_ID = os.environ['COLLECTION_ID']
 COMPARISON_RESULTS_TABLE = os.environ['COMPARISON_RESULTS_TABLE']
 INDEXED_DOCUMENTS_TABLE = os.environ['INDEXED_DOCUMENTS_TABLE']
 DOCUMENTS_BUCKET = os.environ['DOCUMENTS_BUCKET']
+DERIVED_BUCKET = os.environ.get('DERIVED_BUCKET', DOCUMENTS_BUCKET)
+# Prefijo donde versiones anteriores del indexador dejaban los derivados (bucket de documentos)
+LEGACY_DERIVED_PREFIX = '_derived/'
 
 # NEW: Validation mode configuration
 VALIDATION_MODE = os.environ.get('VALIDATION_MODE', 'HYBRID')
 DIRECT_COMPARE_THRESHOLD = float(os.environ.get('DIRECT_COMPARE_THRESHOLD', '80.0'))
+HYBRID_SEARCH_THRESHOLD = 75
 
-# Clients
-s3_client = boto3.client('s3')
-dynamodb = boto3.resource('dynamodb')
-results_table = dynamodb.Table(COMPARISON_RESULTS_TABLE)
-documents_table = dynamodb.Table(INDEXED_DOCUMENTS_TABLE)
+# Mensajes SQS procesados en paralelo dentro de un mismo lote
+VALIDATION_MAX_WORKERS = int(os.environ.get('VALIDATION_MAX_WORKERS', '5'))
+
+# Documentos por invocación de DIRECT_COMPARE_BATCH
+BATCH_COMPARE_MAX_TARGETS = int(os.environ.get('BATCH_COMPARE_MAX_TARGETS', '50'))
+
+# HYBRID_BULK: checkpoints de la ejecución (tabla compartida con el indexador) y
+# margen antes del timeout para dejar de despachar fotos y guardar checkpoint
+VALIDATION_RUNS_TABLE = os.environ.get('VALIDATION_RUNS_TABLE')
+BULK_CHECKPOINT_MARGIN_MS = int(os.environ.get('BULK_CHECKPOINT_MARGIN_SECONDS', '15')) * 1000
+# Fotos en vuelo por ejecución: cada una verifica hasta 3 candidatos en candidate_executor
+# (VALIDATION_MAX_WORKERS * 3 hilos); con más, los candidatos esperan en cola hasta el timeout
+BULK_MAX_WORKERS = VALIDATION_MAX_WORKERS
+MAX_FAILED_KEYS_IN_CHECKPOINT = 1000
+IMAGE_SUFFIXES = ('.jpg', '.jpeg', '.png')
+# Etapas medidas por foto ('store' se mide por BatchWriteItem)
+BULK_STAGES = ('download', 'preprocess', 'search', 'compare', 'store')
+
+# Tiempo máximo para verificar en paralelo los candidatos del modo HYBRID
+HYBRID_CANDIDATES_TIMEOUT_SECONDS = float(os.environ.get('HYBRID_CANDIDATES_TIMEOUT_SECONDS', '10'))
+
+# Caché en memoria de documentos normalizados (derivados generados por el indexador)
+DOCUMENT_CACHE_MAX_BYTES = int(os.environ.get('DOCUMENT_CACHE_MAX_MB', '64')) * 1024 * 1024
+
+# Modo lean: sin DetectFaces previo, la ausencia de cara la indican
+# SearchFacesByImage (SearchedFaceBoundingBox) y CompareFaces (SourceImageFace,
+# o un DetectFaces de la foto si CompareFaces responde InvalidParameterException)
+LEAN_VALIDATION = os.environ.get('LEAN_VALIDATION', 'true').lower() == 'true'
+# Errores de CompareFaces (InvalidParameterException) que pueden deberse a una
+# foto de usuario sin cara; los de formato o tamaño no
+INVALID_COMPARE_ERROR_TYPES = ('INVALID_IMAGE', 'INVALID_PARAMETERS')
+
+# Caché de resultados por (contenido de la foto, modo, documento, umbral):
+# LRU del contenedor delante de DynamoDB con TTL (0 = desactivada)
+CONTENT_HASHES_TABLE = os.environ.get('CONTENT_HASHES_TABLE')
+RESULT_CACHE_TTL_SECONDS = int(os.environ.get('RESULT_CACHE_TTL_SECONDS', '3600'))
+RESULT_CACHE_MAX_ENTRIES = int(os.environ.get('RESULT_CACHE_MAX_ENTRIES', '1024'))
+
+# Estados de una validación completada (el resto son errores que se vuelven a intentar)
+COMPLETED_STATUSES = (
+    'MATCH_CONFIRMED', 'POSSIBLE_MATCH', 'LOW_CONFIDENCE_MATCH', 'NO_STRONG_MATCH', 'NO_MATCH_FOUND',
+    'DIRECT_MATCH_HIGH_CONFIDENCE', 'DIRECT_MATCH_CONFIRMED', 'POSIBLE_MATCH', 'POSIBLE MATCH', 'DIRECT_NO_MATCH',
+    'NO_FACE_DETECTED', 'NO_FACE_IN_USER_IMAGE', 'LOW_QUALITY_IMAGE'
+)
+
+# Estados de una comparación directa completada (entran en el ranking del lote)
+DIRECT_COMPARE_STATUSES = (
+    'DIRECT_MATCH_HIGH_CONFIDENCE', 'DIRECT_MATCH_CONFIRMED', 'POSIBLE_MATCH', 'POSIBLE MATCH', 'DIRECT_NO_MATCH'
+)
+
+# Resultados deterministas para una foto dada (y un documento en los modos directos).
+# Los de búsqueda HYBRID no: dependen de lo que haya en la colección en cada momento
+CACHEABLE_STATUSES = DIRECT_COMPARE_STATUSES + ('NO_FACE_DETECTED', 'NO_FACE_IN_USER_IMAGE', 'LOW_QUALITY_IMAGE')
+
+# Implementación asyncio de las validaciones (para comparar latencias A/B)
+ASYNC_VALIDATION = os.environ.get('ASYNC_VALIDATION', 'false').lower() == 'true'
+if ASYNC_VALIDATION:
+    # Solo con la implementación asyncio: importar asyncio suma ~50-90ms al cold start
+    import asyncio
+
+# Pre-filtro local de calidad antes de llamar a Rekognition
+IMAGE_QUALITY_GATE = os.environ.get('IMAGE_QUALITY_GATE', 'true').lower() == 'true'
+
+# TPS por API de Rekognition ("5" o "CompareFaces=10,IndexFaces=5"; vacío = sin límite)
+REKOGNITION_TPS = parse_tps_config(os.environ.get('REKOGNITION_TPS', ''))
+# Margen antes del timeout de la Lambda en el que ya no se reintentan throttles
+REKOGNITION_DEADLINE_MARGIN_SECONDS = 5
+
+# Clients (se construyen en el primer uso para no pagarlos en el cold start)
+s3_client = LazyClient('s3')
+lambda_client = LazyClient('lambda')
+# Tablas sobre el cliente DynamoDB de bajo nivel (thread-safe, sin capa de resources)
+results_table = DynamoTable(COMPARISON_RESULTS_TABLE)
+documents_table = DynamoTable(INDEXED_DOCUMENTS_TABLE)
+runs_table = DynamoTable(VALIDATION_RUNS_TABLE) if VALIDATION_RUNS_TABLE else None
+# Resultados pendientes de escribir: se vacía con BatchWriteItem antes de terminar la invocación
+result_sink = ResultSink(results_table, 'comparison_id')
+result_cache = (ValidationResultCache(CONTENT_HASHES_TABLE, RESULT_CACHE_TTL_SECONDS, RESULT_CACHE_MAX_ENTRIES)
+                if RESULT_CACHE_TTL_SECONDS > 0 else None)
 
 # Processors
-image_processor = MinimalImageProcessor()
-rekognition_client = RekognitionClient(COLLECTION_ID)
+image_processor = MinimalImageProcessor(int(os.environ.get('IMAGE_TARGET_DIMENSION', '4096')))
+rekognition_client = RekognitionClient(COLLECTION_ID, REKOGNITION_TPS)
+
+document_cache = LRUByteCache(DOCUMENT_CACHE_MAX_BYTES)
+
+# Resultados pendientes de escribir del hilo actual (ver deferred_result_writes)
+deferred_writes = threading.local()
+
+# Pool compartido entre invocaciones para verificar candidatos HYBRID (3 por validación)
+candidate_executor = ThreadPoolExecutor(max_workers=VALIDATION_MAX_WORKERS * 3, thread_name_prefix='candidate')
+# Pool de las llamadas bloqueantes de la implementación asyncio (hasta 3 en vuelo por validación)
+async_executor = ThreadPoolExecutor(max_workers=VALIDATION_MAX_WORKERS * 3, thread_name_prefix='async-io')
 
 def decimal_serializer(obj):
     """
@@ -53,10 +152,23 @@ def lambda_handler(event, context):
     1. Hybrid mode: {"validation_mode": "HYBRID", "user_image_key": "photo.jpg"}
     2. Direct with document_id: {"validation_mode": "DIRECT_COMPARE", "user_image_key": "photo.jpg", "target_document_id": "doc_123"}
     3. NEW - Direct with image key: {"validation_mode": "DIRECT_COMPARE", "user_image_key": "photo.jpg", "document_image_key": "juan_dni.jpg"}
+    4. Lote SQS con notificaciones S3 del bucket de fotos: responde batchItemFailures
+    5. Una foto contra varios documentos: {"validation_mode": "DIRECT_COMPARE_BATCH", "user_image_key": "photo.jpg",
+       "document_image_keys": ["juan_dni.jpg", ...], "target_document_ids": ["doc_123", ...]}
+    6. Validación HYBRID masiva de fotos ya subidas, con checkpoint:
+       {"validation_mode": "HYBRID_BULK", "prefix": "campaign/"} o {"validation_mode": "HYBRID_BULK", "manifest_key": "m.csv"}
+       (para continuar: {"validation_mode": "HYBRID_BULK", "run_id": "bulk_..."}; opcional "max_workers")
+       Invocar en rekognition-basic-user-validator-bulk: con el timeout de 30s del validador
+       cada invocación solo procesa fotos durante ~15s
     """
     
     logger.info(f"Received event: {json.dumps(event)}")
     
+    if context is not None:
+        rekognition_client.set_deadline(
+            time.time() + context.get_remaining_time_in_millis() / 1000 - REKOGNITION_DEADLINE_MARGIN_SECONDS
+        )
+    
     start_time = time.time()
     
     try:
@@ -68,19 +180,19 @@ def lambda_handler(event, context):
             logger.info(f"Manual invocation - Mode: {validation_mode}, User Image: {user_image_key}")
             
             if validation_mode == 'HYBRID':
-                result = validate_hybrid_mode(user_image_key, start_time)
+                result = run_validation(validate_hybrid_mode, user_image_key, start_time)
                 
             elif validation_mode == 'DIRECT_COMPARE':
                 # NEW: Check if using document_image_key or target_document_id
                 if 'document_image_key' in event:
                     document_image_key = event['document_image_key']
                     logger.info(f"Using DIRECT_COMPARE with document_image_key: {document_image_key}")
-                    result = validate_direct_compare_by_image_key(user_image_key, document_image_key, start_time)
+                    result = run_validation(validate_direct_compare_by_image_key, user_image_key, document_image_key, start_time)
                     
                 elif 'target_document_id' in event:
                     target_document_id = event['target_document_id']
                     logger.info(f"Using DIRECT_COMPARE with target_document_id: {target_document_id}")
-                    result = validate_direct_compare_by_document_id(user_image_key, target_document_id, start_time)
+                    result = run_validation(validate_direct_compare_by_document_id, user_image_key, target_document_id, start_time)
                     
                 else:
                     return {
@@ -93,41 +205,50 @@ def lambda_handler(event, context):
                             ]
                         })
                     }
+            elif validation_mode == 'DIRECT_COMPARE_BATCH':
+                document_image_keys = event.get('document_image_keys') or []
+                target_document_ids = event.get('target_document_ids') or []
+                targets_count = len(document_image_keys) + len(target_document_ids)
+                
+                if not targets_count or targets_count > BATCH_COMPARE_MAX_TARGETS:
+                    return {
+                        'statusCode': 400,
+                        'body': json.dumps({
+                            'error': f'DIRECT_COMPARE_BATCH requires between 1 and {BATCH_COMPARE_MAX_TARGETS} '
+                                     f'document_image_keys/target_document_ids (got {targets_count})',
+                            'example': '{"validation_mode": "DIRECT_COMPARE_BATCH", "user_image_key": "photo.jpg", '
+                                       '"document_image_keys": ["juan_dni.jpg", "ana_dni.jpg"], "target_document_ids": ["juan_perez_123"]}'
+                        })
+                    }
+                result = validate_direct_compare_batch(user_image_key, document_image_keys, target_document_ids, start_time)
+                
+            elif validation_mode == 'HYBRID_BULK':
+                return start_bulk_validation(event, context)
+                
             else:
                 return {
                     'statusCode': 400,
                     'body': json.dumps({
                         'error': 'Invalid validation mode',
-                        'supported_modes': ['HYBRID', 'DIRECT_COMPARE']
+                        'supported_modes': ['HYBRID', 'DIRECT_COMPARE', 'DIRECT_COMPARE_BATCH', 'HYBRID_BULK']
                     })
                 }
             
+            # Escribir el resultado antes de responder (STORAGE_ERROR si falla)
+            result = flush_stored_results([result])[0]
             return {
                 'statusCode': 200,
                 'body': json.dumps(result, default=decimal_serializer)
             }
         
-        # Handle S3 events (automatic validation) - unchanged
+        # Handle SQS batches (S3 notifications buffered by the queue)
+        if event.get('Records') and event['Records'][0].get('eventSource') == 'aws:sqs':
+            return process_sqs_batch(event['Records'])
+        
+        # Handle S3 events (automatic validation)
         for record in event['Records']:
             if record['eventSource'] == 'aws:s3':
-                bucket_name = record['s3']['bucket']['name']
-                s3_key = record['s3']['object']['key']
-                
-                logger.info(f"Processing user photo: {s3_key}")
-                
-                # Use configured validation mode for S3 events
-                if VALIDATION_MODE == 'DIRECT_COMPARE':
-                    target_document_id = extract_target_document_from_key(s3_key)
-                    if target_document_id:
-                        result = validate_direct_compare_by_document_id(s3_key, target_document_id, start_time)
-                    else:
-                        logger.warning(f"No target document found for {s3_key}, falling back to HYBRID mode")
-                        result = validate_hybrid_mode(s3_key, start_time)
-                else:
-                    result = validate_hybrid_mode(s3_key, start_time)
-                
-                processing_time = (time.time() - start_time) * 1000
-                logger.info(f"Validation completed for {s3_key}: {result['status']} in {processing_time:.0f}ms")
+                process_s3_record(record, start_time)
         
         return {
             'statusCode': 200,
@@ -140,6 +261,84 @@ def lambda_handler(event, context):
             'statusCode': 500,
             'body': json.dumps({'error': f'Internal error: {str(e)}'})
         }
+    finally:
+        # Ningún resultado queda sin escribir al terminar la invocación
+        if len(result_sink):
+            flush_stored_results([])
+        # Contadores acumulados del contenedor: llamadas, throttles y reintentos
+        logger.info(f"📊 Rekognition stats: {rekognition_client.get_stats()}")
+        logger.info(f"📊 Result sink stats: {result_sink.stats()}")
+        if result_cache:
+            logger.info(f"📊 Result cache stats: {result_cache.stats()}")
+
+def process_s3_record(record: dict, start_time: float) -> dict:
+    """
+    Validar la foto de usuario de una notificación S3 con el modo configurado
+    """
+    s3_key = unquote_plus(record['s3']['object']['key'])
+    
+    logger.info(f"Processing user photo: {s3_key}")
+    
+    # Use configured validation mode for S3 events
+    if VALIDATION_MODE == 'DIRECT_COMPARE':
+        target_document_id = extract_target_document_from_key(s3_key)
+        if target_document_id:
+            result = run_validation(validate_direct_compare_by_document_id, s3_key, target_document_id, start_time)
+        else:
+            logger.warning(f"No target document found for {s3_key}, falling back to HYBRID mode")
+            result = run_validation(validate_hybrid_mode, s3_key, start_time)
+    else:
+        result = run_validation(validate_hybrid_mode, s3_key, start_time)
+    
+    processing_time = (time.time() - start_time) * 1000
+    logger.info(f"Validation completed for {s3_key}: {result['status']} in {processing_time:.0f}ms"
+                f" ({'async' if ASYNC_VALIDATION else 'sync'})")
+    return result
+
+def process_sqs_batch(records: list) -> dict:
+    """
+    Procesar un lote SQS en paralelo y reportar fallos por mensaje.
+    Los resultados de todo el lote se escriben juntos con BatchWriteItem; los
+    mensajes con throttling o errores de almacenamiento se devuelven en
+    batchItemFailures para que SQS los reintente de forma individual.
+    """
+    def process_message(record: dict) -> list:
+        try:
+            body = json.loads(record['body'])
+            if body.get('Event') == 's3:TestEvent':
+                return []
+            
+            return [
+                process_s3_record(s3_record, time.time())
+                for s3_record in body.get('Records', [])
+                if s3_record.get('eventSource') == 'aws:s3'
+            ]
+            
+        except Exception as e:
+            logger.error(f"Error processing SQS message {record.get('messageId')}: {str(e)}")
+            return None
+    
+    message_results = [
+        (record, results)
+        for _, record, results in run_bounded(records, process_message, max_workers=VALIDATION_MAX_WORKERS)
+    ]
+    
+    # Un BatchWriteItem (en lotes de 25) para los resultados de todo el lote
+    failures = result_sink.flush()
+    
+    batch_item_failures = []
+    for record, results in message_results:
+        if results is None or any(
+            is_retryable_result(result) or result.get('comparison_id') in failures for result in results
+        ):
+            batch_item_failures.append({'itemIdentifier': record['messageId']})
+    
+    logger.info(f"SQS batch processed: {len(records)} messages, {len(batch_item_failures)} to retry")
+    return {'batchItemFailures': batch_item_failures}
+
+def is_retryable_result(result: dict) -> bool:
+    """Throttling de Rekognition/DynamoDB o fallo al guardar el resultado"""
+    return result.get('status') == 'STORAGE_ERROR' or is_throttling_error(result.get('error', ''))
 
 def validate_direct_compare_by_image_key(user_image_key: str, document_image_key: str, start_time: float) -> dict:
     """
@@ -149,21 +348,20 @@ def validate_direct_compare_by_image_key(user_image_key: str, document_image_key
     logger.info(f"🎯 DIRECT COMPARE BY IMAGE KEY: {user_image_key} vs {document_image_key}")
     
     try:
-        # STEP 1: Descargar imagen de usuario
-        bucket_name = os.environ['USER_PHOTOS_BUCKET']
-        response = s3_client.get_object(Bucket=bucket_name, Key=user_image_key)
-        user_image_bytes = response['Body'].read()
+        # STEP 1: Descargar imagen de usuario (o devolver el resultado en caché para su contenido)
+        cache_key, cached, user_image_bytes = fetch_user_image(
+            comparison_id, user_image_key, 'DIRECT_COMPARE_BY_IMAGE_KEY', document_image_key, DIRECT_COMPARE_THRESHOLD, start_time
+        )
+        if cached:
+            return cached
         
-        logger.info(f"Downloaded user photo {user_image_key}: {len(user_image_bytes)} bytes")
+        # STEP 2: Buscar metadatos del documento (opcional, para enriquecer resultado
+        # y usar su derivado normalizado si existe)
+        document_metadata = get_document_by_s3_key(document_image_key)
         
-        # STEP 2: Descargar imagen del documento usando document_image_key
+        # STEP 3: Obtener imagen del documento usando document_image_key
         try:
-            doc_response = s3_client.get_object(
-                Bucket=DOCUMENTS_BUCKET, 
-                Key=document_image_key
-            )
-            document_image_bytes = doc_response['Body'].read()
-            logger.info(f"Downloaded document image {document_image_key}: {len(document_image_bytes)} bytes")
+            document_image_bytes = load_document_image(document_image_key, document_metadata)
         except Exception as e:
             return store_validation_result(
                 comparison_id, user_image_key, start_time,
@@ -174,9 +372,6 @@ def validate_direct_compare_by_image_key(user_image_key: str, document_image_key
                 error=f'Failed to download document image: {str(e)}'
             )
         
-        # STEP 3: Buscar metadatos del documento (opcional, para enriquecer resultado)
-        document_metadata = get_document_by_s3_key(document_image_key)
-        
         # STEP 4: Preprocessing de imagen de usuario
         processed_user_bytes, error = image_processor.process_image(user_image_bytes, user_image_key)
         if error:
@@ -189,7 +384,46 @@ def validate_direct_compare_by_image_key(user_image_key: str, document_image_key
                 error=f'User image preprocessing failed: {error}'
             )
         
-        # STEP 5: Validar cara en imagen de usuario
+        # STEP 5-8: Calidad, CompareFaces y almacenamiento
+        return remember_result(cache_key, user_image_key, compare_and_store_by_image_key(
+            comparison_id, user_image_key, document_image_key, document_metadata,
+            processed_user_bytes, document_image_bytes, start_time
+        ))
+        
+    except Exception as e:
+        logger.error(f"Error in direct comparison by image key {user_image_key}: {str(e)}")
+        return store_validation_result(
+            comparison_id, user_image_key, start_time,
+            status='ERROR',
+            validation_mode='DIRECT_COMPARE_BY_IMAGE_KEY',
+            document_image_key=document_image_key,
+            confidence_score=0,
+            error=str(e)
+        )
+
+def compare_and_store_by_image_key(comparison_id: str, user_image_key: str, document_image_key: str,
+                                   document_metadata: dict, processed_user_bytes: bytes,
+                                   document_image_bytes: bytes, start_time: float, screened: bool = False) -> dict:
+    """
+    Pasos finales del modo directo por document_image_key (comunes a las
+    implementaciones síncrona y asyncio): pre-filtro de calidad, CompareFaces
+    y almacenamiento del resultado. Con screened=True la foto ya pasó el
+    pre-filtro y la validación de cara (lote DIRECT_COMPARE_BATCH).
+    """
+    # Pre-filtro de calidad: evita pagar DetectFaces/CompareFaces en imágenes inservibles
+    rejection = None if screened else check_image_quality(processed_user_bytes)
+    if rejection:
+        return store_validation_result(
+            comparison_id, user_image_key, start_time,
+            status='LOW_QUALITY_IMAGE',
+            validation_mode='DIRECT_COMPARE_BY_IMAGE_KEY',
+            document_image_key=document_image_key,
+            confidence_score=0,
+            **rejection
+        )
+    
+    # STEP 5: Validar cara en imagen de usuario (en modo lean lo indica CompareFaces)
+    if not LEAN_VALIDATION and not screened:
         face_detection = rekognition_client.detect_faces(processed_user_bytes)
         if not face_detection['success'] or face_detection['face_count'] == 0:
             return store_validation_result(
@@ -198,68 +432,67 @@ def validate_direct_compare_by_image_key(user_image_key: str, document_image_key
                 validation_mode='DIRECT_COMPARE_BY_IMAGE_KEY',
                 document_image_key=document_image_key,
                 confidence_score=0,
-                error='No faces detected in user photo'
-            )
-        
-        # STEP 6: CompareFaces directo
-        logger.info(f"Performing direct comparison with threshold {DIRECT_COMPARE_THRESHOLD}")
-        
-        comparison_result = rekognition_client.compare_faces(
-            processed_user_bytes,
-            document_image_bytes,
-            threshold=DIRECT_COMPARE_THRESHOLD
-        )
-        
-        if not comparison_result['success']:
-            return store_validation_result(
-                comparison_id, user_image_key, start_time,
-                status='COMPARISON_ERROR',
-                validation_mode='DIRECT_COMPARE_BY_IMAGE_KEY',
-                document_image_key=document_image_key,
-                confidence_score=0,
-                error=f'CompareFaces failed: {comparison_result["error"]}'
+                error=f'Face detection failed: {face_detection["error"]}' if not face_detection['success'] else 'No faces detected in user photo'
             )
-        
-        # 🔧 STEP 7: Evaluar resultado CORREGIDO
-        # SIEMPRE obtener similarity real, sin importar match_found
-        similarity = comparison_result.get('similarity', 0)
-
-        if similarity >= 95:
-            status = 'DIRECT_MATCH_HIGH_CONFIDENCE'
-        elif similarity >= 90:  
-            status = 'DIRECT_MATCH_CONFIRMED'
-        elif similarity >= 80:  # ← Agregado: rango moderado
-            status = 'POSIBLE_MATCH'
-        else:
-            status = 'DIRECT_NO_MATCH'
-
-        confidence = similarity  # ← NUNCA forzar a 0
-        logger.info(f"Direct comparison: {confidence:.1f}% similarity → {status}")
-        
-        # STEP 8: Almacenar resultado
+    
+    # STEP 6: CompareFaces directo
+    logger.info(f"Performing direct comparison with threshold {DIRECT_COMPARE_THRESHOLD}")
+    
+    comparison_result = rekognition_client.compare_faces(
+        processed_user_bytes,
+        document_image_bytes,
+        threshold=DIRECT_COMPARE_THRESHOLD
+    )
+    
+    if user_face_missing(comparison_result, processed_user_bytes):
         return store_validation_result(
             comparison_id, user_image_key, start_time,
-            status=status,
+            status='NO_FACE_IN_USER_IMAGE',
             validation_mode='DIRECT_COMPARE_BY_IMAGE_KEY',
             document_image_key=document_image_key,
-            matched_face_id=document_metadata.get('face_id') if document_metadata else None,
-            confidence_score=Decimal(str(confidence)),
-            person_name=document_metadata.get('person_name') if document_metadata else extract_person_from_filename(document_image_key),
-            target_document_id=document_metadata.get('document_id') if document_metadata else None,
-            direct_comparison_threshold=Decimal(str(DIRECT_COMPARE_THRESHOLD)),
-            candidates_evaluated=1
+            confidence_score=0,
+            error='No faces detected in user photo'
         )
-        
-    except Exception as e:
-        logger.error(f"Error in direct comparison by image key {user_image_key}: {str(e)}")
+    
+    if not comparison_result['success']:
         return store_validation_result(
             comparison_id, user_image_key, start_time,
-            status='ERROR',
+            status='COMPARISON_ERROR',
             validation_mode='DIRECT_COMPARE_BY_IMAGE_KEY',
             document_image_key=document_image_key,
             confidence_score=0,
-            error=str(e)
+            error=f'CompareFaces failed: {comparison_result["error"]}'
         )
+    
+    # 🔧 STEP 7: Evaluar resultado CORREGIDO
+    # SIEMPRE obtener similarity real, sin importar match_found
+    similarity = comparison_result.get('similarity', 0)
+
+    if similarity >= 95:
+        status = 'DIRECT_MATCH_HIGH_CONFIDENCE'
+    elif similarity >= 90:  
+        status = 'DIRECT_MATCH_CONFIRMED'
+    elif similarity >= 80:  # ← Agregado: rango moderado
+        status = 'POSIBLE_MATCH'
+    else:
+        status = 'DIRECT_NO_MATCH'
+
+    confidence = similarity  # ← NUNCA forzar a 0
+    logger.info(f"Direct comparison: {confidence:.1f}% similarity → {status}")
+    
+    # STEP 8: Almacenar resultado
+    return store_validation_result(
+        comparison_id, user_image_key, start_time,
+        status=status,
+        validation_mode='DIRECT_COMPARE_BY_IMAGE_KEY',
+        document_image_key=document_image_key,
+        matched_face_id=document_metadata.get('face_id') if document_metadata else None,
+        confidence_score=float(confidence),
+        person_name=document_metadata.get('person_name') if document_metadata else extract_person_from_filename(document_image_key),
+        target_document_id=document_metadata.get('document_id') if document_metadata else None,
+        direct_comparison_threshold=DIRECT_COMPARE_THRESHOLD,
+        candidates_evaluated=1
+    )
 
 def validate_direct_compare_by_document_id(user_image_key: str, target_document_id: str, start_time: float) -> dict:
     """
@@ -269,12 +502,12 @@ def validate_direct_compare_by_document_id(user_image_key: str, target_document_
     logger.info(f"🎯 DIRECT COMPARE BY DOCUMENT ID: {user_image_key} vs {target_document_id}")
     
     try:
-        # STEP 1: Descargar imagen de usuario
-        bucket_name = os.environ['USER_PHOTOS_BUCKET']
-        response = s3_client.get_object(Bucket=bucket_name, Key=user_image_key)
-        user_image_bytes = response['Body'].read()
-        
-        logger.info(f"Downloaded user photo {user_image_key}: {len(user_image_bytes)} bytes")
+        # STEP 1: Descargar imagen de usuario (o devolver el resultado en caché para su contenido)
+        cache_key, cached, user_image_bytes = fetch_user_image(
+            comparison_id, user_image_key, 'DIRECT_COMPARE_BY_DOCUMENT_ID', target_document_id, DIRECT_COMPARE_THRESHOLD, start_time
+        )
+        if cached:
+            return cached
         
         # STEP 2: Obtener metadatos del documento objetivo
         target_document = get_document_by_id(target_document_id)
@@ -288,14 +521,9 @@ def validate_direct_compare_by_document_id(user_image_key: str, target_document_
                 error=f'Document not found: {target_document_id}'
             )
         
-        # STEP 3: Descargar imagen del documento objetivo
+        # STEP 3: Obtener imagen del documento objetivo
         try:
-            doc_response = s3_client.get_object(
-                Bucket=DOCUMENTS_BUCKET, 
-                Key=target_document['s3_key']
-            )
-            document_image_bytes = doc_response['Body'].read()
-            logger.info(f"Downloaded target document: {len(document_image_bytes)} bytes")
+            document_image_bytes = load_document_image(target_document['s3_key'], target_document)
         except Exception as e:
             return store_validation_result(
                 comparison_id, user_image_key, start_time,
@@ -318,7 +546,46 @@ def validate_direct_compare_by_document_id(user_image_key: str, target_document_
                 error=f'User image preprocessing failed: {error}'
             )
         
-        # STEP 5: Validar cara en imagen de usuario
+        # STEP 5-8: Calidad, CompareFaces y almacenamiento
+        return remember_result(cache_key, user_image_key, compare_and_store_by_document_id(
+            comparison_id, user_image_key, target_document,
+            processed_user_bytes, document_image_bytes, start_time
+        ))
+        
+    except Exception as e:
+        logger.error(f"Error in direct comparison by document ID {user_image_key}: {str(e)}")
+        return store_validation_result(
+            comparison_id, user_image_key, start_time,
+            status='ERROR',
+            validation_mode='DIRECT_COMPARE_BY_DOCUMENT_ID',
+            target_document_id=target_document_id,
+            confidence_score=0,
+            error=str(e)
+        )
+
+def compare_and_store_by_document_id(comparison_id: str, user_image_key: str, target_document: dict,
+                                     processed_user_bytes: bytes, document_image_bytes: bytes,
+                                     start_time: float, screened: bool = False) -> dict:
+    """
+    Pasos finales del modo directo por target_document_id (comunes a las
+    implementaciones síncrona y asyncio y al lote)
+    """
+    target_document_id = target_document['document_id']
+    
+    # Pre-filtro de calidad: evita pagar DetectFaces/CompareFaces en imágenes inservibles
+    rejection = None if screened else check_image_quality(processed_user_bytes)
+    if rejection:
+        return store_validation_result(
+            comparison_id, user_image_key, start_time,
+            status='LOW_QUALITY_IMAGE',
+            validation_mode='DIRECT_COMPARE_BY_DOCUMENT_ID',
+            target_document_id=target_document_id,
+            confidence_score=0,
+            **rejection
+        )
+    
+    # STEP 5: Validar cara en imagen de usuario (en modo lean lo indica CompareFaces)
+    if not LEAN_VALIDATION and not screened:
         face_detection = rekognition_client.detect_faces(processed_user_bytes)
         if not face_detection['success'] or face_detection['face_count'] == 0:
             return store_validation_result(
@@ -327,86 +594,89 @@ def validate_direct_compare_by_document_id(user_image_key: str, target_document_
                 validation_mode='DIRECT_COMPARE_BY_DOCUMENT_ID',
                 target_document_id=target_document_id,
                 confidence_score=0,
-                error='No faces detected in user photo'
-            )
-        
-        # STEP 6: CompareFaces directo
-        logger.info(f"Performing direct comparison with threshold {DIRECT_COMPARE_THRESHOLD}")
-        
-        comparison_result = rekognition_client.compare_faces(
-            processed_user_bytes,
-            document_image_bytes,
-            threshold=DIRECT_COMPARE_THRESHOLD
-        )
-        
-        if not comparison_result['success']:
-            return store_validation_result(
-                comparison_id, user_image_key, start_time,
-                status='COMPARISON_ERROR',
-                validation_mode='DIRECT_COMPARE_BY_DOCUMENT_ID',
-                target_document_id=target_document_id,
-                confidence_score=0,
-                error=f'CompareFaces failed: {comparison_result["error"]}'
+                error=f'Face detection failed: {face_detection["error"]}' if not face_detection['success'] else 'No faces detected in user photo'
             )
-        
-        # 🔧 STEP 7: Evaluar resultado CORREGIDO
-        # SIEMPRE obtener similarity real, sin importar match_found
-        similarity = comparison_result.get('similarity', 0)
-
-        if similarity >= 95:
-            status = 'DIRECT_MATCH_HIGH_CONFIDENCE'
-        elif similarity >= 90: 
-            status = 'DIRECT_MATCH_CONFIRMED'
-        elif similarity >= 80:  
-            status = 'POSIBLE MATCH'
-        else:
-            status = 'DIRECT_NO_MATCH'
-
-        confidence = similarity  # ← Valor real siempre
-        logger.info(f"Direct comparison: {confidence:.1f}% similarity → {status}")
-        
-        # STEP 8: Almacenar resultado
+    
+    # STEP 6: CompareFaces directo
+    logger.info(f"Performing direct comparison with threshold {DIRECT_COMPARE_THRESHOLD}")
+    
+    comparison_result = rekognition_client.compare_faces(
+        processed_user_bytes,
+        document_image_bytes,
+        threshold=DIRECT_COMPARE_THRESHOLD
+    )
+    
+    if user_face_missing(comparison_result, processed_user_bytes):
         return store_validation_result(
             comparison_id, user_image_key, start_time,
-            status=status,
+            status='NO_FACE_IN_USER_IMAGE',
             validation_mode='DIRECT_COMPARE_BY_DOCUMENT_ID',
             target_document_id=target_document_id,
-            matched_face_id=target_document.get('face_id'),
-            confidence_score=Decimal(str(confidence)),
-            person_name=target_document.get('person_name'),
-            document_image_key=target_document.get('s3_key'),
-            direct_comparison_threshold=Decimal(str(DIRECT_COMPARE_THRESHOLD)),
-            candidates_evaluated=1
+            confidence_score=0,
+            error='No faces detected in user photo'
         )
-        
-    except Exception as e:
-        logger.error(f"Error in direct comparison by document ID {user_image_key}: {str(e)}")
+    
+    if not comparison_result['success']:
         return store_validation_result(
             comparison_id, user_image_key, start_time,
-            status='ERROR',
+            status='COMPARISON_ERROR',
             validation_mode='DIRECT_COMPARE_BY_DOCUMENT_ID',
             target_document_id=target_document_id,
             confidence_score=0,
-            error=str(e)
+            error=f'CompareFaces failed: {comparison_result["error"]}'
         )
+    
+    # 🔧 STEP 7: Evaluar resultado CORREGIDO
+    # SIEMPRE obtener similarity real, sin importar match_found
+    similarity = comparison_result.get('similarity', 0)
+
+    if similarity >= 95:
+        status = 'DIRECT_MATCH_HIGH_CONFIDENCE'
+    elif similarity >= 90: 
+        status = 'DIRECT_MATCH_CONFIRMED'
+    elif similarity >= 80:  
+        status = 'POSIBLE MATCH'
+    else:
+        status = 'DIRECT_NO_MATCH'
 
-def validate_hybrid_mode(s3_key: str, start_time: float) -> dict:
+    confidence = similarity  # ← Valor real siempre
+    logger.info(f"Direct comparison: {confidence:.1f}% similarity → {status}")
+    
+    # STEP 8: Almacenar resultado
+    return store_validation_result(
+        comparison_id, user_image_key, start_time,
+        status=status,
+        validation_mode='DIRECT_COMPARE_BY_DOCUMENT_ID',
+        target_document_id=target_document_id,
+        matched_face_id=target_document.get('face_id'),
+        confidence_score=float(confidence),
+        person_name=target_document.get('person_name'),
+        document_image_key=target_document.get('s3_key'),
+        direct_comparison_threshold=DIRECT_COMPARE_THRESHOLD,
+        candidates_evaluated=1
+    )
+
+def validate_hybrid_mode(s3_key: str, start_time: float, stage_timings: dict = None) -> dict:
     """
     MODO HÍBRIDO: SearchFacesByImage + CompareFaces (implementación original)
+    stage_timings (opcional) recibe la duración en ms de cada etapa (HYBRID_BULK)
     """
     comparison_id = generate_comparison_id()
     logger.info(f"🔍 HYBRID MODE: {s3_key}")
     
     try:
-        # STEP 1: Descargar imagen de usuario
-        bucket_name = os.environ['USER_PHOTOS_BUCKET']
-        response = s3_client.get_object(Bucket=bucket_name, Key=s3_key)
-        user_image_bytes = response['Body'].read()
-        
-        logger.info(f"Downloaded user photo {s3_key}: {len(user_image_bytes)} bytes")
+        # STEP 1: Descargar imagen de usuario (o devolver el resultado en caché para su contenido)
+        stage_start = time.perf_counter()
+        cache_key, cached, user_image_bytes = fetch_user_image(
+            comparison_id, s3_key, 'HYBRID', '', HYBRID_SEARCH_THRESHOLD, start_time
+        )
+        stage_start = record_stage(stage_timings, 'download', stage_start)
+        if cached:
+            return cached
         
         # STEP 2: Preprocessing mínimo
         processed_bytes, error = image_processor.process_image(user_image_bytes, s3_key)
+        stage_start = record_stage(stage_timings, 'preprocess', stage_start)
         if error:
             return store_validation_result(
                 comparison_id, s3_key, start_time,
@@ -416,7 +686,51 @@ def validate_hybrid_mode(s3_key: str, start_time: float) -> dict:
                 error=f'Preprocessing failed: {error}'
             )
         
-        # STEP 3: Validar que hay al menos una cara
+        # STEP 3-4: Calidad, cara y búsqueda en la colección
+        result, face_matches = screen_and_search_hybrid(comparison_id, s3_key, processed_bytes, start_time)
+        stage_start = record_stage(stage_timings, 'search', stage_start)
+        if result:
+            return remember_result(cache_key, s3_key, result)
+        
+        # STEP 5: CompareFaces con mejores candidatos (en paralelo, con deadline)
+        candidates = face_matches[:3]
+        best_match, candidates_evaluated = evaluate_candidates_parallel(candidates, processed_bytes)
+        record_stage(stage_timings, 'compare', stage_start)
+        
+        # STEP 6-7: Determinar y almacenar resultado final
+        return remember_result(cache_key, s3_key, store_hybrid_result(
+            comparison_id, s3_key, start_time, best_match, candidates_evaluated, len(candidates)
+        ))
+        
+    except Exception as e:
+        logger.error(f"Error in hybrid validation {s3_key}: {str(e)}")
+        return store_validation_result(
+            comparison_id, s3_key, start_time,
+            status='ERROR',
+            validation_mode='HYBRID',
+            confidence_score=0,
+            error=str(e)
+        )
+
+def screen_and_search_hybrid(comparison_id: str, s3_key: str, processed_bytes: bytes, start_time: float) -> tuple:
+    """
+    Pre-filtro de calidad, validación de cara y SearchFacesByImage del modo HYBRID.
+    
+    Retorna (resultado almacenado si la validación termina aquí, face_matches)
+    """
+    # Pre-filtro de calidad: evita pagar DetectFaces/CompareFaces en imágenes inservibles
+    rejection = check_image_quality(processed_bytes)
+    if rejection:
+        return store_validation_result(
+            comparison_id, s3_key, start_time,
+            status='LOW_QUALITY_IMAGE',
+            validation_mode='HYBRID',
+            confidence_score=0,
+            **rejection
+        ), None
+    
+    # STEP 3: Validar que hay al menos una cara (en modo lean lo indica SearchFacesByImage)
+    if not LEAN_VALIDATION:
         face_detection = rekognition_client.detect_faces(processed_bytes)
         if not face_detection['success']:
             return store_validation_result(
@@ -425,8 +739,8 @@ def validate_hybrid_mode(s3_key: str, start_time: float) -> dict:
                 validation_mode='HYBRID',
                 confidence_score=0,
                 error=f'Face detection failed: {face_detection["error"]}'
-            )
-        
+            ), None
+    
         if face_detection['face_count'] == 0:
             return store_validation_result(
                 comparison_id, s3_key, start_time,
@@ -434,133 +748,1143 @@ def validate_hybrid_mode(s3_key: str, start_time: float) -> dict:
                 validation_mode='HYBRID',
                 confidence_score=0,
                 error='No faces detected in user photo'
-            )
-        
-        # STEP 4: Buscar caras similares en colección
-        search_result = rekognition_client.search_faces_by_image(
-            processed_bytes,
-            threshold=75,
-            max_faces=5
-        )
-        
-        if not search_result['success']:
-            return store_validation_result(
-                comparison_id, s3_key, start_time,
-                status='SEARCH_ERROR',
-                validation_mode='HYBRID',
-                confidence_score=0,
-                error=f'Search failed: {search_result["error"]}'
-            )
-        
-        if not search_result['face_matches']:
-            return store_validation_result(
-                comparison_id, s3_key, start_time,
-                status='NO_MATCH_FOUND',
-                validation_mode='HYBRID',
-                confidence_score=Decimal('0'),
-                search_confidence=Decimal('0')
-            )
-        
-        # STEP 5: CompareFaces con mejores candidatos
-        best_match = None
-        best_confidence = 0
-        candidates_evaluated = 0
-        
-        for face_match in search_result['face_matches'][:3]:
-            candidates_evaluated += 1
-            face_id = face_match['Face']['FaceId']
-            search_confidence = face_match['Similarity']
-            
-            logger.info(f"Evaluating candidate {face_id} with search confidence {search_confidence:.1f}%")
-            
-            document_metadata = get_document_by_face_id(face_id)
-            if not document_metadata:
-                logger.warning(f"No metadata found for face_id: {face_id}")
-                continue
-            
-            try:
-                doc_response = s3_client.get_object(
-                    Bucket=DOCUMENTS_BUCKET, 
-                    Key=document_metadata['s3_key']
-                )
-                document_image_bytes = doc_response['Body'].read()
-            except Exception as e:
-                logger.error(f"Failed to download document {document_metadata['s3_key']}: {str(e)}")
-                continue
-            
-            comparison = rekognition_client.compare_faces(
-                processed_bytes,
-                document_image_bytes,
-                #threshold=80
-            )
-            
-            if comparison['success'] and comparison['match_found']:
-                confidence = comparison['similarity']
-                logger.info(f"CompareFaces result: {confidence:.1f}% similarity")
-                
-                if confidence > best_confidence:
-                    best_confidence = confidence
-                    best_match = {
-                        'face_id': face_id,
-                        'document_metadata': document_metadata,
-                        'confidence': confidence,
-                        'search_confidence': search_confidence,
-                        'comparison_details': comparison
-                    }
-        
-        # STEP 6: Determinar resultado final
-        if best_match:
-            if best_confidence >= 85:
-                status = 'MATCH_CONFIRMED'
-            elif best_confidence >= 75:
-                status = 'POSSIBLE_MATCH'
-            else:
-                status = 'LOW_CONFIDENCE_MATCH'
-        else:
-            status = 'NO_STRONG_MATCH'
-        
-        # STEP 7: Almacenar resultado
+            ), None
+    
+    # STEP 4: Buscar caras similares en colección
+    search_result = rekognition_client.search_faces_by_image(
+        processed_bytes,
+        threshold=HYBRID_SEARCH_THRESHOLD,
+        max_faces=5
+    )
+    
+    if search_result.get('error_type') == 'NO_FACE_DETECTED' or (search_result['success'] and not search_result['searched_face']):
         return store_validation_result(
             comparison_id, s3_key, start_time,
-            status=status,
+            status='NO_FACE_DETECTED',
             validation_mode='HYBRID',
-            matched_face_id=best_match['face_id'] if best_match else None,
-            confidence_score=Decimal(str(best_confidence)),
-            search_confidence=Decimal(str(best_match['search_confidence'])) if best_match else Decimal('0'),
-            person_name=best_match['document_metadata']['person_name'] if best_match else None,
-            document_image_key=best_match['document_metadata']['s3_key'] if best_match else None,
-            candidates_evaluated=candidates_evaluated
-        )
-        
-    except Exception as e:
-        logger.error(f"Error in hybrid validation {s3_key}: {str(e)}")
+            confidence_score=0,
+            error='No faces detected in user photo'
+        ), None
+    
+    if not search_result['success']:
         return store_validation_result(
             comparison_id, s3_key, start_time,
-            status='ERROR',
+            status='SEARCH_ERROR',
             validation_mode='HYBRID',
             confidence_score=0,
-            error=str(e)
-        )
+            error=f'Search failed: {search_result["error"]}'
+        ), None
+    
+    if not search_result['face_matches']:
+        return store_validation_result(
+            comparison_id, s3_key, start_time,
+            status='NO_MATCH_FOUND',
+            validation_mode='HYBRID',
+            confidence_score=0.0,
+            search_confidence=0.0
+        ), None
+    
+    return None, search_result['face_matches']
 
-def get_document_by_face_id(face_id: str) -> dict:
-    """Obtener metadatos de documento por face_id"""
-    try:
-        response = documents_table.query(
-            IndexName='face-id-index',
-            KeyConditionExpression='face_id = :face_id',
-            ExpressionAttributeValues={':face_id': face_id}
-        )
-        
-        if response['Items']:
-            return response['Items'][0]
-        return None
-        
-    except Exception as e:
-        logger.error(f"Error querying document by face_id {face_id}: {str(e)}")
-        return None
+def store_hybrid_result(comparison_id: str, s3_key: str, start_time: float,
+                        best_match: dict, candidates_evaluated: int, candidates_searched: int) -> dict:
+    """Determinar el estado final del modo HYBRID y almacenarlo"""
+    best_confidence = best_match['confidence'] if best_match else 0
+    
+    if best_match:
+        if best_confidence >= 85:
+            status = 'MATCH_CONFIRMED'
+        elif best_confidence >= 75:
+            status = 'POSSIBLE_MATCH'
+        else:
+            status = 'LOW_CONFIDENCE_MATCH'
+    else:
+        status = 'NO_STRONG_MATCH'
+    
+    return store_validation_result(
+        comparison_id, s3_key, start_time,
+        status=status,
+        validation_mode='HYBRID',
+        matched_face_id=best_match['face_id'] if best_match else None,
+        confidence_score=float(best_confidence),
+        search_confidence=float(best_match['search_confidence']) if best_match else 0.0,
+        person_name=best_match['document_metadata']['person_name'] if best_match else None,
+        document_image_key=best_match['document_metadata']['s3_key'] if best_match else None,
+        candidates_evaluated=candidates_evaluated,
+        candidates_searched=candidates_searched
+    )
 
-def get_document_by_id(document_id: str) -> dict:
-    """Obtener metadatos de documento por document_id"""
+def evaluate_candidates_parallel(face_matches: list, processed_bytes: bytes) -> tuple:
+    """
+    Verificar los candidatos de SearchFacesByImage en paralelo (metadata,
+    descarga del documento y CompareFaces por candidato). Los que no terminan
+    antes de HYBRID_CANDIDATES_TIMEOUT_SECONDS se descartan.
+    
+    Retorna (mejor_match o None, candidatos completados)
+    """
+    if not face_matches:
+        return None, 0
+    
+    futures = [candidate_executor.submit(evaluate_candidate, face_match, processed_bytes) for face_match in face_matches]
+    done, not_done = wait(futures, timeout=HYBRID_CANDIDATES_TIMEOUT_SECONDS)
+    
+    if not_done:
+        logger.warning(f"{len(not_done)} candidates did not finish within {HYBRID_CANDIDATES_TIMEOUT_SECONDS}s")
+        for future in not_done:
+            future.cancel()
+    
+    # Recorrer en el orden de la búsqueda para desempatar igual que antes
+    candidates = [future.result() for future in futures if future in done and not future.exception()]
+    return pick_best_candidate(candidates), len(done)
+
+def pick_best_candidate(candidates: list) -> dict:
+    """Candidato con mayor similitud (en empate gana el primero de la búsqueda)"""
+    best_match = None
+    for candidate in candidates:
+        if candidate and (best_match is None or candidate['confidence'] > best_match['confidence']):
+            best_match = candidate
+    return best_match
+
+def evaluate_candidate(face_match: dict, processed_bytes: bytes) -> dict:
+    """
+    Verificar un candidato con CompareFaces; None si no hay match
+    """
+    face_id = face_match['Face']['FaceId']
+    search_confidence = face_match['Similarity']
+    
+    logger.info(f"Evaluating candidate {face_id} with search confidence {search_confidence:.1f}%")
+    
+    document_metadata = get_document_by_face_id(face_id)
+    if not document_metadata:
+        logger.warning(f"No metadata found for face_id: {face_id}")
+        return None
+    
+    try:
+        document_image_bytes = load_document_image(document_metadata['s3_key'], document_metadata)
+    except Exception as e:
+        logger.error(f"Failed to download document {document_metadata['s3_key']}: {str(e)}")
+        return None
+    
+    comparison = rekognition_client.compare_faces(
+        processed_bytes,
+        document_image_bytes,
+        #threshold=80
+    )
+    
+    if comparison['success'] and comparison['match_found']:
+        confidence = comparison['similarity']
+        logger.info(f"CompareFaces result: {confidence:.1f}% similarity")
+        return {
+            'face_id': face_id,
+            'document_metadata': document_metadata,
+            'confidence': confidence,
+            'search_confidence': search_confidence,
+            'comparison_details': comparison
+        }
+    return None
+
+# ======================================================================
+# DIRECT_COMPARE_BATCH: una foto de usuario contra varios documentos
+# ======================================================================
+
+def validate_direct_compare_batch(user_image_key: str, document_image_keys: list,
+                                  target_document_ids: list, start_time: float) -> dict:
+    """
+    Comparar una foto de usuario con varios documentos en una invocación.
+    La foto se descarga, preprocesa y filtra una sola vez; los CompareFaces van
+    en paralelo (hasta VALIDATION_MAX_WORKERS, reduciendo la concurrencia ante
+    throttling y con el límite de REKOGNITION_TPS) y todos los resultados se
+    escriben juntos con BatchWriteItem. Usa siempre la implementación con hilos.
+    
+    Retorna el resultado por documento (en el orden recibido) y el ranking por similitud
+    """
+    batch_id = generate_comparison_id().replace('comp_', 'batch_', 1)
+    targets = (
+        [{'comparison_id': generate_comparison_id(), 'validation_mode': 'DIRECT_COMPARE_BY_IMAGE_KEY',
+          'document_image_key': document_image_key} for document_image_key in document_image_keys] +
+        [{'comparison_id': generate_comparison_id(), 'validation_mode': 'DIRECT_COMPARE_BY_DOCUMENT_ID',
+          'target_document_id': target_document_id} for target_document_id in target_document_ids]
+    )
+    logger.info(f"🎯 DIRECT COMPARE BATCH {batch_id}: {user_image_key} vs {len(targets)} documents")
+    
+    results = {}
+    cache_keys = {}
+    pending = {}
+    
+    with deferred_result_writes(pending):
+        try:
+            # STEP 1: Con el ETag de la foto (HeadObject) se resuelven los documentos ya
+            # validados; la foto solo se descarga si queda alguno por comparar
+            if result_cache:
+                etag = user_photo_etag(user_image_key)
+                for target in targets:
+                    cached = find_cached_result(target['comparison_id'], user_image_key, ValidationResultCache.make_key(
+                        etag, target['validation_mode'], batch_target_reference(target), DIRECT_COMPARE_THRESHOLD
+                    ), start_time)
+                    if cached:
+                        results[target['comparison_id']] = cached
+            
+            remaining = [target for target in targets if target['comparison_id'] not in results]
+            if remaining:
+                response = s3_client.get_object(Bucket=os.environ['USER_PHOTOS_BUCKET'], Key=user_image_key)
+                etag = response['ETag'].strip('"')
+                for target in remaining:
+                    cache_keys[target['comparison_id']] = ValidationResultCache.make_key(
+                        etag, target['validation_mode'], batch_target_reference(target), DIRECT_COMPARE_THRESHOLD
+                    )
+                user_image_bytes = response['Body'].read()
+                logger.info(f"Downloaded user photo {user_image_key}: {len(user_image_bytes)} bytes")
+                
+                # STEP 2: Preprocessing, calidad y cara una sola vez para todos los documentos
+                processed_bytes, rejection = screen_batch_user_image(user_image_bytes, user_image_key)
+                if rejection:
+                    for target in remaining:
+                        results[target['comparison_id']] = store_batch_target_result(
+                            target, user_image_key, start_time, **rejection
+                        )
+                else:
+                    # STEP 3: Documento + CompareFaces por objetivo, en paralelo
+                    def compare_target(target: dict) -> dict:
+                        with deferred_result_writes(pending):
+                            return compare_batch_target(target, user_image_key, processed_bytes, start_time)
+                    
+                    for _, target, result in run_bounded(
+                        remaining, compare_target, max_workers=VALIDATION_MAX_WORKERS,
+                        is_throttled=lambda result: is_throttling_error(result.get('error', ''))
+                    ):
+                        results[target['comparison_id']] = result
+        
+        except Exception as e:
+            logger.error(f"Error in direct comparison batch {batch_id} for {user_image_key}: {str(e)}")
+            for target in targets:
+                if target['comparison_id'] not in results:
+                    results[target['comparison_id']] = store_batch_target_result(
+                        target, user_image_key, start_time, status='ERROR', error=str(e)
+                    )
+    
+    # STEP 4: Escribir los resultados nuevos con BatchWriteItem (lotes de 25)
+    if pending:
+        for item in pending.values():
+            item['batch_id'] = batch_id
+            result_sink.add(item)
+        for comparison_id, error in result_sink.flush().items():
+            results[comparison_id] = storage_error_result(comparison_id, error)
+        logger.info(f"Stored validation results for batch {batch_id}: {result_sink.stats()}")
+        
+        # Cachear solo comparaciones nuevas (las reutilizadas ya apuntan a su original)
+        for comparison_id, cache_key in cache_keys.items():
+            if comparison_id in pending and not results[comparison_id].get('reused_from'):
+                remember_result(cache_key, user_image_key, results[comparison_id])
+    
+    # STEP 5: Resultado por documento y ranking por similitud (en empate, el orden recibido)
+    outcomes = [{'target': batch_target_reference(target), **results[target['comparison_id']]} for target in targets]
+    compared = sorted(
+        (outcome for outcome in outcomes if outcome.get('status') in DIRECT_COMPARE_STATUSES),
+        key=lambda outcome: float(outcome['confidence_score']), reverse=True
+    )
+    ranking = [{
+        'rank': rank,
+        'target': outcome['target'],
+        'comparison_id': outcome['comparison_id'],
+        'status': outcome['status'],
+        'confidence_score': outcome['confidence_score'],
+        'person_name': outcome.get('person_name')
+    } for rank, outcome in enumerate(compared, 1)]
+    
+    processing_time = (time.time() - start_time) * 1000
+    logger.info(f"Batch {batch_id} completed: {len(targets)} documents, {len(compared)} compared in {processing_time:.0f}ms")
+    
+    return {
+        'batch_id': batch_id,
+        'validation_mode': 'DIRECT_COMPARE_BATCH',
+        'user_image_key': user_image_key,
+        'targets_evaluated': len(targets),
+        'best_match': ranking[0] if ranking and ranking[0]['status'] != 'DIRECT_NO_MATCH' else None,
+        'ranking': ranking,
+        'results': outcomes,
+        'processing_time_ms': int(processing_time)
+    }
+
+def screen_batch_user_image(user_image_bytes: bytes, user_image_key: str) -> tuple:
+    """
+    Preprocessing, pre-filtro de calidad y (fuera del modo lean) DetectFaces de
+    la foto del lote. Retorna (bytes procesados, campos del rechazo o None)
+    """
+    processed_bytes, error = image_processor.process_image(user_image_bytes, user_image_key)
+    if error:
+        return None, {'status': 'USER_IMAGE_PROCESSING_ERROR', 'error': f'User image preprocessing failed: {error}'}
+    
+    rejection = check_image_quality(processed_bytes)
+    if rejection:
+        return None, {'status': 'LOW_QUALITY_IMAGE', **rejection}
+    
+    if not LEAN_VALIDATION:
+        face_detection = rekognition_client.detect_faces(processed_bytes)
+        if not face_detection['success'] or face_detection['face_count'] == 0:
+            return None, {
+                'status': 'NO_FACE_IN_USER_IMAGE',
+                'error': f'Face detection failed: {face_detection["error"]}' if not face_detection['success'] else 'No faces detected in user photo'
+            }
+    
+    return processed_bytes, None
+
+def compare_batch_target(target: dict, user_image_key: str, processed_bytes: bytes, start_time: float) -> dict:
+    """
+    Obtener el documento de un objetivo del lote y compararlo con la foto ya
+    filtrada (mismos estados que los modos directos individuales)
+    """
+    comparison_id = target['comparison_id']
+    try:
+        if 'document_image_key' in target:
+            document_image_key = target['document_image_key']
+            document_metadata = get_document_by_s3_key(document_image_key)
+            try:
+                document_image_bytes = load_document_image(document_image_key, document_metadata)
+            except Exception as e:
+                return store_batch_target_result(
+                    target, user_image_key, start_time,
+                    status='DOCUMENT_IMAGE_NOT_FOUND',
+                    error=f'Failed to download document image: {str(e)}'
+                )
+            return compare_and_store_by_image_key(
+                comparison_id, user_image_key, document_image_key, document_metadata,
+                processed_bytes, document_image_bytes, start_time, screened=True
+            )
+        
+        target_document = get_document_by_id(target['target_document_id'])
+        if not target_document:
+            return store_batch_target_result(
+                target, user_image_key, start_time,
+                status='TARGET_DOCUMENT_NOT_FOUND',
+                error=f'Document not found: {target["target_document_id"]}'
+            )
+        try:
+            document_image_bytes = load_document_image(target_document['s3_key'], target_document)
+        except Exception as e:
+            return store_batch_target_result(
+                target, user_image_key, start_time,
+                status='TARGET_DOCUMENT_ACCESS_ERROR',
+                error=f'Failed to download target document: {str(e)}'
+            )
+        return compare_and_store_by_document_id(
+            comparison_id, user_image_key, target_document,
+            processed_bytes, document_image_bytes, start_time, screened=True
+        )
+    
+    except Exception as e:
+        logger.error(f"Error comparing {user_image_key} with {batch_target_reference(target)}: {str(e)}")
+        return store_batch_target_result(target, user_image_key, start_time, status='ERROR', error=str(e))
+
+def store_batch_target_result(target: dict, user_image_key: str, start_time: float, **fields) -> dict:
+    """Almacenar un resultado sin comparación para un objetivo del lote"""
+    return store_validation_result(
+        target['comparison_id'], user_image_key, start_time,
+        **{key: value for key, value in target.items() if key != 'comparison_id'},
+        confidence_score=0,
+        **fields
+    )
+
+def batch_target_reference(target: dict) -> str:
+    """document_image_key o target_document_id del objetivo"""
+    return target.get('document_image_key') or target.get('target_document_id')
+
+# ======================================================================
+# HYBRID_BULK: validación HYBRID de muchas fotos ya subidas (prefijo o manifiesto)
+# ======================================================================
+
+def start_bulk_validation(event: dict, context) -> dict:
+    """
+    Iniciar una validación masiva ({"prefix": ...} o {"manifest_key": ...}) o
+    continuarla desde su checkpoint ({"run_id": ...})
+    """
+    run_id = event.get('run_id')
+    if run_id:
+        if runs_table is None:
+            return {
+                'statusCode': 400,
+                'body': json.dumps({'error': 'Resuming a bulk run requires VALIDATION_RUNS_TABLE'})
+            }
+        run = get_bulk_run(run_id)
+        if not run:
+            return {
+                'statusCode': 404,
+                'body': json.dumps({'error': f'Run not found: {run_id}'})
+            }
+        if run['status'] != 'IN_PROGRESS':
+            return {
+                'statusCode': 409,
+                'body': json.dumps({'error': f'Run {run_id} is {run["status"]}, nothing to resume'})
+            }
+        run['invocations'] += 1
+        logger.info(f"▶️  RESUMING bulk run {run_id} at position {run['position']}")
+        return run_bulk_validation(run, context)
+    
+    if 'prefix' not in event and 'manifest_key' not in event:
+        return {
+            'statusCode': 400,
+            'body': json.dumps({
+                'error': 'HYBRID_BULK requires prefix, manifest_key or run_id',
+                'examples': [
+                    '{"validation_mode": "HYBRID_BULK", "prefix": "campaign_2025/"}',
+                    '{"validation_mode": "HYBRID_BULK", "manifest_key": "manifests/campaign_2025.csv"}',
+                    '{"validation_mode": "HYBRID_BULK", "run_id": "bulk_20250618_143022_a1b2c3d4"}'
+                ]
+            })
+        }
+    
+    run = new_bulk_run(
+        event.get('prefix', ''), event.get('manifest_key'), event.get('start_after'),
+        int(event.get('max_workers', VALIDATION_MAX_WORKERS))
+    )
+    logger.info(f"🚀 HYBRID BULK run {run['run_id']}: {run['manifest_key'] or 'prefix ' + repr(run['prefix'])}")
+    return run_bulk_validation(run, context)
+
+def run_bulk_validation(run: dict, context) -> dict:
+    """
+    Pipeline acotado: cada foto pasa por descarga, preprocessing, búsqueda y
+    CompareFaces en un pool de hasta max_workers hilos (reducido ante
+    throttling); los resultados se escriben con BatchWriteItem en lotes de 25.
+    
+    Cuando quedan menos de BULK_CHECKPOINT_MARGIN_SECONDS se deja de despachar
+    fotos, se terminan las que están en vuelo, se escriben sus resultados y se
+    guarda el checkpoint; la Lambda se re-invoca para continuar.
+    
+    El checkpoint (y los contadores de la ejecución) solo avanza hasta la
+    última foto de la secuencia contigua con resultado ya escrito: si un error
+    corta la invocación, las fotos en vuelo o sin escribir se repiten al continuar.
+    """
+    invocation_start = time.time()
+    stage_samples = {stage: [] for stage in BULK_STAGES}
+    listing = {}
+    # Posición en esta invocación → {'s3_key', 'status', 'write_failed'}
+    outcomes = {}
+    pending_photos = {}
+    
+    def flush_results():
+        if not pending_photos:
+            return
+        stage_start = time.perf_counter()
+        failures = result_sink.flush()
+        stage_samples['store'].append((time.perf_counter() - stage_start) * 1000)
+        for comparison_id in failures:
+            outcomes[pending_photos[comparison_id]]['write_failed'] = True
+        pending_photos.clear()
+    
+    def deadline_reached() -> bool:
+        return context is not None and context.get_remaining_time_in_millis() < BULK_CHECKPOINT_MARGIN_MS
+    
+    run['max_workers'] = min(max(1, run['max_workers']), BULK_MAX_WORKERS)
+    try:
+        for position, s3_key, outcome in run_bounded(
+            iter_bulk_photo_keys(run, listing),
+            validate_bulk_photo,
+            max_workers=run['max_workers'],
+            is_throttled=lambda outcome: is_throttling_error(outcome['result'].get('error', '')),
+            should_stop=deadline_reached
+        ):
+            outcomes[position] = {'s3_key': s3_key, 'status': outcome['result'].get('status', 'ERROR'), 'write_failed': False}
+            for stage, elapsed_ms in outcome['stage_timings'].items():
+                stage_samples[stage].append(elapsed_ms)
+            
+            for item in outcome['items']:
+                item['bulk_run_id'] = run['run_id']
+                pending_photos[item['comparison_id']] = position
+                result_sink.add(item)
+                for callback in outcome['post_write'].get(item['comparison_id'], []):
+                    result_sink.when_written(item['comparison_id'], callback)
+            if len(result_sink) >= BATCH_WRITE_MAX_ITEMS:
+                flush_results()
+    
+    except Exception as e:
+        # Se guarda lo ya escrito; el checkpoint no pasa de la primera foto sin resultado
+        logger.error(f"Error in bulk run {run['run_id']}: {str(e)}")
+        run['last_error'] = str(e)
+    finally:
+        # Escribir lo pendiente antes de calcular y guardar el checkpoint
+        flush_results()
+    
+    # Fotos contiguas desde el inicio de la invocación con resultado escrito
+    processed = 0
+    while processed in outcomes and processed not in pending_photos.values():
+        photo = outcomes[processed]
+        run['status_counts'][photo['status']] = run['status_counts'].get(photo['status'], 0) + 1
+        if photo['status'] not in COMPLETED_STATUSES or photo['write_failed']:
+            run['errors'] += 1
+            if len(run['failed_keys']) < MAX_FAILED_KEYS_IN_CHECKPOINT:
+                run['failed_keys'].append(photo['s3_key'])
+        processed += 1
+    
+    # Actualizar la ejecución (checkpoint o cierre)
+    elapsed = time.time() - invocation_start
+    run['validated'] += processed
+    run['active_seconds'] = round(run['active_seconds'] + elapsed, 3)
+    if processed:
+        run['position'], run['last_key'], run['manifest_offset'] = listing['checkpoints'][processed - 1]
+    
+    if listing.get('exhausted') and processed == len(listing['checkpoints']):
+        run['status'] = 'COMPLETED'
+        message = 'Bulk validation completed'
+    elif processed == 0:
+        # Ninguna foto avanzó en esta invocación: evitar un bucle de re-invocaciones
+        run['status'] = 'FAILED'
+        message = 'Bulk validation stopped: no progress in this invocation'
+    else:
+        run['status'] = 'IN_PROGRESS'
+        message = 'Bulk validation checkpointed, continuing in a new invocation'
+    
+    if save_bulk_run(run) and run['status'] == 'IN_PROGRESS':
+        continue_bulk_run_async(run, context)
+    
+    throughput = processed / elapsed if elapsed > 0 else 0
+    stage_latency_ms = {stage: latency_percentiles(samples) for stage, samples in stage_samples.items() if samples}
+    logger.info(f"📊 BULK {run['run_id']}: {processed} photos in {elapsed:.1f}s ({throughput:.2f} photos/s), "
+                f"{run['validated']} total, {run['errors']} errors → {run['status']}")
+    
+    return {
+        'statusCode': 200,
+        'body': json.dumps({
+            'message': message,
+            'run_id': run['run_id'],
+            'run_status': run['status'],
+            'invocation': {
+                'photos': processed,
+                'elapsed_seconds': round(elapsed, 3),
+                'throughput_photos_per_second': round(throughput, 2),
+                'stage_latency_ms': stage_latency_ms
+            },
+            'validated': run['validated'],
+            'errors': run['errors'],
+            'status_counts': run['status_counts'],
+            'run_throughput_photos_per_second': round(run['validated'] / run['active_seconds'], 2) if run['active_seconds'] else 0,
+            'failed_keys': run['failed_keys']
+        })
+    }
+
+def validate_bulk_photo(s3_key: str) -> dict:
+    """
+    Validar una foto del lote en modo HYBRID sin escribir su resultado: el
+    item queda en 'items' para el siguiente BatchWriteItem y lo que debe
+    ejecutarse tras escribirlo (caché de resultados) en 'post_write'
+    """
+    stage_timings = {}
+    pending = {}
+    post_write = {}
+    with deferred_result_writes(pending, post_write):
+        result = validate_hybrid_mode(s3_key, time.time(), stage_timings)
+    return {'result': result, 'items': list(pending.values()), 'post_write': post_write, 'stage_timings': stage_timings}
+
+def iter_bulk_photo_keys(run: dict, listing: dict):
+    """
+    Keys pendientes de la ejecución a partir de su checkpoint. listing se
+    actualiza con 'checkpoints' (por key despachada, el checkpoint que la da
+    por procesada: position, last_key y manifest_offset, bytes del manifiesto
+    ya leídos) y 'exhausted'
+    """
+    listing['checkpoints'] = []
+    listing['exhausted'] = False
+    position = run['position']
+    if run['manifest_key']:
+        keys = iter_manifest_keys(run['manifest_key'], run['manifest_offset'])
+    else:
+        keys = ((s3_key, 0) for s3_key in iter_user_photo_keys(run['prefix'], run['last_key'] or run['start_after']))
+    
+    for s3_key, manifest_offset in keys:
+        position += 1
+        listing['checkpoints'].append((position, s3_key, manifest_offset))
+        yield s3_key
+    listing['exhausted'] = True
+
+def iter_manifest_keys(manifest_key: str, offset: int = 0):
+    """
+    Keys de un manifiesto del bucket de fotos (una por línea; en CSV la primera
+    columna), leído en streaming desde el byte offset (GET con Range al
+    continuar un checkpoint, sin releer lo ya procesado). Se ignoran líneas
+    vacías y comentarios (#).
+    
+    Retorna pares (key, offset de la línea siguiente)
+    """
+    params = {'Bucket': os.environ['USER_PHOTOS_BUCKET'], 'Key': manifest_key}
+    if offset:
+        params['Range'] = f'bytes={offset}-'
+    try:
+        response = s3_client.get_object(**params)
+    except Exception as e:
+        # El checkpoint quedó justo al final del manifiesto: no queda nada
+        if offset and getattr(e, 'response', {}).get('Error', {}).get('Code') == 'InvalidRange':
+            return
+        raise
+    
+    for line in iter_raw_lines(response['Body']):
+        offset += len(line)
+        s3_key = line.decode('utf-8').split(',')[0].strip()
+        if not s3_key or s3_key.startswith('#'):
+            continue
+        yield s3_key, offset
+
+def iter_raw_lines(body, chunk_size: int = 64 * 1024):
+    """Líneas de un StreamingBody con su salto de línea (para contar bytes exactos)"""
+    pending = b''
+    for chunk in body.iter_chunks(chunk_size):
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + b'\n'
+    if pending:
+        yield pending
+
+def iter_user_photo_keys(prefix: str = '', start_after: str = None):
+    """Listar las fotos del bucket de usuarios página a página (StartAfter como checkpoint)"""
+    params = {'Bucket': os.environ['USER_PHOTOS_BUCKET'], 'Prefix': prefix or ''}
+    if start_after:
+        params['StartAfter'] = start_after
+    
+    while True:
+        response = s3_client.list_objects_v2(**params)
+        for obj in response.get('Contents', []):
+            if obj['Key'].lower().endswith(IMAGE_SUFFIXES):
+                yield obj['Key']
+        if not response.get('IsTruncated'):
+            return
+        params['ContinuationToken'] = response['NextContinuationToken']
+
+def record_stage(stage_timings: dict, stage: str, started: float) -> float:
+    """Guardar la duración (ms) de una etapa si se piden tiempos; retorna el instante actual"""
+    now = time.perf_counter()
+    if stage_timings is not None:
+        stage_timings[stage] = (now - started) * 1000
+    return now
+
+def latency_percentiles(samples: list) -> dict:
+    """p50/p90/p99/max por rango más cercano (ms)"""
+    ordered = sorted(samples)
+    
+    def percentile(p: float) -> float:
+        return round(ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)], 1)
+    
+    return {
+        'count': len(ordered),
+        'p50': percentile(50),
+        'p90': percentile(90),
+        'p99': percentile(99),
+        'max': round(ordered[-1], 1)
+    }
+
+def new_bulk_run(prefix: str, manifest_key: str, start_after: str, max_workers: int) -> dict:
+    """Estado inicial de una validación masiva con checkpoint"""
+    timestamp = datetime.utcnow()
+    return {
+        'run_id': f"bulk_{timestamp.strftime('%Y%m%d_%H%M%S')}_{str(uuid.uuid4())[:8]}",
+        'action': 'hybrid_bulk',
+        'status': 'IN_PROGRESS',
+        'prefix': prefix or '',
+        'manifest_key': manifest_key,
+        'start_after': start_after,
+        'max_workers': max_workers,
+        'position': 0,
+        'manifest_offset': 0,
+        'last_key': None,
+        'validated': 0,
+        'errors': 0,
+        'status_counts': {},
+        'failed_keys': [],
+        'active_seconds': 0,
+        'invocations': 1,
+        'started_at': timestamp.isoformat()
+    }
+
+def save_bulk_run(run: dict) -> bool:
+    """Guardar checkpoint de la validación masiva (expira a los 30 días)"""
+    if runs_table is None:
+        logger.warning("VALIDATION_RUNS_TABLE not configured, checkpoint not saved")
+        return False
+    run['updated_at'] = datetime.utcnow().isoformat()
+    run['ttl'] = int(time.time()) + (30 * 24 * 60 * 60)
+    try:
+        runs_table.put_item(Item={key: value for key, value in run.items() if value is not None})
+        return True
+    except Exception as e:
+        logger.error(f"Error saving bulk run {run['run_id']}: {str(e)}")
+        return False
+
+def get_bulk_run(run_id: str) -> dict:
+    """Leer una validación masiva y normalizar los números de DynamoDB (Decimal → int/float)"""
+    run = runs_table.get_item(Key={'run_id': run_id}).get('Item')
+    if not run:
+        return None
+    for field in ('max_workers', 'position', 'manifest_offset', 'validated', 'errors', 'invocations', 'ttl'):
+        run[field] = int(run.get(field, 0))
+    run['active_seconds'] = float(run.get('active_seconds', 0))
+    run['status_counts'] = {status: int(count) for status, count in run.get('status_counts', {}).items()}
+    for field in ('manifest_key', 'start_after', 'last_key'):
+        run.setdefault(field, None)
+    run.setdefault('prefix', '')
+    run.setdefault('failed_keys', [])
+    return run
+
+def continue_bulk_run_async(run: dict, context):
+    """Re-invocar esta misma Lambda (asíncrono) para continuar la validación masiva"""
+    if context is None:
+        logger.warning(f"No Lambda context, bulk run {run['run_id']} must be resumed manually")
+        return
+    lambda_client.invoke(
+        FunctionName=context.invoked_function_arn,
+        InvocationType='Event',
+        Payload=json.dumps({'validation_mode': 'HYBRID_BULK', 'run_id': run['run_id']})
+    )
+    logger.info(f"⏩ Bulk run {run['run_id']} checkpointed at {run['last_key']}, re-invoked asynchronously")
+
+# ======================================================================
+# Implementación asyncio (ASYNC_VALIDATION=true)
+# Mismos pasos, estados y campos que la síncrona; las llamadas bloqueantes
+# (boto3, Pillow) corren en async_executor y los pasos independientes se
+# solapan: la foto de usuario se descarga y preprocesa mientras se buscan los
+# metadatos y se descarga el documento.
+# ======================================================================
+
+async def run_blocking(func, *args):
+    """Ejecutar una llamada bloqueante en el pool compartido sin bloquear el event loop"""
+    return await asyncio.get_running_loop().run_in_executor(async_executor, func, *args)
+
+async def prepare_user_image_async(comparison_id: str, user_image_key: str, validation_mode: str,
+                                   target: str, threshold: float, start_time: float) -> tuple:
+    """
+    Descargar (o resolver desde la caché de resultados) y preprocesar la foto de
+    usuario: (cache_key, resultado en caché o None, bytes procesados, error)
+    """
+    cache_key, cached, user_image_bytes = await run_blocking(
+        fetch_user_image, comparison_id, user_image_key, validation_mode, target, threshold, start_time
+    )
+    if cached:
+        return cache_key, cached, None, None
+    processed_bytes, error = await run_blocking(image_processor.process_image, user_image_bytes, user_image_key)
+    return cache_key, None, processed_bytes, error
+
+async def fetch_document_by_image_key_async(document_image_key: str) -> tuple:
+    """Metadatos (opcionales) y bytes del documento: (metadata, bytes)"""
+    document_metadata = await run_blocking(get_document_by_s3_key, document_image_key)
+    document_image_bytes = await run_blocking(load_document_image, document_image_key, document_metadata)
+    return document_metadata, document_image_bytes
+
+async def fetch_document_by_id_async(target_document_id: str) -> tuple:
+    """Metadatos y bytes del documento objetivo: (None, None) si no existe"""
+    target_document = await run_blocking(get_document_by_id, target_document_id)
+    if not target_document:
+        return None, None
+    document_image_bytes = await run_blocking(load_document_image, target_document['s3_key'], target_document)
+    return target_document, document_image_bytes
+
+async def validate_direct_compare_by_image_key_async(user_image_key: str, document_image_key: str, start_time: float) -> dict:
+    """
+    Modo directo por document_image_key con la foto de usuario y el documento
+    obtenidos en paralelo
+    """
+    comparison_id = generate_comparison_id()
+    logger.info(f"🎯⚡ ASYNC DIRECT COMPARE BY IMAGE KEY: {user_image_key} vs {document_image_key}")
+    
+    try:
+        # STEP 1-4: Foto de usuario (descarga + preprocessing) y documento a la vez
+        user_outcome, document_outcome = await asyncio.gather(
+            prepare_user_image_async(
+                comparison_id, user_image_key, 'DIRECT_COMPARE_BY_IMAGE_KEY', document_image_key, DIRECT_COMPARE_THRESHOLD, start_time
+            ),
+            fetch_document_by_image_key_async(document_image_key),
+            return_exceptions=True
+        )
+        # Los errores se evalúan en el mismo orden que en la versión síncrona
+        if isinstance(user_outcome, Exception):
+            raise user_outcome
+        
+        cache_key, cached, processed_user_bytes, error = user_outcome
+        if cached:
+            return cached
+        
+        if isinstance(document_outcome, Exception):
+            return await run_blocking(functools.partial(
+                store_validation_result,
+                comparison_id, user_image_key, start_time,
+                status='DOCUMENT_IMAGE_NOT_FOUND',
+                validation_mode='DIRECT_COMPARE_BY_IMAGE_KEY',
+                document_image_key=document_image_key,
+                confidence_score=0,
+                error=f'Failed to download document image: {str(document_outcome)}'
+            ))
+        
+        if error:
+            return await run_blocking(functools.partial(
+                store_validation_result,
+                comparison_id, user_image_key, start_time,
+                status='USER_IMAGE_PROCESSING_ERROR',
+                validation_mode='DIRECT_COMPARE_BY_IMAGE_KEY',
+                document_image_key=document_image_key,
+                confidence_score=0,
+                error=f'User image preprocessing failed: {error}'
+            ))
+        
+        # STEP 5-8: Calidad, CompareFaces y almacenamiento
+        document_metadata, document_image_bytes = document_outcome
+        result = await run_blocking(
+            compare_and_store_by_image_key,
+            comparison_id, user_image_key, document_image_key, document_metadata,
+            processed_user_bytes, document_image_bytes, start_time
+        )
+        return await run_blocking(remember_result, cache_key, user_image_key, result)
+        
+    except Exception as e:
+        logger.error(f"Error in async direct comparison by image key {user_image_key}: {str(e)}")
+        return await run_blocking(functools.partial(
+            store_validation_result,
+            comparison_id, user_image_key, start_time,
+            status='ERROR',
+            validation_mode='DIRECT_COMPARE_BY_IMAGE_KEY',
+            document_image_key=document_image_key,
+            confidence_score=0,
+            error=str(e)
+        ))
+
+async def validate_direct_compare_by_document_id_async(user_image_key: str, target_document_id: str, start_time: float) -> dict:
+    """
+    Modo directo por target_document_id con la foto de usuario y el documento
+    obtenidos en paralelo
+    """
+    comparison_id = generate_comparison_id()
+    logger.info(f"🎯⚡ ASYNC DIRECT COMPARE BY DOCUMENT ID: {user_image_key} vs {target_document_id}")
+    
+    try:
+        # STEP 1-4: Foto de usuario (descarga + preprocessing) y documento a la vez
+        user_outcome, document_outcome = await asyncio.gather(
+            prepare_user_image_async(
+                comparison_id, user_image_key, 'DIRECT_COMPARE_BY_DOCUMENT_ID', target_document_id, DIRECT_COMPARE_THRESHOLD, start_time
+            ),
+            fetch_document_by_id_async(target_document_id),
+            return_exceptions=True
+        )
+        # Los errores se evalúan en el mismo orden que en la versión síncrona
+        if isinstance(user_outcome, Exception):
+            raise user_outcome
+        
+        cache_key, cached, processed_user_bytes, error = user_outcome
+        if cached:
+            return cached
+        
+        # get_document_by_id no lanza: una excepción aquí es de la descarga
+        if isinstance(document_outcome, Exception):
+            return await run_blocking(functools.partial(
+                store_validation_result,
+                comparison_id, user_image_key, start_time,
+                status='TARGET_DOCUMENT_ACCESS_ERROR',
+                validation_mode='DIRECT_COMPARE_BY_DOCUMENT_ID',
+                target_document_id=target_document_id,
+                confidence_score=0,
+                error=f'Failed to download target document: {str(document_outcome)}'
+            ))
+        
+        target_document, document_image_bytes = document_outcome
+        if not target_document:
+            return await run_blocking(functools.partial(
+                store_validation_result,
+                comparison_id, user_image_key, start_time,
+                status='TARGET_DOCUMENT_NOT_FOUND',
+                validation_mode='DIRECT_COMPARE_BY_DOCUMENT_ID',
+                target_document_id=target_document_id,
+                confidence_score=0,
+                error=f'Document not found: {target_document_id}'
+            ))
+        
+        if error:
+            return await run_blocking(functools.partial(
+                store_validation_result,
+                comparison_id, user_image_key, start_time,
+                status='USER_IMAGE_PROCESSING_ERROR',
+                validation_mode='DIRECT_COMPARE_BY_DOCUMENT_ID',
+                target_document_id=target_document_id,
+                confidence_score=0,
+                error=f'User image preprocessing failed: {error}'
+            ))
+        
+        # STEP 5-8: Calidad, CompareFaces y almacenamiento
+        result = await run_blocking(
+            compare_and_store_by_document_id,
+            comparison_id, user_image_key, target_document,
+            processed_user_bytes, document_image_bytes, start_time
+        )
+        return await run_blocking(remember_result, cache_key, user_image_key, result)
+        
+    except Exception as e:
+        logger.error(f"Error in async direct comparison by document ID {user_image_key}: {str(e)}")
+        return await run_blocking(functools.partial(
+            store_validation_result,
+            comparison_id, user_image_key, start_time,
+            status='ERROR',
+            validation_mode='DIRECT_COMPARE_BY_DOCUMENT_ID',
+            target_document_id=target_document_id,
+            confidence_score=0,
+            error=str(e)
+        ))
+
+async def validate_hybrid_mode_async(s3_key: str, start_time: float) -> dict:
+    """
+    MODO HÍBRIDO con asyncio: los candidatos se verifican como tareas del
+    event loop (metadata → documento → CompareFaces por candidato)
+    """
+    comparison_id = generate_comparison_id()
+    logger.info(f"🔍⚡ ASYNC HYBRID MODE: {s3_key}")
+    
+    try:
+        # STEP 1-2: Descarga (o resultado en caché) y preprocessing de la foto de usuario
+        cache_key, cached, processed_bytes, error = await prepare_user_image_async(
+            comparison_id, s3_key, 'HYBRID', '', HYBRID_SEARCH_THRESHOLD, start_time
+        )
+        if cached:
+            return cached
+        if error:
+            return await run_blocking(functools.partial(
+                store_validation_result,
+                comparison_id, s3_key, start_time,
+                status='PROCESSING_ERROR',
+                validation_mode='HYBRID',
+                confidence_score=0,
+                error=f'Preprocessing failed: {error}'
+            ))
+        
+        # STEP 3-4: Calidad, cara y búsqueda en la colección
+        result, face_matches = await run_blocking(
+            screen_and_search_hybrid, comparison_id, s3_key, processed_bytes, start_time
+        )
+        if not result:
+            # STEP 5: CompareFaces con mejores candidatos (concurrentes, con deadline)
+            candidates = face_matches[:3]
+            best_match, candidates_evaluated = await evaluate_candidates_async(candidates, processed_bytes)
+            
+            # STEP 6-7: Determinar y almacenar resultado final
+            result = await run_blocking(
+                store_hybrid_result, comparison_id, s3_key, start_time, best_match, candidates_evaluated, len(candidates)
+            )
+        return await run_blocking(remember_result, cache_key, s3_key, result)
+        
+    except Exception as e:
+        logger.error(f"Error in async hybrid validation {s3_key}: {str(e)}")
+        return await run_blocking(functools.partial(
+            store_validation_result,
+            comparison_id, s3_key, start_time,
+            status='ERROR',
+            validation_mode='HYBRID',
+            confidence_score=0,
+            error=str(e)
+        ))
+
+async def evaluate_candidates_async(face_matches: list, processed_bytes: bytes) -> tuple:
+    """
+    Equivalente asyncio de evaluate_candidates_parallel: los candidatos que no
+    terminan antes de HYBRID_CANDIDATES_TIMEOUT_SECONDS se descartan.
+    
+    Retorna (mejor_match o None, candidatos completados)
+    """
+    if not face_matches:
+        return None, 0
+    
+    tasks = [
+        asyncio.ensure_future(run_blocking(evaluate_candidate, face_match, processed_bytes))
+        for face_match in face_matches
+    ]
+    done, not_done = await asyncio.wait(tasks, timeout=HYBRID_CANDIDATES_TIMEOUT_SECONDS)
+    
+    if not_done:
+        logger.warning(f"{len(not_done)} candidates did not finish within {HYBRID_CANDIDATES_TIMEOUT_SECONDS}s")
+        for task in not_done:
+            task.cancel()
+    
+    # Recorrer en el orden de la búsqueda para desempatar igual que la versión síncrona
+    candidates = [task.result() for task in tasks if task in done and not task.exception()]
+    return pick_best_candidate(candidates), len(done)
+
+# Implementación asyncio de cada modo de validación
+ASYNC_VALIDATORS = {
+    validate_direct_compare_by_image_key: validate_direct_compare_by_image_key_async,
+    validate_direct_compare_by_document_id: validate_direct_compare_by_document_id_async,
+    validate_hybrid_mode: validate_hybrid_mode_async,
+}
+
+def run_validation(validator, *args) -> dict:
+    """
+    Ejecutar un modo de validación con la implementación seleccionada por
+    ASYNC_VALIDATION (un event loop por validación; seguro desde los hilos
+    del lote SQS)
+    """
+    if ASYNC_VALIDATION:
+        return asyncio.run(ASYNC_VALIDATORS[validator](*args))
+    return validator(*args)
+
+def user_face_missing(comparison_result: dict, user_image_bytes: bytes) -> bool:
+    """
+    CompareFaces no encontró cara en la foto de usuario (imagen origen).
+    CompareFaces responde InvalidParameterException tanto si falta la cara en
+    el origen como en el destino, normalmente sin decir cuál ("Request has
+    invalid parameters"). En modo lean no hubo DetectFaces previo: se
+    distingue con un único DetectFaces de la foto de usuario
+    """
+    if comparison_result.get('error_type') == 'NO_FACE_IN_SOURCE':
+        return True
+    if comparison_result['success']:
+        return not comparison_result['source_face_detected']
+    if LEAN_VALIDATION and comparison_result.get('error_type') in INVALID_COMPARE_ERROR_TYPES:
+        face_detection = rekognition_client.detect_faces(user_image_bytes)
+        return face_detection['success'] and face_detection['face_count'] == 0
+    return False
+
+def check_image_quality(image_bytes: bytes) -> dict:
+    """
+    Pre-filtro local de calidad de la foto de usuario.
+    Retorna None si pasa (o está desactivado); si no, los campos de error y scores
+    """
+    if not IMAGE_QUALITY_GATE:
+        return None
+    try:
+        quality = image_processor.assess_quality(image_bytes)
+    except Exception as e:
+        # El pre-filtro nunca debe bloquear la validación por sí mismo
+        logger.warning(f"Quality check skipped: {str(e)}")
+        return None
+    if quality['passed']:
+        return None
+    return {
+        'error': f'Image quality check failed: {"; ".join(quality["reasons"])}',
+        'quality_scores': json.dumps({k: v for k, v in quality.items() if k not in ('passed', 'reasons')})
+    }
+
+def fetch_user_image(comparison_id: str, user_image_key: str, validation_mode: str,
+                     target: str, threshold: float, start_time: float) -> tuple:
+    """
+    Foto de usuario consultando antes la caché de resultados con su ETag. El
+    ETag cambia si cambia el contenido, así que sirve de huella de la foto sin
+    calcular un hash. Con caché, el ETag se lee con HeadObject: un acierto
+    cuesta solo ese round trip (sin GetObject) y un fallo paga HeadObject +
+    GetObject. Sin caché se hace solo el GET.
+    
+    Retorna (cache_key, resultado en caché o None, bytes de la foto o None)
+    """
+    if result_cache:
+        etag = user_photo_etag(user_image_key)
+        cached = find_cached_result(
+            comparison_id, user_image_key,
+            ValidationResultCache.make_key(etag, validation_mode, target, threshold), start_time
+        )
+        if cached:
+            return None, cached, None
+    
+    response = s3_client.get_object(Bucket=os.environ['USER_PHOTOS_BUCKET'], Key=user_image_key)
+    # Clave a partir del ETag del GET: es la del contenido validado aunque la foto cambie tras el HEAD
+    cache_key = ValidationResultCache.make_key(response['ETag'].strip('"'), validation_mode, target, threshold)
+    user_image_bytes = response['Body'].read()
+    logger.info(f"Downloaded user photo {user_image_key}: {len(user_image_bytes)} bytes")
+    return cache_key, None, user_image_bytes
+
+def user_photo_etag(user_image_key: str) -> str:
+    """ETag de la foto de usuario (HeadObject, sin descargar el cuerpo)"""
+    response = s3_client.head_object(Bucket=os.environ['USER_PHOTOS_BUCKET'], Key=user_image_key)
+    return response['ETag'].strip('"')
+
+def find_cached_result(comparison_id: str, user_image_key: str, cache_key: tuple, start_time: float) -> dict:
+    """
+    Resultado en caché para este contenido y esta petición (o None).
+    Un reintento de la misma foto devuelve el resultado original tal cual; la
+    misma foto subida con otra key se guarda como comparación nueva que
+    referencia la original (reused_from). Ninguno llama a Rekognition.
+    """
+    if not result_cache:
+        return None
+    try:
+        entry = result_cache.get(cache_key)
+    except Exception as e:
+        logger.warning(f"Result cache lookup failed for {user_image_key}: {str(e)}")
+        return None
+    if not entry:
+        return None
+    
+    previous = entry['result']
+    if entry['user_image_key'] == user_image_key:
+        logger.info(f"⚡ Result cache hit for {user_image_key}: {previous['comparison_id']}")
+        return {**previous, 'cache_hit': True}
+    
+    logger.info(f"♻️  Reusing result {previous['comparison_id']} for identical photo {user_image_key}")
+    fields = {k: v for k, v in previous.items() if k not in ('comparison_id', 'processing_time_ms')}
+    return store_validation_result(
+        comparison_id, user_image_key, start_time,
+        reused_from=previous['comparison_id'],
+        **fields
+    )
+
+def remember_result(cache_key: tuple, user_image_key: str, result: dict) -> dict:
+    """
+    Guardar el resultado en la caché si es determinista (no crítico), una
+    vez escrito en la tabla de resultados. Un resultado degradado (candidatos
+    descartados por el deadline) no se guarda
+    """
+    degraded = result.get('candidates_evaluated', 0) < result.get('candidates_searched', 0)
+    if result_cache and result.get('status') in CACHEABLE_STATUSES and not degraded:
+        def cache_result():
+            try:
+                result_cache.put(cache_key, user_image_key, result)
+            except Exception as e:
+                logger.warning(f"Could not cache result {result.get('comparison_id')}: {str(e)}")
+        if getattr(deferred_writes, 'pending', None) is None:
+            result_sink.when_written(result['comparison_id'], cache_result)
+        elif deferred_writes.post_write is not None:
+            # El item aún no está en result_sink: quien abrió el bloque lo registra al añadirlo
+            deferred_writes.post_write.setdefault(result['comparison_id'], []).append(cache_result)
+    return result
+
+def load_document_image(s3_key: str, document_metadata: dict = None) -> bytes:
+    """
+    Obtener los bytes del documento para CompareFaces.
+    Se prefieren los derivados del indexador (DERIVED_BUCKET), pasando por la caché LRU del
+    contenedor: primero el recorte de la cara (face_crop_key), luego el
+    documento normalizado (normalized_key); si no hay, se descarga el original.
+    """
+    derived_keys = [
+        document_metadata.get(field)
+        for field in ('face_crop_key', 'normalized_key')
+        if document_metadata and document_metadata.get(field)
+    ]
+    
+    for derived_key in derived_keys:
+        cached = document_cache.get(derived_key)
+        if cached is not None:
+            logger.info(f"Document cache hit: {derived_key}")
+            return cached
+        try:
+            derived_bucket = DOCUMENTS_BUCKET if derived_key.startswith(LEGACY_DERIVED_PREFIX) else DERIVED_BUCKET
+            response = s3_client.get_object(Bucket=derived_bucket, Key=derived_key)
+            image_bytes = response['Body'].read()
+            document_cache.put(derived_key, image_bytes)
+            logger.info(f"Downloaded derived document {derived_key}: {len(image_bytes)} bytes")
+            return image_bytes
+        except Exception as e:
+            logger.warning(f"Derived document {derived_key} unavailable: {str(e)}")
+    
+    response = s3_client.get_object(Bucket=DOCUMENTS_BUCKET, Key=s3_key)
+    image_bytes = response['Body'].read()
+    logger.info(f"Downloaded document image {s3_key}: {len(image_bytes)} bytes")
+    return image_bytes
+
+def get_document_by_face_id(face_id: str) -> dict:
+    """Obtener metadatos de documento por face_id"""
+    try:
+        response = documents_table.query(
+            IndexName='face-id-index',
+            KeyConditionExpression='face_id = :face_id',
+            ExpressionAttributeValues={':face_id': face_id}
+        )
+        
+        if response['Items']:
+            return response['Items'][0]
+        return None
+        
+    except Exception as e:
+        logger.error(f"Error querying document by face_id {face_id}: {str(e)}")
+        return None
+
+def get_document_by_id(document_id: str) -> dict:
+    """Obtener metadatos de documento por document_id"""
     try:
         response = documents_table.get_item(
             Key={'document_id': document_id}
@@ -576,12 +1900,14 @@ def get_document_by_id(document_id: str) -> dict:
 
 def get_document_by_s3_key(s3_key: str) -> dict:
     """
-    NEW: Obtener metadatos de documento por s3_key
+    NEW: Obtener metadatos de documento por s3_key (query sobre s3-key-index)
     """
     try:
-        response = documents_table.scan(
-            FilterExpression='s3_key = :key',
-            ExpressionAttributeValues={':key': s3_key}
+        response = documents_table.query(
+            IndexName='s3-key-index',
+            KeyConditionExpression='s3_key = :key',
+            ExpressionAttributeValues={':key': s3_key},
+            Limit=1
         )
         
         if response['Items']:
@@ -640,56 +1966,69 @@ def extract_target_document_from_key(s3_key: str) -> str:
         logger.error(f"Error extracting target document from {s3_key}: {e}")
         return None
 
+@contextmanager
+def deferred_result_writes(pending: dict, post_write: dict = None):
+    """
+    Dentro del bloque, store_validation_result deja los items del hilo actual
+    en `pending` (comparison_id → item) en lugar de escribirlos; quien abre
+    el bloque los escribe después con BatchWriteItem. remember_result deja en
+    `post_write` (comparison_id → [callback]) lo que debe ejecutarse una vez
+    escrito cada item (sin post_write no se cachea)
+    """
+    previous = (getattr(deferred_writes, 'pending', None), getattr(deferred_writes, 'post_write', None))
+    deferred_writes.pending = pending
+    deferred_writes.post_write = post_write
+    try:
+        yield pending
+    finally:
+        deferred_writes.pending, deferred_writes.post_write = previous
+
 def store_validation_result(comparison_id: str, user_image_key: str, start_time: float, **kwargs) -> dict:
-    """Almacenar resultado de validación en DynamoDB"""
-    processing_time = (time.time() - start_time) * 1000
-    timestamp = datetime.utcnow().isoformat()
-    
-    ttl = int(time.time()) + (365 * 24 * 60 * 60)
-    
-    # Para DynamoDB: convertir floats a Decimal
-    processed_kwargs_for_db = {}
-    # Para respuesta JSON: mantener como float
-    processed_kwargs_for_response = {}
-    
-    for key, value in kwargs.items():
-        if isinstance(value, float):
-            processed_kwargs_for_db[key] = Decimal(str(value))
-            processed_kwargs_for_response[key] = value  # Mantener como float
-        else:
-            processed_kwargs_for_db[key] = value
-            processed_kwargs_for_response[key] = value
-    
-    # Item para DynamoDB (con Decimals)
-    item_for_db = {
+    """
+    Registrar el resultado de validación: el item queda en result_sink y se
+    escribe con BatchWriteItem al vaciarlo (antes de terminar la invocación).
+    Los campos se usan tal cual en la respuesta y en el item: los float se
+    serializan directamente para DynamoDB, sin convertirlos a Decimal.
+    """
+    item_for_response = {
         'comparison_id': comparison_id,
-        'timestamp': timestamp,
+        'processing_time_ms': int((time.time() - start_time) * 1000),
+        **kwargs
+    }
+    item_for_db = {
+        **item_for_response,
+        'timestamp': datetime.utcnow().isoformat(),
         'user_image_key': user_image_key,
-        'processing_time_ms': int(processing_time),
-        'ttl': ttl,
-        **processed_kwargs_for_db
+        'pipeline': 'async' if ASYNC_VALIDATION else 'sync',
+        'ttl': int(time.time()) + (365 * 24 * 60 * 60)
     }
     
-    # Item para respuesta JSON (con floats)
-    item_for_response = {
+    pending = getattr(deferred_writes, 'pending', None)
+    if pending is not None:
+        # Lo escribe quien abrió deferred_result_writes (un reintento reemplaza el item)
+        pending[comparison_id] = item_for_db
+    else:
+        result_sink.add(item_for_db)
+    return item_for_response
+
+def flush_stored_results(results: list) -> list:
+    """
+    Escribir los resultados pendientes de result_sink. Los de `results` que no
+    se pudieron guardar se sustituyen por STORAGE_ERROR (se reintentan)
+    """
+    failures = result_sink.flush()
+    return [
+        storage_error_result(result['comparison_id'], failures[result['comparison_id']])
+        if result.get('comparison_id') in failures else result
+        for result in results
+    ]
+
+def storage_error_result(comparison_id: str, error: str) -> dict:
+    return {
         'comparison_id': comparison_id,
-        'processing_time_ms': int(processing_time),
-        **processed_kwargs_for_response
+        'status': 'STORAGE_ERROR',
+        'error': error
     }
-    
-    try:
-        results_table.put_item(Item=item_for_db)
-        logger.info(f"Stored validation result: {comparison_id}")
-        
-        return item_for_response
-        
-    except Exception as e:
-        logger.error(f"Error storing result: {str(e)}")
-        return {
-            'comparison_id': comparison_id,
-            'status': 'STORAGE_ERROR',
-            'error': str(e)
-        }
 
 def generate_comparison_id() -> str:
     """Generar ID único para comparación"""
@@ -6,11 +6,12 @@ from aws_cdk import(
     aws_lambda as lambda_,
     aws_iam as iam,
     aws_s3_notifications as s3n,
+    aws_sqs as sqs,
+    aws_lambda_event_sources as lambda_event_sources,
     RemovalPolicy,
     Duration
 )
 from constructs import Construct
-import os
 
 class RekognitionStack(Stack):
     def __init__(self,scope:Construct, construct_id:str,**kwargs)->None:
@@ -19,6 +20,18 @@ class RekognitionStack(Stack):
         # Get validation mode from context or default to HYBRID
         validation_mode = self.node.try_get_context('validation_mode') or 'HYBRID'
         direct_compare_threshold = self.node.try_get_context('direct_compare_threshold') or '80.0'
+        indexing_max_workers = str(self.node.try_get_context('indexing_max_workers') or '8')
+        indexing_preprocess_workers = str(self.node.try_get_context('indexing_preprocess_workers') or '0')
+        image_target_dimension = str(self.node.try_get_context('image_target_dimension') or '1920')
+        image_quality_gate = str(self.node.try_get_context('image_quality_gate') or 'true')
+        rekognition_tps = str(self.node.try_get_context('rekognition_tps') or '')
+        validator_batch_size = int(self.node.try_get_context('validator_batch_size') or 10)
+        validator_batch_window_seconds = int(self.node.try_get_context('validator_batch_window_seconds') or 5)
+        validator_max_concurrency = int(self.node.try_get_context('validator_max_concurrency') or 5)
+        validator_max_workers = str(self.node.try_get_context('validator_max_workers') or '5')
+        lean_validation = str(self.node.try_get_context('lean_validation') or 'true')
+        async_validation = str(self.node.try_get_context('async_validation') or 'false')
+        result_cache_ttl_seconds = str(self.node.try_get_context('result_cache_ttl_seconds') or '3600')
 
 # ======================================================================
 #1. Bucket S3
@@ -32,6 +45,16 @@ class RekognitionStack(Stack):
             removal_policy=RemovalPolicy.RETAIN
         )
         
+        # Derivados del indexador (documento normalizado y recorte de la cara) en un
+        # bucket aparte: escribirlos en el de documentos dispararía su notificación
+        self.derived_documents_bucket = s3.Bucket(
+            self, 'DerivedDocumentsBucketBasic',
+            bucket_name=f'rekognition-basic-derived-documents-{self.account}-{self.region}',
+            encryption=s3.BucketEncryption.S3_MANAGED,
+            block_public_access=s3.BlockPublicAccess.BLOCK_ALL,
+            removal_policy=RemovalPolicy.RETAIN
+        )
+        
         self.user_photos_bucket=s3.Bucket(
             self,'UserPhotosBucketBasic',
             bucket_name=f'rekognition-basic-user-photos-{self.account}-{self.region}',
@@ -90,6 +113,48 @@ class RekognitionStack(Stack):
             )
         )
 
+        # Búsqueda directa por s3_key (evita scans completos de la tabla)
+        self.indexed_documents_table.add_global_secondary_index(
+            index_name='s3-key-index',
+            partition_key=dynamodb.Attribute(
+                name='s3_key',
+                type=dynamodb.AttributeType.STRING
+            )
+        )
+
+    #================================================
+        # Índice de hashes de contenido: documentos duplicados (SHA-256 y bandas
+        # del dHash) y resultados reutilizables de fotos de usuario (con TTL)
+        self.content_hashes_table=dynamodb.Table(
+            self,'ContentHashesTableBasic',
+            table_name='rekognition-basic-content-hashes',
+            partition_key=dynamodb.Attribute(
+                name='hash_key',
+                type=dynamodb.AttributeType.STRING
+            ),
+            sort_key=dynamodb.Attribute(
+                name='entry_id',
+                type=dynamodb.AttributeType.STRING
+            ),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute='ttl',
+            removal_policy=RemovalPolicy.DESTROY
+        )
+
+    #================================================
+        # Tabla de checkpoints para ejecuciones de indexación que abarcan varias invocaciones
+        self.indexing_runs_table=dynamodb.Table(
+            self,'IndexingRunsTableBasic',
+            table_name='rekognition-basic-indexing-runs',
+            partition_key=dynamodb.Attribute(
+                name='run_id',
+                type=dynamodb.AttributeType.STRING
+            ),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute='ttl',
+            removal_policy=RemovalPolicy.DESTROY
+        )
+
     #================================================
         # Tabla de resultados con campos adicionales para modo directo
         self.comparison_results_table=dynamodb.Table(
@@ -132,6 +197,32 @@ class RekognitionStack(Stack):
             )
         )
 
+    #================================================
+        # Cola entre el bucket de fotos y el validador: absorbe ráfagas de subidas
+        self.user_photos_dlq = sqs.Queue(
+            self, 'UserPhotosDLQBasic',
+            queue_name='rekognition-basic-user-photos-dlq',
+            retention_period=Duration.days(14)
+        )
+
+        self.user_photos_queue = sqs.Queue(
+            self, 'UserPhotosQueueBasic',
+            queue_name='rekognition-basic-user-photos-queue',
+            # >= 6x el timeout del validador (recomendación para event source mappings)
+            visibility_timeout=Duration.seconds(180),
+            dead_letter_queue=sqs.DeadLetterQueue(
+                max_receive_count=5,
+                queue=self.user_photos_dlq
+            )
+        )
+
+        # Eventos S3 que el indexador no pudo procesar tras los reintentos de Lambda
+        self.document_indexer_dlq = sqs.Queue(
+            self, 'DocumentIndexerDLQBasic',
+            queue_name='rekognition-basic-document-indexer-dlq',
+            retention_period=Duration.days(14)
+        )
+
     #======================== SHARED LAYER
         self.shared_layer = lambda_.LayerVersion(
             self, 'SharedLayer',
@@ -152,6 +243,11 @@ class RekognitionStack(Stack):
         )
 
     #======================== IAM ROLES
+        # ARN construido a partir del nombre para evitar dependencia circular rol ↔ función
+        indexer_function_arn = f'arn:aws:lambda:{self.region}:{self.account}:function:rekognition-basic-document-indexer'
+        validator_function_arn = f'arn:aws:lambda:{self.region}:{self.account}:function:rekognition-basic-user-validator'
+        validator_bulk_function_arn = f'arn:aws:lambda:{self.region}:{self.account}:function:rekognition-basic-user-validator-bulk'
+
         self.indexer_role=iam.Role(
             self,'IndexerLambdaRoleBasic',
             assumed_by=iam.ServicePrincipal('lambda.amazonaws.com'),
@@ -186,15 +282,56 @@ class RekognitionStack(Stack):
                             ],
                             resources=[f'{self.documents_bucket.bucket_arn}/*']
                         ),
+                        # Derivados generados por el indexador (documentos normalizados y recortes)
+                        iam.PolicyStatement(
+                            effect=iam.Effect.ALLOW,
+                            actions=[
+                                's3:PutObject',
+                                's3:DeleteObject'
+                            ],
+                            resources=[f'{self.derived_documents_bucket.bucket_arn}/*']
+                        ),
                         iam.PolicyStatement(
                             effect=iam.Effect.ALLOW,
                             actions=[
                                 'dynamodb:PutItem',
                                 'dynamodb:GetItem',
                                 'dynamodb:UpdateItem',
+                                'dynamodb:Query',
                                 'dynamodb:Scan'
                             ],
-                            resources=[self.indexed_documents_table.table_arn]
+                            resources=[
+                                self.indexed_documents_table.table_arn,
+                                f'{self.indexed_documents_table.table_arn}/index/*'
+                            ]
+                        ),
+                        iam.PolicyStatement(
+                            effect=iam.Effect.ALLOW,
+                            actions=[
+                                'dynamodb:PutItem',
+                                'dynamodb:GetItem',
+                                'dynamodb:Scan'
+                            ],
+                            resources=[self.indexing_runs_table.table_arn]
+                        ),
+                        iam.PolicyStatement(
+                            effect=iam.Effect.ALLOW,
+                            actions=[
+                                'dynamodb:Query',
+                                'dynamodb:BatchWriteItem'
+                            ],
+                            resources=[self.content_hashes_table.table_arn]
+                        ),
+                        # Auto re-invocación para continuar ejecuciones con checkpoint
+                        iam.PolicyStatement(
+                            effect=iam.Effect.ALLOW,
+                            actions=[
+                                'lambda:InvokeFunction'
+                            ],
+                            resources=[
+                                indexer_function_arn,
+                                f'{indexer_function_arn}:*'
+                            ]
                         )
                     ]
                 )
@@ -237,13 +374,15 @@ class RekognitionStack(Stack):
                             ],
                             resources=[
                                 f'{self.user_photos_bucket.bucket_arn}/*',
-                                f'{self.documents_bucket.bucket_arn}/*'
+                                f'{self.documents_bucket.bucket_arn}/*',
+                                f'{self.derived_documents_bucket.bucket_arn}/*'
                             ]
                         ),
                         iam.PolicyStatement(
                             effect=iam.Effect.ALLOW,
                             actions=[
                                 'dynamodb:PutItem',
+                                'dynamodb:BatchWriteItem',
                                 'dynamodb:GetItem',
                                 'dynamodb:Query',
                                 'dynamodb:Scan'
@@ -252,7 +391,30 @@ class RekognitionStack(Stack):
                                 self.comparison_results_table.table_arn,
                                 f"{self.comparison_results_table.table_arn}/index/*",
                                 self.indexed_documents_table.table_arn,
-                                f'{self.indexed_documents_table.table_arn}/index/*'
+                                f'{self.indexed_documents_table.table_arn}/index/*',
+                                self.content_hashes_table.table_arn
+                            ]
+                        ),
+                        # Checkpoints de las validaciones masivas (HYBRID_BULK)
+                        iam.PolicyStatement(
+                            effect=iam.Effect.ALLOW,
+                            actions=[
+                                'dynamodb:PutItem',
+                                'dynamodb:GetItem'
+                            ],
+                            resources=[self.indexing_runs_table.table_arn]
+                        ),
+                        # Auto re-invocación para continuar validaciones masivas con checkpoint
+                        iam.PolicyStatement(
+                            effect=iam.Effect.ALLOW,
+                            actions=[
+                                'lambda:InvokeFunction'
+                            ],
+                            resources=[
+                                validator_function_arn,
+                                f'{validator_function_arn}:*',
+                                validator_bulk_function_arn,
+                                f'{validator_bulk_function_arn}:*'
                             ]
                         )
                     ]
@@ -287,7 +449,8 @@ class RekognitionStack(Stack):
                             ],
                             resources=[
                                 self.indexed_documents_table.table_arn,
-                                self.comparison_results_table.table_arn
+                                self.comparison_results_table.table_arn,
+                                self.content_hashes_table.table_arn
                             ]
                         )
                     ]
@@ -305,17 +468,55 @@ class RekognitionStack(Stack):
             role=self.indexer_role,
             timeout=Duration.minutes(5),
             memory_size=1024,
+            # Eventos S3 asíncronos: 2 reintentos y después a la DLQ
+            retry_attempts=2,
+            dead_letter_queue=self.document_indexer_dlq,
             layers=[
                 self.shared_layer       
             ],
             environment={
                 'COLLECTION_ID':'document-faces-basic-collection',
                 'INDEXED_DOCUMENTS_TABLE':self.indexed_documents_table.table_name,
-                'DOCUMENTS_BUCKET':self.documents_bucket.bucket_name
+                'DOCUMENTS_BUCKET':self.documents_bucket.bucket_name,
+                'INDEXING_MAX_WORKERS': indexing_max_workers,
+                'INDEXING_PREPROCESS_WORKERS': indexing_preprocess_workers,
+                'INDEXING_RUNS_TABLE': self.indexing_runs_table.table_name,
+                'CONTENT_HASHES_TABLE': self.content_hashes_table.table_name,
+                'NEAR_DUPLICATE_MAX_DISTANCE': '-1',
+                'INDEXING_CHECKPOINT_MARGIN_SECONDS': '60',
+                'DERIVED_BUCKET': self.derived_documents_bucket.bucket_name,
+                'IMAGE_TARGET_DIMENSION': image_target_dimension,
+                'IMAGE_QUALITY_GATE': image_quality_gate,
+                'REKOGNITION_TPS': rekognition_tps
             }
         )
 
         # Enhanced user validator with dual mode support
+        validator_environment = {
+            'COLLECTION_ID':'document-faces-basic-collection',
+            'COMPARISON_RESULTS_TABLE':self.comparison_results_table.table_name,
+            'INDEXED_DOCUMENTS_TABLE':self.indexed_documents_table.table_name,
+            'DOCUMENTS_BUCKET': self.documents_bucket.bucket_name,
+            'DERIVED_BUCKET': self.derived_documents_bucket.bucket_name,
+            'USER_PHOTOS_BUCKET': self.user_photos_bucket.bucket_name,
+            # NEW: Validation mode configuration
+            'VALIDATION_MODE': validation_mode,
+            'DIRECT_COMPARE_THRESHOLD': direct_compare_threshold,
+            'VALIDATION_MAX_WORKERS': validator_max_workers,
+            'BATCH_COMPARE_MAX_TARGETS': '50',
+            'VALIDATION_RUNS_TABLE': self.indexing_runs_table.table_name,
+            'BULK_CHECKPOINT_MARGIN_SECONDS': '15',
+            'HYBRID_CANDIDATES_TIMEOUT_SECONDS': '10',
+            'LEAN_VALIDATION': lean_validation,
+            'ASYNC_VALIDATION': async_validation,
+            'CONTENT_HASHES_TABLE': self.content_hashes_table.table_name,
+            'RESULT_CACHE_TTL_SECONDS': result_cache_ttl_seconds,
+            'RESULT_CACHE_MAX_ENTRIES': '1024',
+            'DOCUMENT_CACHE_MAX_MB': '64',
+            'IMAGE_TARGET_DIMENSION': image_target_dimension,
+            'IMAGE_QUALITY_GATE': image_quality_gate,
+            'REKOGNITION_TPS': rekognition_tps
+        }
         self.user_validator=lambda_.Function(
             self,'UserValidatorBasic',
             function_name='rekognition-basic-user-validator',
@@ -328,16 +529,36 @@ class RekognitionStack(Stack):
             layers=[
                 self.shared_layer       
             ],
-            environment={
-                'COLLECTION_ID':'document-faces-basic-collection',
-                'COMPARISON_RESULTS_TABLE':self.comparison_results_table.table_name,
-                'INDEXED_DOCUMENTS_TABLE':self.indexed_documents_table.table_name,
-                'DOCUMENTS_BUCKET': self.documents_bucket.bucket_name,
-                'USER_PHOTOS_BUCKET': self.user_photos_bucket.bucket_name,
-                # NEW: Validation mode configuration
-                'VALIDATION_MODE': validation_mode,
-                'DIRECT_COMPARE_THRESHOLD': direct_compare_threshold
-            }
+            environment=validator_environment
+        )
+
+        # Mismo código para HYBRID_BULK: con 15 minutos cada invocación procesa fotos
+        # hasta BULK_CHECKPOINT_MARGIN_SECONDS antes del final (con 30s solo ~15s).
+        # Función aparte para no alargar el timeout (ni la visibilidad SQS) del validador
+        self.user_validator_bulk=lambda_.Function(
+            self,'UserValidatorBulkBasic',
+            function_name='rekognition-basic-user-validator-bulk',
+            runtime=lambda_.Runtime.PYTHON_3_11,
+            handler='handler.lambda_handler',
+            code=lambda_.Code.from_asset('functions/user_validator'),
+            role=self.validator_role,
+            timeout=Duration.minutes(15),
+            memory_size=512,
+            layers=[
+                self.shared_layer
+            ],
+            environment=validator_environment
+        )
+
+        # Lotes desde SQS con reporte de fallos por mensaje (batchItemFailures)
+        self.user_validator.add_event_source(
+            lambda_event_sources.SqsEventSource(
+                self.user_photos_queue,
+                batch_size=validator_batch_size,
+                max_batching_window=Duration.seconds(validator_batch_window_seconds),
+                max_concurrency=validator_max_concurrency,
+                report_batch_item_failures=True
+            )
         )
 
         self.cleanup_function = lambda_.Function(
@@ -349,26 +570,38 @@ class RekognitionStack(Stack):
             role=self.cleanup_role,
             timeout=Duration.minutes(15),  # Tiempo suficiente para limpiezas grandes
             memory_size=512,
+            layers=[
+                self.shared_layer
+            ],
             environment={
                 'COLLECTION_ID': 'document-faces-basic-collection',
                 'INDEXED_DOCUMENTS_TABLE': self.indexed_documents_table.table_name,
-                'COMPARISON_RESULTS_TABLE': self.comparison_results_table.table_name
+                'COMPARISON_RESULTS_TABLE': self.comparison_results_table.table_name,
+                'CONTENT_HASHES_TABLE': self.content_hashes_table.table_name
             }
         )
-        # S3 event notifications (unchanged)
+        # Indexación incremental: cada documento nuevo se indexa al subirse
+        for suffix in ['.jpg', '.jpeg', '.png']:
+            self.documents_bucket.add_event_notification(
+                s3.EventType.OBJECT_CREATED,
+                s3n.LambdaDestination(self.document_indexer),
+                s3.NotificationKeyFilter(suffix=suffix)
+            )
+
+        # S3 event notifications → SQS → user validator
         self.user_photos_bucket.add_event_notification(
             s3.EventType.OBJECT_CREATED,
-            s3n.LambdaDestination(self.user_validator),
+            s3n.SqsDestination(self.user_photos_queue),
             s3.NotificationKeyFilter(suffix='.jpg')
         )
         self.user_photos_bucket.add_event_notification(
             s3.EventType.OBJECT_CREATED, 
-            s3n.LambdaDestination(self.user_validator),
+            s3n.SqsDestination(self.user_photos_queue),
             s3.NotificationKeyFilter(suffix=".jpeg")
         )
         self.user_photos_bucket.add_event_notification(
             s3.EventType.OBJECT_CREATED,
-            s3n.LambdaDestination(self.user_validator), 
+            s3n.SqsDestination(self.user_photos_queue), 
             s3.NotificationKeyFilter(suffix=".png")
         )
 
@@ -378,6 +611,11 @@ class RekognitionStack(Stack):
             value=self.documents_bucket.bucket_name,
             description='Bucket for identity documents'
         )
+        cdk.CfnOutput(
+            self,'DerivedDocumentsBucketNameBasic',
+            value=self.derived_documents_bucket.bucket_name,
+            description='Bucket for indexer derivatives (normalized documents, face crops)'
+        )
         cdk.CfnOutput(
             self, 'UserPhotosBucketNameBasic',
             value=self.user_photos_bucket.bucket_name,
@@ -388,11 +626,36 @@ class RekognitionStack(Stack):
             value=self.indexed_documents_table.table_name,
             description='DynamoDB table for indexed documents metadata'
         )
+        cdk.CfnOutput(
+            self,'IndexingRunsTableNameBasic',
+            value=self.indexing_runs_table.table_name,
+            description='DynamoDB table for indexing run checkpoints'
+        )
+        cdk.CfnOutput(
+            self,'ContentHashesTableNameBasic',
+            value=self.content_hashes_table.table_name,
+            description='DynamoDB table for content hashes (duplicate documents, reusable results)'
+        )
         cdk.CfnOutput(
             self,'ComparisonResultsTableNameBasic',
             value=self.comparison_results_table.table_name,
             description='DynamoDB table for comparison results'
         )
+        cdk.CfnOutput(
+            self,'UserPhotosQueueUrlBasic',
+            value=self.user_photos_queue.queue_url,
+            description='SQS queue buffering user photo uploads for the validator'
+        )
+        cdk.CfnOutput(
+            self,'DocumentIndexerDLQUrlBasic',
+            value=self.document_indexer_dlq.queue_url,
+            description='S3 events the document indexer could not process after retries'
+        )
+        cdk.CfnOutput(
+            self,'UserValidatorBulkFunctionNameBasic',
+            value=self.user_validator_bulk.function_name,
+            description='Lambda for HYBRID_BULK validation runs (15 min per invocation, re-invokes itself)'
+        )
         cdk.CfnOutput(
             self,'ValidationMode',
             value=validation_mode,
@@ -0,0 +1,87 @@
+import os
+import threading
+import logging
+
+logger = logging.getLogger()
+
+# Ajustes de conexión compartidos por todos los clientes del contenedor
+# (boto3/botocore se importan al crear el primer cliente, no en el cold start)
+CLIENT_CONFIG = {
+    'max_pool_connections': int(os.environ.get('AWS_MAX_POOL_CONNECTIONS', '50')),
+    'connect_timeout': float(os.environ.get('AWS_CONNECT_TIMEOUT_SECONDS', '3')),
+    'read_timeout': float(os.environ.get('AWS_READ_TIMEOUT_SECONDS', '20')),
+    'tcp_keepalive': True,
+    'retries': {'mode': 'standard', 'max_attempts': 3}
+}
+
+# Una sesión por contenedor; crear clientes desde una sesión no es thread-safe
+_session = None
+_clients = {}
+_lock = threading.Lock()
+_thread_local = threading.local()
+
+
+def get_session():
+    global _session
+    with _lock:
+        if _session is None:
+            import boto3
+            _session = boto3.session.Session()
+        return _session
+
+
+def build_config(**overrides):
+    from botocore.config import Config
+    return Config(**{**CLIENT_CONFIG, **overrides})
+
+
+def get_client(service_name: str, **config_overrides):
+    """
+    Cliente boto3 compartido (los clientes son thread-safe) con el pool de
+    conexiones y timeouts de CLIENT_CONFIG. `config_overrides` se aplican
+    encima de la base y dan lugar a otro cliente cacheado.
+    """
+    key = (service_name, repr(sorted(config_overrides.items())))
+    client = _clients.get(key)
+    if client is None:
+        session = get_session()
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = session.client(service_name, config=build_config(**config_overrides))
+                _clients[key] = client
+    return client
+
+
+class LazyClient:
+    """
+    Cliente que se construye en el primer uso (evita cargar boto3 y los modelos
+    de servicio de botocore en el cold start si la invocación no lo necesita)
+    """
+
+    def __init__(self, service_name: str, **config_overrides):
+        self.service_name = service_name
+        self.config_overrides = config_overrides
+
+    def __getattr__(self, name):
+        return getattr(get_client(self.service_name, **self.config_overrides), name)
+
+
+def get_resource(service_name: str):
+    """
+    Resource boto3 del hilo actual (los resources no son thread-safe),
+    creado desde la sesión compartida con CLIENT_CONFIG
+    """
+    resources = _thread_local.__dict__.setdefault('resources', {})
+    resource = resources.get(service_name)
+    if resource is None:
+        session = get_session()
+        with _lock:
+            resource = session.resource(service_name, config=build_config())
+        resources[service_name] = resource
+    return resource
+
+
+def clients_created() -> int:
+    """Clientes construidos en este contenedor (para medir la inicialización perezosa)"""
+    return len(_clients)
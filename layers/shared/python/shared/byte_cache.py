@@ -0,0 +1,56 @@
+import threading
+import logging
+from collections import OrderedDict
+from typing import Optional
+
+logger = logging.getLogger()
+
+
+class LRUByteCache:
+    """
+    Caché LRU en memoria del contenedor, acotada por el total de bytes guardados.
+    Sobrevive entre invocaciones mientras el contenedor Lambda siga caliente.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            value = self._items.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: str, value: bytes):
+        size = len(value)
+        if size > self.max_bytes:
+            logger.info(f"Not caching {key}: {size} bytes exceeds cache size {self.max_bytes}")
+            return
+
+        with self._lock:
+            if key in self._items:
+                self.current_bytes -= len(self._items.pop(key))
+            self._items[key] = value
+            self.current_bytes += size
+
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.current_bytes -= len(evicted)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'items': len(self._items),
+                'bytes': self.current_bytes,
+                'hits': self.hits,
+                'misses': self.misses
+            }
@@ -0,0 +1,129 @@
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Any, Callable, Iterable, Iterator, Optional, Tuple
+
+logger = logging.getLogger()
+
+
+class AdaptiveConcurrencyLimit:
+    """
+    Límite de concurrencia AIMD: se reduce a la mitad cuando Rekognition
+    devuelve throttling y crece de uno en uno tras una ronda de éxitos
+    """
+
+    def __init__(self, max_limit: int, min_limit: int = 1):
+        self.max_limit = max(1, int(max_limit))
+        self.min_limit = max(1, min(int(min_limit), self.max_limit))
+        self.limit = self.max_limit
+        self.throttle_count = 0
+        self._successes = 0
+        self._lock = threading.Lock()
+
+    def on_success(self):
+        with self._lock:
+            self._successes += 1
+            if self._successes >= self.limit and self.limit < self.max_limit:
+                self.limit += 1
+                self._successes = 0
+
+    def on_throttle(self):
+        with self._lock:
+            self.throttle_count += 1
+            self._successes = 0
+            new_limit = max(self.min_limit, self.limit // 2)
+            if new_limit != self.limit:
+                logger.warning(f"Throttling detected, reducing concurrency {self.limit} → {new_limit}")
+                self.limit = new_limit
+
+
+class TokenBucket:
+    """
+    Rate limiter token bucket thread-safe: `rate` tokens por segundo con
+    ráfagas de hasta `capacity`
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(1.0, self.rate))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout: Optional[float] = None) -> bool:
+        """Esperar un token; False si no se obtiene antes de `timeout` segundos"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait_time = (1 - self._tokens) / self.rate
+
+            if deadline is not None and now + wait_time > deadline:
+                return False
+            time.sleep(wait_time)
+
+
+def run_bounded(items: Iterable, worker: Callable[[Any], Any], max_workers: int,
+                is_throttled: Optional[Callable[[Any], bool]] = None,
+                max_retries: int = 3, base_delay: float = 0.5,
+                limit: Optional[AdaptiveConcurrencyLimit] = None,
+                should_stop: Optional[Callable[[], bool]] = None) -> Iterator[Tuple[int, Any, Any]]:
+    """
+    Ejecutar worker(item) en un pool de hilos acotado
+
+    - Los items se consumen de forma perezosa: nunca hay más de `limit` en vuelo
+    - Si is_throttled(resultado) es True, se reduce la concurrencia y el item
+      se reintenta con backoff exponencial (hasta max_retries)
+    - Si should_stop() es True, no se consumen más items: se terminan los
+      que están en vuelo y se retorna (el iterable queda sin agotar)
+    - Devuelve (posición, item, resultado) en orden de finalización
+    """
+    limit = limit or AdaptiveConcurrencyLimit(max_workers)
+    iterator = iter(enumerate(items))
+    exhausted = False
+    in_flight = {}
+
+    def attempt(item, retry: int):
+        if retry:
+            delay = base_delay * (2 ** (retry - 1))
+            time.sleep(delay + random.uniform(0, delay))
+        return worker(item)
+
+    with ThreadPoolExecutor(max_workers=limit.max_limit) as executor:
+        while in_flight or not exhausted:
+            while not exhausted and len(in_flight) < limit.limit:
+                if should_stop and should_stop():
+                    logger.info("Stop requested, draining in-flight work")
+                    exhausted = True
+                    break
+                try:
+                    position, item = next(iterator)
+                except StopIteration:
+                    exhausted = True
+                    break
+                in_flight[executor.submit(attempt, item, 0)] = (position, item, 0)
+
+            if not in_flight:
+                continue
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                position, item, retry = in_flight.pop(future)
+                result = future.result()
+
+                if is_throttled and is_throttled(result):
+                    limit.on_throttle()
+                    if retry < max_retries:
+                        in_flight[executor.submit(attempt, item, retry + 1)] = (position, item, retry + 1)
+                        continue
+                else:
+                    limit.on_success()
+
+                yield position, item, result
@@ -0,0 +1,80 @@
+import hashlib
+
+from shared.dynamodb_table import DynamoTable
+
+# El dHash de 64 bits se guarda también partido en 4 bandas de 16 bits: si dos
+# hashes difieren en 3 bits o menos, al menos una banda coincide exactamente
+# (principio del palomar), así que basta una query por banda
+PHASH_BANDS = 4
+PHASH_BAND_HEX = 4
+MAX_NEAR_DUPLICATE_DISTANCE = PHASH_BANDS - 1
+
+
+def content_hash(data: bytes) -> str:
+    """SHA-256 del contenido (hex)"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def hamming_distance(hash_a: str, hash_b: str) -> int:
+    """Bits distintos entre dos hashes perceptuales en hex"""
+    return bin(int(hash_a, 16) ^ int(hash_b, 16)).count('1')
+
+
+class ContentHashIndex:
+    """
+    Índice de hashes de documentos en una tabla dedicada (hash_key + entry_id):
+    - doc#sha256:<hash>           → documento con esos bytes exactos
+    - doc#dhash<banda>:<valor>    → documentos con esa banda del hash perceptual
+    La misma tabla guarda con TTL la caché de resultados (ver result_cache)
+    """
+
+    def __init__(self, table_name: str):
+        self.table = DynamoTable(table_name)
+
+    # ------------------------------------------------------------ documentos
+
+    def find_document_by_content(self, sha256: str) -> dict:
+        """Documento indexado con exactamente los mismos bytes (o None)"""
+        response = self.table.query(
+            KeyConditionExpression='hash_key = :key',
+            ExpressionAttributeValues={':key': f'doc#sha256:{sha256}'},
+            Limit=1
+        )
+        return response['Items'][0] if response['Items'] else None
+
+    def find_similar_document(self, perceptual_hash: str, max_distance: int = MAX_NEAR_DUPLICATE_DISTANCE) -> dict:
+        """
+        Documento más parecido con distancia Hamming <= max_distance (o None).
+        El item devuelto incluye 'distance'
+        """
+        max_distance = min(max_distance, MAX_NEAR_DUPLICATE_DISTANCE)
+        best = None
+        for band, band_value in enumerate(self._bands(perceptual_hash)):
+            response = self.table.query(
+                KeyConditionExpression='hash_key = :key',
+                ExpressionAttributeValues={':key': f'doc#dhash{band}:{band_value}'}
+            )
+            for item in response['Items']:
+                distance = hamming_distance(perceptual_hash, item['perceptual_hash'])
+                if distance <= max_distance and (best is None or distance < best['distance']):
+                    best = {**item, 'distance': distance}
+            if best and best['distance'] == 0:
+                break
+        return best
+
+    def register_document(self, document_id: str, s3_key: str, sha256: str, perceptual_hash: str = None) -> int:
+        """Registrar los hashes de un documento recién indexado"""
+        entry = {'entry_id': document_id, 'document_id': document_id, 's3_key': s3_key, 'content_hash': sha256}
+        if perceptual_hash:
+            entry['perceptual_hash'] = perceptual_hash
+        items = [{'hash_key': f'doc#sha256:{sha256}', **entry}]
+        if perceptual_hash:
+            items += [
+                {'hash_key': f'doc#dhash{band}:{band_value}', **entry}
+                for band, band_value in enumerate(self._bands(perceptual_hash))
+            ]
+        return self.table.batch_put(items)
+
+    @staticmethod
+    def _bands(perceptual_hash: str) -> list:
+        return [perceptual_hash[i:i + PHASH_BAND_HEX] for i in range(0, PHASH_BANDS * PHASH_BAND_HEX, PHASH_BAND_HEX)]
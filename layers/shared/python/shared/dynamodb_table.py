@@ -0,0 +1,129 @@
+import math
+import random
+import time
+from decimal import Decimal
+
+from shared.aws_clients import get_client
+
+# BatchWriteItem acepta hasta 25 operaciones por llamada
+BATCH_WRITE_MAX_ITEMS = 25
+
+# Se crean en el primer uso: importar boto3.dynamodb importa boto3 entero
+_serializer = None
+_deserializer = None
+
+
+def serialize_item(item: dict) -> dict:
+    return {key: to_attribute_value(value) for key, value in item.items()}
+
+
+def to_attribute_value(value) -> dict:
+    """
+    Valor Python → AttributeValue en una sola pasada. A diferencia de
+    TypeSerializer acepta float (se escribe su repr, sin pasar por Decimal);
+    los tipos poco comunes (sets, binarios) se delegan en TypeSerializer
+    """
+    if isinstance(value, str):
+        return {'S': value}
+    if isinstance(value, bool):
+        return {'BOOL': value}
+    if isinstance(value, (int, float, Decimal)):
+        if isinstance(value, float) and not math.isfinite(value):
+            raise TypeError(f'Non-finite float not supported by DynamoDB: {value}')
+        return {'N': str(value)}
+    if value is None:
+        return {'NULL': True}
+    if isinstance(value, dict):
+        return {'M': {key: to_attribute_value(inner) for key, inner in value.items()}}
+    if isinstance(value, (list, tuple)):
+        return {'L': [to_attribute_value(inner) for inner in value]}
+
+    global _serializer
+    if _serializer is None:
+        from boto3.dynamodb.types import TypeSerializer
+        _serializer = TypeSerializer()
+    return _serializer.serialize(value)
+
+
+def deserialize_item(item: dict) -> dict:
+    global _deserializer
+    if _deserializer is None:
+        from boto3.dynamodb.types import TypeDeserializer
+        _deserializer = TypeDeserializer()
+    return {key: _deserializer.deserialize(value) for key, value in item.items()}
+
+
+class DynamoTable:
+    """
+    Tabla DynamoDB sobre el cliente de bajo nivel, con la misma interfaz que
+    boto3.resource('dynamodb').Table para put_item/get_item/query/scan
+    (items en Python nativo con Decimal). Evita cargar la capa de resources
+    en el cold start y, al usar un cliente thread-safe, se puede compartir
+    entre hilos. El cliente se crea en la primera llamada.
+    """
+
+    def __init__(self, table_name: str):
+        self.table_name = table_name
+
+    @property
+    def client(self):
+        return get_client('dynamodb')
+
+    def put_item(self, Item: dict, **kwargs) -> dict:
+        return self.client.put_item(TableName=self.table_name, Item=serialize_item(Item),
+                                    **self._serialize_params(kwargs))
+
+    def get_item(self, Key: dict, **kwargs) -> dict:
+        response = self.client.get_item(TableName=self.table_name, Key=serialize_item(Key), **kwargs)
+        if 'Item' in response:
+            response['Item'] = deserialize_item(response['Item'])
+        return response
+
+    def delete_item(self, Key: dict, **kwargs) -> dict:
+        return self.client.delete_item(TableName=self.table_name, Key=serialize_item(Key),
+                                       **self._serialize_params(kwargs))
+
+    def batch_put(self, items: list, max_attempts: int = 5) -> int:
+        """
+        Escribir items con BatchWriteItem (lotes de 25), reintentando los
+        UnprocessedItems con backoff exponencial. Retorna los items escritos;
+        lanza RuntimeError si quedan items sin procesar tras max_attempts
+        """
+        written = 0
+        for start in range(0, len(items), BATCH_WRITE_MAX_ITEMS):
+            requests = [{'PutRequest': {'Item': serialize_item(item)}}
+                        for item in items[start:start + BATCH_WRITE_MAX_ITEMS]]
+            for attempt in range(max_attempts):
+                response = self.client.batch_write_item(RequestItems={self.table_name: requests})
+                unprocessed = response.get('UnprocessedItems', {}).get(self.table_name, [])
+                written += len(requests) - len(unprocessed)
+                requests = unprocessed
+                if not requests:
+                    break
+                time.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+            if requests:
+                raise RuntimeError(f'BatchWriteItem left {len(requests)} unprocessed items in {self.table_name}')
+        return written
+
+    def query(self, **kwargs) -> dict:
+        response = self.client.query(TableName=self.table_name, **self._serialize_params(kwargs))
+        return self._deserialize_page(response)
+
+    def scan(self, **kwargs) -> dict:
+        response = self.client.scan(TableName=self.table_name, **self._serialize_params(kwargs))
+        return self._deserialize_page(response)
+
+    @staticmethod
+    def _serialize_params(params: dict) -> dict:
+        params = dict(params)
+        for key in ('ExpressionAttributeValues', 'ExclusiveStartKey'):
+            if key in params:
+                params[key] = serialize_item(params[key])
+        return params
+
+    @staticmethod
+    def _deserialize_page(response: dict) -> dict:
+        response['Items'] = [deserialize_item(item) for item in response.get('Items', [])]
+        if 'LastEvaluatedKey' in response:
+            response['LastEvaluatedKey'] = deserialize_item(response['LastEvaluatedKey'])
+        return response
@@ -1,102 +1,414 @@
-import boto3
 import io
-from PIL import Image, ExifTags
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Iterable, Iterator
+from PIL import Image, ExifTags, ImageFilter, ImageStat
+# Solo los plugins que usamos: Image.open con formats=... no carga los ~40 plugins de Pillow
+from PIL import JpegImagePlugin, PngImagePlugin
 import logging
 
 logger=logging.getLogger()
 logger.setLevel(logging.INFO)
 
+ORIENTATION_TAG = next(tag for tag, name in ExifTags.TAGS.items() if name == 'Orientation')
+
+# Laplaciano 3x3 (el offset evita recortar los valores negativos a 0)
+LAPLACIAN_KERNEL = ImageFilter.Kernel((3, 3), [0, 1, 0, 1, -4, 1, 0, 1, 0], scale=1, offset=128)
+
+# Orientación EXIF → transposición equivalente (sin re-muestrear)
+ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90
+}
+
 class MinimalImageProcessor:
-    def __init__(self):
+    def __init__(self, target_dimension: int = None):
         self.MAX_FILE_SIZE =15*1024*1024
         self.MIN_DIMENSION=80
         self.MAX_DIMENSION=4096
+        # Lado mayor al que se reducen las imágenes grandes (<= MAX_DIMENSION)
+        self.TARGET_DIMENSION=min(target_dimension or self.MAX_DIMENSION, self.MAX_DIMENSION)
         self.SUPPORTED_FORMATS=['JPEG','PNG']
+        # Rekognition acepta hasta 5MB cuando la imagen va en Bytes
+        self.MAX_PASS_THROUGH_SIZE=5*1024*1024
+        self.FACE_CROP_PADDING=0.4
+        self.FACE_CROP_MAX_DIMENSION=800
+        # Pre-filtro de calidad (miniatura en gris) antes de pagar llamadas a Rekognition
+        self.QUALITY_THUMBNAIL_SIZE=256
+        self.MIN_SHARPNESS=20.0
+        self.MIN_BRIGHTNESS=40.0
+        self.MAX_BRIGHTNESS=220.0
+        self.MIN_CONTRAST=12.0
+        self.MAX_CLIPPED_RATIO=0.5
+        # Rekognition no detecta rostros de menos de 50x50 px
+        self.MIN_FACE_SIZE=50
+        # Lado del dHash (8 → 64 bits) para detectar documentos casi idénticos
+        self.PHASH_SIZE=8
 
     def process_image(self,image_bytes:bytes,filename:str)->tuple:
+        processed_bytes, error, _ = self.process_image_detailed(image_bytes, filename)
+        return processed_bytes, error
+
+    def process_image_detailed(self, image_bytes: bytes, filename: str) -> tuple:
+        """
+        Pipeline de una sola decodificación:
+        1. Cabecera (formato, tamaño, orientación EXIF) sin decodificar píxeles
+        2. FAST_PATH: JPEG ya conformes se devuelven con los bytes originales
+        3. FULL_PATH: JPEG grandes con decodificación draft (DCT a 1/2, 1/4 u 1/8)
+           cerca del tamaño objetivo, resize + orientación en una sola pasada
+           y re-codificación a JPEG
+        
+        Retorna (bytes, error, info) con info['path'] y info['timings_ms'] por etapa
+        """
+        timings = {}
+        info = {'timings_ms': timings}
         try:
             if len(image_bytes) > self.MAX_FILE_SIZE:
                 logger.error(f"File {filename} exceeds 15MB limit: {len(image_bytes)/1024/1024:.1f}MB")
-                return None, f"File too large: {len(image_bytes)/1024/1024:.1f}MB (max: 15MB)"
+                return None, f"File too large: {len(image_bytes)/1024/1024:.1f}MB (max: 15MB)", info
+            
+            stage_start = time.perf_counter()
             try:
-                image = Image.open(io.BytesIO(image_bytes))
+                image = Image.open(io.BytesIO(image_bytes), formats=self.SUPPORTED_FORMATS)
             except Exception as e:
-                return None, f"Invalid image format: {str(e)}"    
-            if image.format not in self.SUPPORTED_FORMATS:
-                return None, f"Unsupported format: {image.format}. Supported: {self.SUPPORTED_FORMATS}"
-            image = self._fix_orientation(image)
-            width, height = image.size
+                return None, f"Invalid image format (supported: {self.SUPPORTED_FORMATS}): {str(e)}", info
+            header = self._read_header(image, len(image_bytes))
+            image_format = header['format']
+            if image_format not in self.SUPPORTED_FORMATS:
+                return None, f"Unsupported format: {image_format}. Supported: {self.SUPPORTED_FORMATS}", info
+            
+            orientation = header['orientation']
+            width, height = header['width'], header['height']
+            info['original_size'] = (width, height)
             if width < self.MIN_DIMENSION or height < self.MIN_DIMENSION:
-                return None, f"Image too small: {width}x{height} (min: {self.MIN_DIMENSION}x{self.MIN_DIMENSION})"
-            if width > self.MAX_DIMENSION or height > self.MAX_DIMENSION:
-                image=self._resize_image(image)
+                return None, f"Image too small: {width}x{height} (min: {self.MIN_DIMENSION}x{self.MIN_DIMENSION})", info
+            
+            if self.is_pass_through(header):
+                timings['inspect'] = self._elapsed_ms(stage_start)
+                info['path'] = 'FAST_PATH'
+                info['output_size'] = (width, height)
+                info['reencoded'] = False
+                logger.info(f"Processed {filename}: FAST_PATH, compliant JPEG {width}x{height} passed through untouched")
+                return image_bytes, None, info
+            
+            info['path'] = 'FULL_PATH'
+            # Tamaño objetivo en la orientación almacenada (antes de transponer)
+            target_size = self._target_size(*header['stored_size'])
+            
+            if image_format == 'JPEG' and target_size is not None:
+                image.draft(image.mode, target_size)
+            image.load()
+            timings['decode'] = self._elapsed_ms(stage_start)
+            
+            stage_start = time.perf_counter()
+            if target_size is not None and image.size != target_size:
+                image = image.resize(target_size, Image.Resampling.LANCZOS)
                 logger.info(f"Resized image from {width}x{height} to {image.size}")
+            if orientation in ORIENTATION_TRANSPOSE:
+                image = image.transpose(ORIENTATION_TRANSPOSE[orientation])
+            timings['transform'] = self._elapsed_ms(stage_start)
+            
+            stage_start = time.perf_counter()
             output_buffer = io.BytesIO()
-            if image.format == 'PNG':
-                # Convertir PNG a JPEG para mejor compresión
+            if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+                # Convertir PNG a JPEG para mejor compresión (fondo blanco para la transparencia)
+                image = image.convert('RGBA')
                 rgb_image = Image.new('RGB', image.size, (255, 255, 255))
-                rgb_image.paste(image, mask=image.split()[-1] if image.mode == 'RGBA' else None)
-                rgb_image.save(output_buffer, format='JPEG', quality=85, optimize=True)
-            else:
-                image.save(output_buffer, format='JPEG', quality=85, optimize=True)
-                
+                rgb_image.paste(image, mask=image.split()[-1])
+                image = rgb_image
+            elif image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            image.save(output_buffer, format='JPEG', quality=85, optimize=True)
             processed_bytes = output_buffer.getvalue()
+            timings['encode'] = self._elapsed_ms(stage_start)
+            
+            info['output_size'] = image.size
+            info['reencoded'] = True
             if len(processed_bytes) > self.MAX_FILE_SIZE:
-                return None, f"Unable to compress image below 15MB limit"
-            logger.info(f"Processed {filename}: {len(image_bytes)/1024/1024:.1f}MB → {len(processed_bytes)/1024/1024:.1f}MB")
-            return processed_bytes, None
+                return None, f"Unable to compress image below 15MB limit", info
+            logger.info(f"Processed {filename}: FULL_PATH, {len(image_bytes)/1024/1024:.1f}MB → {len(processed_bytes)/1024/1024:.1f}MB "
+                        f"(decode {timings['decode']}ms, transform {timings['transform']}ms, encode {timings['encode']}ms)")
+            return processed_bytes, None, info
         except Exception as e:
             logger.error(f'Error processing {filename}:{str(e)}')
-            return None, f'Processing failed: {str(e)}'
+            return None, f'Processing failed: {str(e)}', info
     
-    def _fix_orientation(self, image):
+    def process_images(self, items: Iterable[tuple], max_workers: int = None, max_in_flight: int = None) -> Iterator[tuple]:
         """
-        Corrige orientación basada en EXIF - CRÍTICO para fotos de móviles
+        Preprocesar un lote de (bytes, nombre) en un pool de procesos.
+        Devuelve (nombre, bytes, error) en orden de finalización; nunca hay más
+        de max_in_flight imágenes en memoria pendientes de procesar.
         """
-        try:
-            for orientation in ExifTags.TAGS.keys():
-                if ExifTags.TAGS[orientation] == 'Orientation':
-                    break
-            exif = image.getexif()      
-
-            if exif is not None:
-                orientation_value = exif.get(orientation)
-                
-                if orientation_value == 3:
-                    image = image.rotate(180, expand=True)
-                elif orientation_value == 6:
-                    image = image.rotate(270, expand=True)
-                elif orientation_value == 8:
-                    image = image.rotate(90, expand=True)
-                    
-        except (AttributeError, KeyError, TypeError):
-            # No EXIF data available, skip orientation fix
-            pass
-            
-        return image
+        with ImageProcessingPool(max_workers, self.TARGET_DIMENSION) as pool:
+            yield from pool.process_images(items, max_in_flight)
     
-    def _resize_image(self, image):
+    def assess_quality(self, image_bytes: bytes, check_exposure: bool = True) -> dict:
         """
-        Redimensiona imagen manteniendo aspect ratio
+        Pre-filtro de calidad sobre una miniatura en escala de grises:
+        - sharpness: varianza del Laplaciano (imágenes borrosas → valor bajo)
+        - brightness/contrast: media y desviación del histograma
+        - clipped_ratio: fracción de píxeles quemados o negros
+        - tamaño: el lado menor debe admitir un rostro de 50px
+        
+        check_exposure=False no rechaza por brillo ni píxeles quemados: los
+        escaneos de documentos sobre fondo blanco son muy claros y válidos
+        
+        Retorna dict con passed, reasons y los scores
         """
+        start = time.perf_counter()
+        image = Image.open(io.BytesIO(image_bytes), formats=self.SUPPORTED_FORMATS)
         width, height = image.size
+        thumbnail_size = (self.QUALITY_THUMBNAIL_SIZE, self.QUALITY_THUMBNAIL_SIZE)
+        if image.format == 'JPEG':
+            image.draft('L', thumbnail_size)
+        image = image.convert('L')
+        image.thumbnail(thumbnail_size)
         
-        if width > height:
-            new_width = self.MAX_DIMENSION
-            new_height = int((height * self.MAX_DIMENSION) / width)
-        else:
-            new_height = self.MAX_DIMENSION  
-            new_width = int((width * self.MAX_DIMENSION) / height)
-            
-        return image.resize((new_width, new_height), Image.Resampling.LANCZOS)
-
-
-
+        histogram = image.histogram()
+        total_pixels = sum(histogram)
+        stat = ImageStat.Stat(image)
+        # El borde de 1px queda sin filtrar: medir solo el interior
+        laplacian = image.filter(LAPLACIAN_KERNEL).crop((1, 1, image.width - 1, image.height - 1))
+        sharpness = ImageStat.Stat(laplacian).var[0]
+        clipped_ratio = (sum(histogram[:5]) + sum(histogram[251:])) / total_pixels
+        
+        scores = {
+            'sharpness': round(sharpness, 2),
+            'brightness': round(stat.mean[0], 2),
+            'contrast': round(stat.stddev[0], 2),
+            'clipped_ratio': round(clipped_ratio, 3)
+        }
+        
+        reasons = []
+        if sharpness < self.MIN_SHARPNESS:
+            reasons.append(f'Image too blurry (sharpness {scores["sharpness"]} < {self.MIN_SHARPNESS})')
+        if check_exposure and not self.MIN_BRIGHTNESS <= stat.mean[0] <= self.MAX_BRIGHTNESS:
+            reasons.append(f'Bad exposure (brightness {scores["brightness"]}, expected {self.MIN_BRIGHTNESS}-{self.MAX_BRIGHTNESS})')
+        if stat.stddev[0] < self.MIN_CONTRAST:
+            reasons.append(f'Contrast too low ({scores["contrast"]} < {self.MIN_CONTRAST})')
+        if check_exposure and clipped_ratio > self.MAX_CLIPPED_RATIO:
+            reasons.append(f'Too many clipped pixels ({scores["clipped_ratio"]:.0%})')
+        if min(width, height) < self.MIN_FACE_SIZE:
+            reasons.append(f'Image too small for a detectable face ({width}x{height}, min side {self.MIN_FACE_SIZE}px)')
+        
+        logger.info(f"Quality check {'passed' if not reasons else 'FAILED'} in {self._elapsed_ms(start)}ms: {scores}")
+        return {'passed': not reasons, 'reasons': reasons, **scores}
 
+    def perceptual_hash(self, image_bytes: bytes) -> str:
+        """
+        dHash de 64 bits en hex: la imagen en gris reducida a 9x8 y un bit por
+        cada par de píxeles vecinos (izquierdo más claro que el derecho).
+        Re-codificar, redimensionar o cambiar la calidad JPEG solo cambia unos
+        pocos bits; la distancia Hamming mide cuánto se parecen dos imágenes
+        """
+        image = Image.open(io.BytesIO(image_bytes), formats=self.SUPPORTED_FORMATS)
+        if image.format == 'JPEG':
+            image.draft('L', (self.PHASH_SIZE * 8, self.PHASH_SIZE * 8))
+        image = image.convert('L').resize((self.PHASH_SIZE + 1, self.PHASH_SIZE), Image.Resampling.BOX)
+        pixels = list(image.getdata())
 
+        bits = 0
+        for row in range(self.PHASH_SIZE):
+            offset = row * (self.PHASH_SIZE + 1)
+            for col in range(self.PHASH_SIZE):
+                bits = (bits << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+        return f'{bits:0{self.PHASH_SIZE * self.PHASH_SIZE // 4}x}'
 
+    def inspect_image(self, image_bytes: bytes) -> dict:
+        """
+        Inspección solo de cabecera (no decodifica píxeles): formato, tamaño
+        en orientación final, orientación EXIF, modo de color y tamaño en bytes
+        """
+        return self._read_header(Image.open(io.BytesIO(image_bytes), formats=self.SUPPORTED_FORMATS), len(image_bytes))
+    
+    def is_pass_through(self, header: dict) -> bool:
+        """
+        True si la imagen ya cumple todo lo que haría process_image: JPEG RGB/L,
+        sin rotación EXIF, dentro de TARGET_DIMENSION y aceptable como Bytes
+        """
+        return (
+            header['format'] == 'JPEG'
+            and header['orientation'] in (None, 1)
+            and header['mode'] in ('RGB', 'L')
+            and self._target_size(*header['stored_size']) is None
+            and header['size_bytes'] <= self.MAX_PASS_THROUGH_SIZE
+        )
+    
+    def _read_header(self, image, size_bytes: int) -> dict:
+        orientation = self._get_orientation(image)
+        width, height = image.size
+        if orientation in (5, 6, 7, 8):
+            width, height = height, width
+        return {
+            'format': image.format,
+            'width': width,
+            'height': height,
+            'stored_size': image.size,
+            'orientation': orientation,
+            'mode': image.mode,
+            'size_bytes': size_bytes
+        }
+    
+    def crop_face(self, image_bytes: bytes, bounding_box: dict, filename: str = '') -> tuple:
+        """
+        Recortar la cara (BoundingBox relativo de Rekognition) con margen alrededor,
+        para usar como imagen objetivo de CompareFaces con un payload mucho menor
+        """
+        try:
+            image = Image.open(io.BytesIO(image_bytes), formats=self.SUPPORTED_FORMATS)
+            width, height = image.size
+            
+            box_left = bounding_box['Left'] * width
+            box_top = bounding_box['Top'] * height
+            box_width = bounding_box['Width'] * width
+            box_height = bounding_box['Height'] * height
+            pad_x = box_width * self.FACE_CROP_PADDING
+            pad_y = box_height * self.FACE_CROP_PADDING
+            
+            left = max(0, int(box_left - pad_x))
+            top = max(0, int(box_top - pad_y))
+            right = min(width, int(box_left + box_width + pad_x))
+            bottom = min(height, int(box_top + box_height + pad_y))
+            
+            # Rekognition exige al menos MIN_DIMENSION por lado
+            if right - left < self.MIN_DIMENSION:
+                left = max(0, min(left, width - self.MIN_DIMENSION))
+                right = min(width, left + self.MIN_DIMENSION)
+            if bottom - top < self.MIN_DIMENSION:
+                top = max(0, min(top, height - self.MIN_DIMENSION))
+                bottom = min(height, top + self.MIN_DIMENSION)
+            
+            if right - left < self.MIN_DIMENSION or bottom - top < self.MIN_DIMENSION:
+                return None, f"Face crop too small: {right - left}x{bottom - top}"
+            
+            crop = image.crop((left, top, right, bottom))
+            if max(crop.size) > self.FACE_CROP_MAX_DIMENSION:
+                crop.thumbnail((self.FACE_CROP_MAX_DIMENSION, self.FACE_CROP_MAX_DIMENSION), Image.Resampling.LANCZOS)
+            if crop.mode != 'RGB':
+                crop = crop.convert('RGB')
+            
+            output_buffer = io.BytesIO()
+            crop.save(output_buffer, format='JPEG', quality=90)
+            crop_bytes = output_buffer.getvalue()
+            logger.info(f"Face crop {filename}: {width}x{height} → {crop.size[0]}x{crop.size[1]}, {len(image_bytes)} → {len(crop_bytes)} bytes")
+            return crop_bytes, None
+        except Exception as e:
+            logger.error(f'Error cropping face {filename}:{str(e)}')
+            return None, f'Face crop failed: {str(e)}'
+    
+    def _get_orientation(self, image):
+        """
+        Leer la orientación EXIF (CRÍTICO para fotos de móviles) desde la cabecera
+        """
+        try:
+            return image.getexif().get(ORIENTATION_TAG)
+        except (AttributeError, KeyError, TypeError):
+            # No EXIF data available, skip orientation fix
+            return None
+    
+    def _target_size(self, width, height):
+        """
+        Tamaño final manteniendo aspect ratio, o None si ya cabe en TARGET_DIMENSION.
+        El lado menor nunca baja de MIN_DIMENSION (salvo que exceda MAX_DIMENSION).
+        """
+        if width <= self.TARGET_DIMENSION and height <= self.TARGET_DIMENSION:
+            return None
+        
+        scale = self.TARGET_DIMENSION / max(width, height)
+        if min(width, height) * scale < self.MIN_DIMENSION:
+            scale = min(self.MIN_DIMENSION / min(width, height), self.MAX_DIMENSION / max(width, height))
+        if scale >= 1:
+            return None
+            
+        return (int(width * scale), int(height * scale))
+    
+    @staticmethod
+    def _elapsed_ms(stage_start: float) -> int:
+        return int((time.perf_counter() - stage_start) * 1000)
 
 
+# Procesador propio de cada proceso del pool (se crea en el initializer)
+_worker_processor = None
 
+def _init_worker(target_dimension):
+    global _worker_processor
+    _worker_processor = MinimalImageProcessor(target_dimension)
 
+def _process_in_worker(image_bytes: bytes, filename: str) -> tuple:
+    return _worker_processor.process_image(image_bytes, filename)
 
+class ImageProcessingPool:
+    """
+    Pool de procesos para el preprocesado (Pillow es CPU-bound y el GIL deja
+    núcleos ociosos). Lambda no tiene /dev/shm y multiprocessing no puede crear
+    sus colas: en ese caso se usa un pool de hilos (Pillow libera el GIL al
+    decodificar y redimensionar).
+    """
+    
+    def __init__(self, max_workers: int = None, target_dimension: int = None):
+        self.max_workers = max_workers
+        try:
+            self._executor = ProcessPoolExecutor(
+                max_workers=max_workers,
+                initializer=_init_worker,
+                initargs=(target_dimension,)
+            )
+            self._processor = None
+            self.uses_processes = True
+        except (OSError, NotImplementedError, ImportError) as e:
+            logger.warning(f"Process pool unavailable ({str(e)}), preprocessing with threads")
+            self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='preprocess')
+            self._processor = MinimalImageProcessor(target_dimension)
+            self.uses_processes = False
+    
+    def submit(self, image_bytes: bytes, filename: str):
+        """Future con el resultado (bytes, error) de process_image"""
+        if self.uses_processes:
+            return self._executor.submit(_process_in_worker, image_bytes, filename)
+        return self._executor.submit(self._processor.process_image, image_bytes, filename)
+    
+    def process_image(self, image_bytes: bytes, filename: str) -> tuple:
+        """Igual que MinimalImageProcessor.process_image, ejecutado en el pool"""
+        return self.submit(image_bytes, filename).result()
+    
+    def process_images(self, items: Iterable[tuple], max_in_flight: int = None) -> Iterator[tuple]:
+        """Devuelve (nombre, bytes, error) en orden de finalización con ventana acotada"""
+        max_in_flight = max_in_flight or 2 * (self.max_workers or 4)
+        iterator = iter(items)
+        in_flight = {}
+        exhausted = False
+        
+        while in_flight or not exhausted:
+            while not exhausted and len(in_flight) < max_in_flight:
+                try:
+                    image_bytes, filename = next(iterator)
+                except StopIteration:
+                    exhausted = True
+                    break
+                in_flight[self.submit(image_bytes, filename)] = filename
+            
+            if not in_flight:
+                continue
+            
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                filename = in_flight.pop(future)
+                try:
+                    processed_bytes, error = future.result()
+                except Exception as e:
+                    processed_bytes, error = None, f'Processing failed: {str(e)}'
+                yield filename, processed_bytes, error
+    
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.shutdown()
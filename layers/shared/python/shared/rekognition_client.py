@@ -1,18 +1,119 @@
-import boto3
-import json
 import logging
-from typing import Dict, List, Optional
+import random
+import threading
+import time
+from typing import Dict, Optional
+from shared.concurrency import TokenBucket
+from shared.aws_clients import LazyClient
 
 logger = logging.getLogger()
 
+# Códigos de error que indican que se superaron los TPS de Rekognition/DynamoDB
+THROTTLING_ERROR_CODES = (
+    'ThrottlingException',
+    'ProvisionedThroughputExceededException',
+    'LimitExceededException'
+)
+
+def is_throttling_error(error) -> bool:
+    """Detectar si una excepción o mensaje de error corresponde a throttling"""
+    message = str(error)
+    return any(code in message for code in THROTTLING_ERROR_CODES)
+
+REKOGNITION_CLIENT_CONFIG = {'retries': {'mode': 'standard', 'total_max_attempts': 2}}
+
+# APIs de pago con límite de TPS por cuenta/región
+RATE_LIMITED_APIS = ('CompareFaces', 'SearchFacesByImage', 'IndexFaces', 'DetectFaces')
+
+def parse_tps_config(value: str) -> Dict[str, float]:
+    """
+    TPS por API desde configuración:
+    "5" → 5 TPS para todas; "CompareFaces=10,IndexFaces=5" → por API; "" → sin límite
+    """
+    if not value:
+        return {}
+    if '=' not in value:
+        return {api: float(value) for api in RATE_LIMITED_APIS}
+    tps = {}
+    for entry in value.split(','):
+        api, rate = entry.split('=')
+        tps[api.strip()] = float(rate)
+    return tps
+
+def is_no_face_error(error) -> bool:
+    """
+    InvalidParameterException de SearchFacesByImage/IndexFaces cuando la imagen
+    no contiene caras. CompareFaces no lo indica así (ver compare_faces)
+    """
+    return 'no faces in the image' in str(error).lower()
+
 class RekognitionClient:
     """
     Cliente Rekognition CORREGIDO que SIEMPRE obtiene similarity real
     """
     
-    def __init__(self, collection_id: str):
-        self.rekognition = boto3.client('rekognition')
+    # Backoff ante throttling: base * 2^intento con jitter completo, hasta MAX_BACKOFF
+    MAX_RETRIES = 5
+    BASE_BACKOFF_SECONDS = 0.2
+    MAX_BACKOFF_SECONDS = 5.0
+    
+    def __init__(self, collection_id: str, tps: Dict[str, float] = None):
+        # Los throttles los reintenta este cliente (con rate limit y deadline);
+        # botocore solo reintenta una vez los errores transitorios
+        self.rekognition = LazyClient('rekognition', **REKOGNITION_CLIENT_CONFIG)
         self.collection_id = collection_id
+        self.rate_limiters = {api: TokenBucket(rate) for api, rate in (tps or {}).items() if rate > 0}
+        self.deadline = None
+        self._stats = {'calls': 0, 'throttles': 0, 'retries': 0, 'rate_limit_wait_ms': 0}
+        self._stats_lock = threading.Lock()
+    
+    def set_deadline(self, deadline: Optional[float]):
+        """Instante (time.time()) a partir del cual no se reintenta ni se espera al rate limiter"""
+        self.deadline = deadline
+    
+    def get_stats(self) -> Dict:
+        with self._stats_lock:
+            return dict(self._stats)
+    
+    def _count(self, counter: str, amount: int = 1):
+        with self._stats_lock:
+            self._stats[counter] += amount
+    
+    def _remaining_seconds(self) -> Optional[float]:
+        return None if self.deadline is None else self.deadline - time.time()
+    
+    def _call(self, api_name: str, method, **params):
+        """
+        Llamar a una API de Rekognition respetando su rate limit y reintentando
+        los throttles con backoff exponencial + jitter mientras quede presupuesto
+        (intentos y tiempo hasta el deadline). Otras excepciones se propagan.
+        """
+        attempt = 0
+        while True:
+            limiter = self.rate_limiters.get(api_name)
+            if limiter:
+                wait_start = time.perf_counter()
+                if not limiter.acquire(timeout=self._remaining_seconds()):
+                    self._count('throttles')
+                    raise RuntimeError(f'ThrottlingException: client-side rate limit for {api_name} not available before deadline')
+                self._count('rate_limit_wait_ms', int((time.perf_counter() - wait_start) * 1000))
+            
+            self._count('calls')
+            try:
+                return method(**params)
+            except Exception as e:
+                if not is_throttling_error(e):
+                    raise
+                self._count('throttles')
+                attempt += 1
+                delay = random.uniform(0, min(self.MAX_BACKOFF_SECONDS, self.BASE_BACKOFF_SECONDS * (2 ** attempt)))
+                remaining = self._remaining_seconds()
+                if attempt > self.MAX_RETRIES or (remaining is not None and delay >= remaining):
+                    logger.warning(f"{api_name} throttled, retry budget exhausted after {attempt - 1} retries")
+                    raise
+                logger.warning(f"{api_name} throttled, retry {attempt}/{self.MAX_RETRIES} in {delay:.2f}s")
+                self._count('retries')
+                time.sleep(delay)
     
     def create_collection_if_not_exists(self) -> bool:
         """Crear colección si no existe"""
@@ -51,7 +152,8 @@ class RekognitionClient:
             logger.info(f"🔧 FIXED: Comparing faces to get REAL similarity (threshold bypass)")
             
             # 🎯 SOLUCIÓN: Usar threshold=0 para SIEMPRE obtener similarity
-            response = self.rekognition.compare_faces(
+            response = self._call(
+                'CompareFaces', self.rekognition.compare_faces,
                 SourceImage={'Bytes': source_image},
                 TargetImage={'Bytes': target_image},
                 SimilarityThreshold=0  # ← CLAVE: threshold=0 captura TODO
@@ -130,7 +232,16 @@ class RekognitionClient:
             error_msg = str(e)
             logger.error(f"InvalidParameterException: {error_msg}")
             
-            if 'image' in error_msg.lower():
+            if is_no_face_error(error_msg):
+                # CompareFaces lanza InvalidParameterException si falta cara en el origen o
+                # en el destino, casi siempre como "Request has invalid parameters" (sin
+                # decir cuál): quien llama lo distingue con DetectFaces del origen
+                return {
+                    'success': False,
+                    'error': 'No faces detected in source image',
+                    'error_type': 'NO_FACE_IN_SOURCE'
+                }
+            elif 'image' in error_msg.lower():
                 if 'format' in error_msg.lower():
                     return {
                         'success': False,
@@ -164,27 +275,51 @@ class RekognitionClient:
                 'error_type': 'UNEXPECTED_ERROR'
             }
     
-    def index_face(self, image_bytes: bytes, external_image_id: str) -> Dict:
-        """Indexar cara en la colección"""
+    def index_face(self, image_bytes: bytes, external_image_id: str, max_faces: int = 1,
+                   quality_filter: str = 'AUTO') -> Dict:
+        """
+        Indexar cara en la colección. IndexFaces ya detecta las caras: las que
+        no se indexan vienen en UnindexedFaces con sus motivos (EXCEEDS_MAX_FACES,
+        LOW_QUALITY, SMALL_BOUNDING_BOX...), así que no hace falta DetectFaces antes
+        """
         try:
-            response = self.rekognition.index_faces(
+            response = self._call(
+                'IndexFaces', self.rekognition.index_faces,
                 CollectionId=self.collection_id,
                 Image={'Bytes': image_bytes},
                 ExternalImageId=external_image_id,
-                MaxFaces=1,
-                QualityFilter='AUTO',
+                MaxFaces=max_faces,
+                QualityFilter=quality_filter,
                 DetectionAttributes=['DEFAULT']
             )
             
-            if not response['FaceRecords']:
-                return {'success': False, 'error': 'No faces detected in image'}
+            face_records = response['FaceRecords']
+            unindexed_faces = response.get('UnindexedFaces', [])
+            face_count = len(face_records) + len(unindexed_faces)
+            unindexed_reasons = sorted({
+                reason for face in unindexed_faces for reason in face.get('Reasons', [])
+            })
+            
+            if not face_records:
+                if not unindexed_faces:
+                    return {'success': False, 'error': 'No faces detected in image',
+                            'error_type': 'NO_FACE_DETECTED', 'face_count': 0}
+                return {
+                    'success': False,
+                    'error': f'No indexable faces (filtered: {", ".join(unindexed_reasons)})',
+                    'error_type': 'FACES_FILTERED',
+                    'face_count': face_count,
+                    'unindexed_reasons': unindexed_reasons
+                }
                 
-            face_record = response['FaceRecords'][0]
+            face_record = face_records[0]
             return {
                 'success': True,
                 'face_id': face_record['Face']['FaceId'],
                 'confidence': face_record['Face']['Confidence'],
-                'bounding_box': face_record['Face']['BoundingBox']
+                'bounding_box': face_record['Face']['BoundingBox'],
+                'face_count': face_count,
+                'unindexed_reasons': unindexed_reasons
             }
             
         except Exception as e:
@@ -194,7 +329,8 @@ class RekognitionClient:
     def search_faces_by_image(self, image_bytes: bytes, threshold: float = 80.0, max_faces: int = 5) -> Dict:
         """Buscar caras similares en la colección"""
         try:
-            response = self.rekognition.search_faces_by_image(
+            response = self._call(
+                'SearchFacesByImage', self.rekognition.search_faces_by_image,
                 CollectionId=self.collection_id,
                 Image={'Bytes': image_bytes},
                 FaceMatchThreshold=threshold,
@@ -207,6 +343,11 @@ class RekognitionClient:
                 'searched_face': response.get('SearchedFaceBoundingBox', {})
             }
             
+        except self.rekognition.exceptions.InvalidParameterException as e:
+            if is_no_face_error(e):
+                return {'success': False, 'error': 'No faces detected in image', 'error_type': 'NO_FACE_DETECTED'}
+            logger.error(f"Error searching faces: {str(e)}")
+            return {'success': False, 'error': str(e)}
         except Exception as e:
             logger.error(f"Error searching faces: {str(e)}")
             return {'success': False, 'error': str(e)}
@@ -221,7 +362,8 @@ class RekognitionClient:
                     'error': f'Image too large: {len(image_bytes)/1024/1024:.1f}MB (max: 15MB)'
                 }
             
-            response = self.rekognition.detect_faces(
+            response = self._call(
+                'DetectFaces', self.rekognition.detect_faces,
                 Image={'Bytes': image_bytes},
                 Attributes=['DEFAULT']
             )
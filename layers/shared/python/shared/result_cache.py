@@ -0,0 +1,88 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from shared.dynamodb_table import DynamoTable
+
+
+class ValidationResultCache:
+    """
+    Caché de resultados de validación: LRU en memoria del contenedor delante
+    de items DynamoDB con TTL (tabla de hashes de contenido).
+
+    La clave es la huella del contenido de la foto de usuario (ETag de S3),
+    el modo, el documento objetivo y el umbral: si la foto cambia, cambia el
+    ETag y la entrada anterior deja de aplicar.
+    """
+
+    def __init__(self, table_name: str = None, ttl_seconds: int = 3600, max_entries: int = 1024):
+        self.table = DynamoTable(table_name) if table_name else None
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.memory_hits = 0
+        self.table_hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(user_image_etag: str, validation_mode: str, target: str = '', threshold: float = None) -> tuple:
+        threshold_part = f'{threshold:g}' if threshold is not None else ''
+        return f'result#{user_image_etag}', f'{validation_mode}#{target or ""}#{threshold_part}'
+
+    def get(self, key: tuple) -> dict:
+        """{'user_image_key', 'result'} guardado para la clave, o None si no hay o expiró"""
+        now = time.time()
+        with self._lock:
+            entry = self._items.get(key)
+            if entry and entry['expires_at'] > now:
+                self._items.move_to_end(key)
+                self.memory_hits += 1
+                return entry['value']
+            if entry:
+                del self._items[key]
+
+        item = None
+        if self.table:
+            item = self.table.get_item(Key={'hash_key': key[0], 'entry_id': key[1]}).get('Item')
+        # El borrado por TTL de DynamoDB puede tardar: filtrar los expirados
+        if not item or item['ttl'] <= now:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        value = {'user_image_key': item['user_image_key'], 'result': json.loads(item['result'])}
+        self._remember(key, value, int(item['ttl']))
+        with self._lock:
+            self.table_hits += 1
+        return value
+
+    def put(self, key: tuple, user_image_key: str, result: dict):
+        expires_at = int(time.time()) + self.ttl_seconds
+        self._remember(key, {'user_image_key': user_image_key, 'result': result}, expires_at)
+        if self.table:
+            self.table.put_item(Item={
+                'hash_key': key[0],
+                'entry_id': key[1],
+                'user_image_key': user_image_key,
+                'comparison_id': result.get('comparison_id'),
+                'result': json.dumps(result, default=float),
+                'ttl': expires_at
+            })
+
+    def _remember(self, key: tuple, value: dict, expires_at: int):
+        with self._lock:
+            self._items[key] = {'value': value, 'expires_at': expires_at}
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'items': len(self._items),
+                'memory_hits': self.memory_hits,
+                'table_hits': self.table_hits,
+                'misses': self.misses
+            }
@@ -0,0 +1,79 @@
+import logging
+import threading
+
+from shared.dynamodb_table import DynamoTable, BATCH_WRITE_MAX_ITEMS
+
+logger = logging.getLogger()
+
+
+class ResultSink:
+    """
+    Buffer de items de una tabla DynamoDB: se acumulan durante la invocación
+    y se escriben con BatchWriteItem (lotes de 25, reintentando los
+    UnprocessedItems) al llamar a flush(). Un item con la misma clave
+    reemplaza al pendiente (BatchWriteItem no admite claves repetidas).
+    """
+
+    def __init__(self, table: DynamoTable, key_attribute: str):
+        self.table = table
+        self.key_attribute = key_attribute
+        self.written = 0
+        self.failed = 0
+        self._items = {}
+        self._callbacks = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._items)
+
+    def add(self, item: dict):
+        with self._lock:
+            self._items[item[self.key_attribute]] = item
+
+    def when_written(self, key: str, callback):
+        """
+        Ejecutar callback() cuando el item `key` quede escrito (en el momento
+        si no está pendiente); si su escritura falla, se descarta
+        """
+        with self._lock:
+            if key in self._items:
+                self._callbacks.setdefault(key, []).append(callback)
+                return
+        callback()
+
+    def flush(self) -> dict:
+        """
+        Escribir los items pendientes. Retorna {clave: error} de los que no se
+        pudieron escribir (si un lote falla se reportan todos sus items)
+        """
+        with self._lock:
+            items, self._items = list(self._items.values()), {}
+            callbacks, self._callbacks = self._callbacks, {}
+
+        failures = {}
+        for start in range(0, len(items), BATCH_WRITE_MAX_ITEMS):
+            chunk = items[start:start + BATCH_WRITE_MAX_ITEMS]
+            try:
+                self.table.batch_put(chunk)
+            except Exception as e:
+                logger.error(f"Error writing {len(chunk)} items to {self.table.table_name}: {str(e)}")
+                failures.update((item[self.key_attribute], str(e)) for item in chunk)
+
+        with self._lock:
+            self.written += len(items) - len(failures)
+            self.failed += len(failures)
+
+        for key, key_callbacks in callbacks.items():
+            if key in failures:
+                continue
+            for callback in key_callbacks:
+                try:
+                    callback()
+                except Exception as e:
+                    logger.warning(f"Post-write callback failed for {key}: {str(e)}")
+        return failures
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'pending': len(self._items), 'written': self.written, 'failed': self.failed}
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+⏱️ BENCHMARK DE COLD START
+Para cada Lambda arranca intérpretes nuevos (como un cold start) y mide con
+AWS simulado (ver cold_start_probe.py):
+- init_ms: import del módulo handler (fase INIT)
+- first_invocation_ms: primera invocación del contenedor
+- warm_invocation_ms: mediana de las invocaciones siguientes
+
+Genera un reporte JSON y termina con código 1 si se supera el presupuesto
+de cold_start_budget.json (o el indicado con --budget).
+
+Uso:
+    python script/benchmark_cold_start.py [--runs 5] [--warm 5] [--output reporte.json]
+                                          [--budget presupuesto.json] [--python-path /ruta/deps]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(SCRIPT_DIR)
+LAYER_PATH = os.path.join(REPO_ROOT, 'layers', 'shared', 'python')
+PROBE_PATH = os.path.join(SCRIPT_DIR, 'cold_start_probe.py')
+DEFAULT_BUDGET_PATH = os.path.join(SCRIPT_DIR, 'cold_start_budget.json')
+
+HANDLERS = {
+    'user_validator': os.path.join(REPO_ROOT, 'functions', 'user_validator'),
+    'document_indexer': os.path.join(REPO_ROOT, 'functions', 'document_indexer'),
+    'cleanup': os.path.join(REPO_ROOT, 'functions', 'cleanup'),
+}
+
+METRICS = ('init_ms', 'first_invocation_ms', 'warm_invocation_ms')
+
+# Dependencias de la layer que necesitan los handlers (módulo → paquete)
+REQUIRED_MODULES = {'boto3': 'boto3', 'PIL': 'Pillow'}
+
+# Variables que leen los handlers (valores ficticios: AWS está simulado)
+HANDLER_ENV = {
+    'AWS_DEFAULT_REGION': 'us-east-1',
+    'AWS_ACCESS_KEY_ID': 'benchmark',
+    'AWS_SECRET_ACCESS_KEY': 'benchmark',
+    'COLLECTION_ID': 'benchmark-collection',
+    'INDEXED_DOCUMENTS_TABLE': 'benchmark-indexed-documents',
+    'COMPARISON_RESULTS_TABLE': 'benchmark-comparison-results',
+    'INDEXING_RUNS_TABLE': 'benchmark-indexing-runs',
+    'CONTENT_HASHES_TABLE': 'benchmark-content-hashes',
+    'DOCUMENTS_BUCKET': 'benchmark-documents',
+    'DERIVED_BUCKET': 'benchmark-derived-documents',
+    'USER_PHOTOS_BUCKET': 'benchmark-user-photos',
+}
+
+
+def missing_dependencies(extra_paths: list) -> list:
+    """Paquetes que no se pueden importar con el mismo PYTHONPATH que las sondas"""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([LAYER_PATH] + extra_paths))
+    missing = []
+    for module, package in REQUIRED_MODULES.items():
+        completed = subprocess.run(
+            [sys.executable, '-c', f'import {module}'], env=env, capture_output=True
+        )
+        if completed.returncode != 0:
+            missing.append(package)
+    return missing
+
+
+def run_probe(handler_name: str, warm_invocations: int, extra_paths: list) -> dict:
+    function_dir = HANDLERS[handler_name]
+    env = dict(os.environ, **HANDLER_ENV)
+    env['PYTHONPATH'] = os.pathsep.join([function_dir, LAYER_PATH] + extra_paths)
+    env['PYTHONDONTWRITEBYTECODE'] = '1'
+    completed = subprocess.run(
+        [sys.executable, PROBE_PATH, handler_name, str(warm_invocations)],
+        cwd=function_dir, env=env, capture_output=True, text=True
+    )
+    if completed.returncode != 0:
+        raise RuntimeError(completed.stderr.strip().splitlines()[-1])
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def benchmark(runs: int, warm_invocations: int, extra_paths: list) -> dict:
+    report = {}
+    for handler_name in HANDLERS:
+        try:
+            samples = [run_probe(handler_name, warm_invocations, extra_paths) for _ in range(runs)]
+        except RuntimeError as e:
+            report[handler_name] = {'error': str(e)}
+            continue
+        result = {}
+        for metric in METRICS:
+            values = [sample[metric] for sample in samples if sample[metric] is not None]
+            if values:
+                result[metric] = {
+                    'median': round(statistics.median(values), 1),
+                    'min': min(values),
+                    'max': max(values)
+                }
+        result['clients_created'] = samples[-1]['clients_created']
+        result['unstubbed_operations'] = samples[-1]['unstubbed_operations']
+        report[handler_name] = result
+    return report
+
+
+def check_budget(report: dict, budget: dict) -> list:
+    """Violaciones del presupuesto (se compara la mediana de cada métrica)"""
+    violations = []
+    for handler_name, limits in budget.items():
+        if handler_name.startswith('_'):
+            continue
+        result = report.get(handler_name, {})
+        if 'error' in result:
+            violations.append(f"{handler_name}: {result['error']}")
+            continue
+        for metric, limit in limits.items():
+            measured = result.get(metric, {}).get('median')
+            if measured is not None and measured > limit:
+                violations.append(f"{handler_name}.{metric}: {measured}ms > {limit}ms")
+    return violations
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark de cold start de las Lambdas')
+    parser.add_argument('--runs', type=int, default=5, help='Intérpretes nuevos (cold starts) por handler')
+    parser.add_argument('--warm', type=int, default=5, help='Invocaciones en caliente por cold start')
+    parser.add_argument('--budget', default=DEFAULT_BUDGET_PATH, help='JSON con límites en ms por handler y métrica')
+    parser.add_argument('--output', help='Ruta donde escribir el reporte JSON')
+    parser.add_argument('--python-path', action='append', default=[],
+                        help='Rutas extra con dependencias (boto3, Pillow) si no están instaladas')
+    args = parser.parse_args()
+
+    missing = missing_dependencies(args.python_path)
+    if missing:
+        print(f"❌ Faltan dependencias: {', '.join(missing)}. Instala layers/shared/python/requirements.txt "
+              f"(pip install -r layers/shared/python/requirements.txt) o indica su ruta con --python-path")
+        sys.exit(1)
+
+    with open(args.budget) as budget_file:
+        budget = json.load(budget_file)
+
+    print(f"⏱️ COLD START BENCHMARK ({args.runs} cold starts x {args.warm} invocaciones en caliente)")
+    print("=" * 60)
+
+    results = benchmark(args.runs, args.warm, args.python_path)
+    violations = check_budget(results, budget)
+    report = {
+        'runs': args.runs,
+        'warm_invocations': args.warm,
+        'python': sys.version.split()[0],
+        'results': results,
+        'budget': {k: v for k, v in budget.items() if not k.startswith('_')},
+        'budget_exceeded': violations
+    }
+
+    for handler_name, result in results.items():
+        if 'error' in result:
+            print(f"❌ {handler_name}: {result['error']}")
+            continue
+        print(f"📦 {handler_name}")
+        for metric in METRICS:
+            if metric in result:
+                stats = result[metric]
+                print(f"   {metric}: {stats['median']}ms mediana (min {stats['min']}ms, max {stats['max']}ms)")
+        if result['unstubbed_operations']:
+            print(f"   ⚠️ Operaciones sin respuesta simulada: {', '.join(result['unstubbed_operations'])}")
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+        print(f"📄 Reporte: {args.output}")
+    else:
+        print(json.dumps(report, indent=2))
+
+    if violations:
+        print("❌ PRESUPUESTO SUPERADO:")
+        for violation in violations:
+            print(f"   - {violation}")
+        sys.exit(1)
+    print("✅ Dentro del presupuesto")
+
+
+if __name__ == "__main__":
+    main()
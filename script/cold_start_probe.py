@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Sonda que benchmark_cold_start.py lanza en un intérprete nuevo por handler:
+1. INIT: import del módulo handler
+2. Primera invocación (construye clientes, carga modelos de botocore...)
+3. Invocaciones en caliente
+
+Las llamadas a AWS no salen a la red: un hook 'before-call' de botocore (el
+mismo mecanismo que usa botocore.stub.Stubber) devuelve respuestas fijas
+después de validar y serializar los parámetros.
+
+Uso: python cold_start_probe.py <handler> <invocaciones_en_caliente>
+Imprime una línea JSON con los tiempos.
+"""
+
+import json
+import sys
+import time
+
+start = time.perf_counter()
+import handler
+init_ms = (time.perf_counter() - start) * 1000
+
+import io
+import itertools
+import statistics
+from datetime import datetime
+
+HANDLER_NAME = sys.argv[1]
+WARM_INVOCATIONS = int(sys.argv[2])
+
+unstubbed_operations = []
+get_object_calls = itertools.count(1)
+
+
+def sample_jpeg() -> bytes:
+    from PIL import Image, ImageDraw, ImageFilter
+    image = Image.effect_noise((640, 480), 40).convert('RGB').filter(ImageFilter.GaussianBlur(1))
+    draw = ImageDraw.Draw(image)
+    draw.ellipse((220, 120, 420, 380), fill=(200, 160, 140), outline=(20, 20, 20), width=4)
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+
+IMAGE_BYTES = sample_jpeg() if HANDLER_NAME != 'cleanup' else b''
+FACE = {'Width': 0.3, 'Height': 0.5, 'Left': 0.35, 'Top': 0.25}
+
+
+def canned_response(operation: str, params: dict) -> dict:
+    """Respuesta fija por operación con la forma que devuelve AWS"""
+    if operation == 'HeadObject':
+        # ETag distinto en cada consulta: cada invocación valida una foto nueva (sin aciertos de caché)
+        return {'ContentLength': len(IMAGE_BYTES), 'ETag': f'"benchmark-{next(get_object_calls)}"'}
+    if operation == 'GetObject':
+        from botocore.response import StreamingBody
+        return {'Body': StreamingBody(io.BytesIO(IMAGE_BYTES), len(IMAGE_BYTES)), 'ContentLength': len(IMAGE_BYTES),
+                'ETag': f'"benchmark-{next(get_object_calls)}"'}
+    if operation in ('PutObject', 'DeleteObject', 'PutItem', 'DeleteFaces'):
+        return {}
+    if operation in ('Query', 'Scan'):
+        return {'Items': [], 'Count': 0, 'ScannedCount': 0}
+    if operation == 'GetItem':
+        return {}
+    if operation == 'BatchWriteItem':
+        return {'UnprocessedItems': {}}
+    if operation == 'DescribeCollection':
+        return {'FaceCount': 0, 'FaceModelVersion': '7.0', 'CreationTimestamp': datetime(2025, 1, 1),
+                'CollectionARN': 'arn:aws:rekognition:us-east-1:000000000000:collection/benchmark'}
+    if operation == 'ListFaces':
+        return {'Faces': []}
+    if operation == 'DetectFaces':
+        return {'FaceDetails': [{'BoundingBox': FACE, 'Confidence': 99.9}]}
+    if operation == 'IndexFaces':
+        return {'FaceRecords': [{'Face': {'FaceId': 'benchmark-face', 'BoundingBox': FACE, 'Confidence': 99.9}}],
+                'UnindexedFaces': []}
+    if operation == 'SearchFacesByImage':
+        return {'SearchedFaceBoundingBox': FACE, 'SearchedFaceConfidence': 99.9, 'FaceMatches': []}
+    if operation == 'CompareFaces':
+        return {'SourceImageFace': {'BoundingBox': FACE, 'Confidence': 99.9},
+                'FaceMatches': [{'Similarity': 97.5, 'Face': {'BoundingBox': FACE, 'Confidence': 99.9}}],
+                'UnmatchedFaces': []}
+    if operation == 'Invoke':
+        return {'StatusCode': 202}
+    unstubbed_operations.append(operation)
+    return {}
+
+
+def stub_aws_calls(event_name: str, model=None, params=None, **kwargs):
+    from botocore.awsrequest import AWSResponse
+    return AWSResponse(None, 200, {}, None), canned_response(model.name, params)
+
+
+# Registrar el hook en la sesión compartida cuando el handler la cree
+from shared import aws_clients
+_create_session = aws_clients.get_session
+
+
+def get_stubbed_session():
+    session = _create_session()
+    if not getattr(session, '_benchmark_stubbed', False):
+        session.events.register('before-call.*.*', stub_aws_calls)
+        session._benchmark_stubbed = True
+    return session
+
+
+aws_clients.get_session = get_stubbed_session
+
+EVENTS = {
+    'user_validator': {
+        'validation_mode': 'DIRECT_COMPARE',
+        'user_image_key': 'benchmark_user.jpg',
+        'document_image_key': 'benchmark_dni.jpg'
+    },
+    'document_indexer': {
+        'Records': [{
+            'eventSource': 'aws:s3',
+            's3': {'bucket': {'name': 'benchmark-documents'}, 'object': {'key': 'benchmark_dni.jpg'}}
+        }]
+    },
+    'cleanup': {'action': 'status'}
+}
+
+
+class LambdaContext:
+    function_name = f'benchmark-{HANDLER_NAME}'
+    invoked_function_arn = f'arn:aws:lambda:us-east-1:000000000000:function:benchmark-{HANDLER_NAME}'
+
+    def get_remaining_time_in_millis(self):
+        return 300000
+
+
+def invoke() -> float:
+    start = time.perf_counter()
+    response = handler.lambda_handler(EVENTS[HANDLER_NAME], LambdaContext())
+    elapsed = (time.perf_counter() - start) * 1000
+    if response.get('statusCode', 200) != 200:
+        raise RuntimeError(f"{HANDLER_NAME} returned {response.get('statusCode')}: {response.get('body')}")
+    # Los handlers responden 200 también con errores internos: medir un camino de error no vale
+    body = json.loads(response.get('body') or '{}')
+    if body.get('status') == 'ERROR' or body.get('errors'):
+        raise RuntimeError(f"{HANDLER_NAME} failed: {response['body']}")
+    return elapsed
+
+
+first_invocation_ms = invoke()
+warm_times = [invoke() for _ in range(WARM_INVOCATIONS)]
+
+print(json.dumps({
+    'init_ms': round(init_ms, 1),
+    'first_invocation_ms': round(first_invocation_ms, 1),
+    'warm_invocation_ms': round(statistics.median(warm_times), 1) if warm_times else None,
+    'clients_created': aws_clients.clients_created(),
+    'unstubbed_operations': sorted(set(unstubbed_operations))
+}))
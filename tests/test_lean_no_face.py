@@ -0,0 +1,83 @@
+"""
+Modo lean (sin DetectFaces previo): CompareFaces responde
+InvalidParameterException ("Request has invalid parameters") tanto si falta la
+cara en la foto de usuario como en el documento. Con respuestas de AWS
+simuladas (botocore Stubber) se comprueba que se siguen distinguiendo:
+- sin cara en la foto de usuario → NO_FACE_IN_USER_IMAGE
+- sin cara en el documento → COMPARISON_ERROR
+
+Requiere las dependencias de layers/shared/python/requirements.txt
+"""
+
+import importlib.util
+import os
+import sys
+import time
+
+import pytest
+
+pytest.importorskip('boto3')
+pytest.importorskip('PIL')
+from botocore.stub import Stubber
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+os.environ.update({
+    'AWS_DEFAULT_REGION': 'us-east-1',
+    'AWS_ACCESS_KEY_ID': 'test',
+    'AWS_SECRET_ACCESS_KEY': 'test',
+    'COLLECTION_ID': 'test-collection',
+    'COMPARISON_RESULTS_TABLE': 'test-comparison-results',
+    'INDEXED_DOCUMENTS_TABLE': 'test-indexed-documents',
+    'DOCUMENTS_BUCKET': 'test-documents',
+    'USER_PHOTOS_BUCKET': 'test-user-photos',
+    'LEAN_VALIDATION': 'true',
+    'IMAGE_QUALITY_GATE': 'false',
+})
+sys.path.insert(0, os.path.join(REPO_ROOT, 'layers', 'shared', 'python'))
+
+spec = importlib.util.spec_from_file_location(
+    'user_validator_handler', os.path.join(REPO_ROOT, 'functions', 'user_validator', 'handler.py')
+)
+handler = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(handler)
+
+from shared import aws_clients
+from shared.rekognition_client import REKOGNITION_CLIENT_CONFIG
+
+INVALID_PARAMETERS = {
+    'service_error_code': 'InvalidParameterException',
+    'service_message': 'Request has invalid parameters',
+    'http_status_code': 400,
+}
+
+
+@pytest.fixture
+def rekognition():
+    client = aws_clients.get_client('rekognition', **REKOGNITION_CLIENT_CONFIG)
+    with Stubber(client) as stubber:
+        yield stubber
+        stubber.assert_no_pending_responses()
+
+
+def compare(user_key: str) -> dict:
+    return handler.compare_and_store_by_image_key(
+        handler.generate_comparison_id(), user_key, 'juan_dni.jpg', None,
+        b'user-photo', b'document', time.time()
+    )
+
+
+def test_user_photo_without_face(rekognition):
+    rekognition.add_client_error('compare_faces', **INVALID_PARAMETERS)
+    rekognition.add_response('detect_faces', {'FaceDetails': []})
+
+    assert compare('no_face.jpg')['status'] == 'NO_FACE_IN_USER_IMAGE'
+
+
+def test_document_without_face(rekognition):
+    rekognition.add_client_error('compare_faces', **INVALID_PARAMETERS)
+    rekognition.add_response('detect_faces', {
+        'FaceDetails': [{'BoundingBox': {'Width': 0.3, 'Height': 0.5, 'Left': 0.35, 'Top': 0.25}, 'Confidence': 99.9}]
+    })
+
+    assert compare('face.jpg')['status'] == 'COMPARISON_ERROR'